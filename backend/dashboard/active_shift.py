@@ -0,0 +1,121 @@
+"""
+Кэш активных смен линий.
+
+Активную смену линии ищут на каждом событии упаковки, переключении задания,
+запросе /api/shift/active/ и подключении веб-сокета. Её снимок (id, линия,
+мастер, время старта) лежит в Redis под ключом line:{code}:active_shift и
+дополнительно несколько секунд помнится в памяти процесса
+(ACTIVE_SHIFT_CACHE_TTL). Shift.start_shift записывает снимок,
+finalize_shifts сбрасывает его. Если ключа в Redis нет, смена берётся из БД
+и ключ заполняется заново – только если его не успел записать старт или
+завершение смены (SET NX), и на короткий срок.
+"""
+import json
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from dashboard.models import Line, Shift
+from dashboard.repos.connection import get_async_redis
+from dashboard.repos.redis_repository import RedisRepository, active_shift_key
+
+# {код линии: (срок, снимок)}
+_cache = {}
+_lock = threading.Lock()
+
+
+def request_line(request):
+    """Код линии из параметра line запроса или тела; по умолчанию – основная линия."""
+    line = request.query_params.get('line')
+    if not line and isinstance(request.data, dict):
+        line = request.data.get('line')
+    return line or Line.DEFAULT_CODE
+
+
+def shift_snapshot(shift):
+    return {
+        "id": shift.id,
+        "line": shift.line.code,
+        "master": shift.master_id,
+        "master_name": shift.master.name,
+        "status": shift.status,
+        "start_time": shift.start_time.isoformat() if shift.start_time else None,
+    }
+
+
+def _remember_locally(line, snapshot):
+    with _lock:
+        _cache[line] = (time.monotonic() + settings.SHIFT_ENGINE["ACTIVE_SHIFT_CACHE_TTL"], snapshot)
+
+
+def _cached(line):
+    with _lock:
+        expires, snapshot = _cache.get(line, (0, None))
+        if expires > time.monotonic():
+            return True, snapshot
+    return False, None
+
+
+def get_active_shift_info(line=None):
+    """Снимок активной смены линии или None."""
+    line = line or Line.DEFAULT_CODE
+    hit, snapshot = _cached(line)
+    if hit:
+        return snapshot
+
+    redis = RedisRepository()
+    hit, snapshot = redis.get_active_shift(line)
+    if not hit:
+        shift = Shift.objects.select_related('master', 'line').filter(
+            status=Shift.Status.ACTIVE, line__code=line
+        ).order_by('-start_time').first()
+        snapshot = shift_snapshot(shift) if shift else None
+        if not redis.refill_active_shift(line, snapshot):
+            # Пока читали БД, смену начали или завершили – верим Redis
+            hit, current = redis.get_active_shift(line)
+            if hit:
+                snapshot = current
+    _remember_locally(line, snapshot)
+    return snapshot
+
+
+def get_active_shift_id(line=None):
+    snapshot = get_active_shift_info(line)
+    return snapshot["id"] if snapshot else None
+
+
+async def aget_active_shift_id(line=None):
+    """Асинхронный вариант для консьюмеров: промах уходит в БД через поток."""
+    line = line or Line.DEFAULT_CODE
+    hit, snapshot = _cached(line)
+    if not hit:
+        raw = await get_async_redis().get(active_shift_key(line))
+        if raw is None:
+            snapshot = await sync_to_async(get_active_shift_info)(line)
+        else:
+            snapshot = json.loads(raw)
+            _remember_locally(line, snapshot)
+    return snapshot["id"] if snapshot else None
+
+
+def remember_active_shift(shift):
+    """Вызывается при старте смены."""
+    snapshot = shift_snapshot(shift)
+    RedisRepository().set_active_shift(snapshot["line"], snapshot)
+    _remember_locally(snapshot["line"], snapshot)
+
+
+def forget_active_shifts(shift_ids):
+    """Вызывается при завершении смен; другие процессы забудут смену через ACTIVE_SHIFT_CACHE_TTL."""
+    shift_ids = list(shift_ids)
+    redis = RedisRepository()
+    lines = set(Shift.objects.filter(id__in=shift_ids).values_list('line__code', flat=True))
+    for line in lines:
+        redis.clear_active_shift(line, shift_ids)
+    with _lock:
+        for line in lines:
+            _, snapshot = _cache.get(line, (0, None))
+            if snapshot and snapshot["id"] in shift_ids:
+                _cache.pop(line)
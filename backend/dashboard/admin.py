@@ -3,7 +3,8 @@ from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
 
 from .forms import CustomUserCreationForm
-from .models import Product, Packing, Shift, PackingLog, BreakLog, ProductPacking, ShiftTask, DefaultSettings, Master
+from .models import Product, Packing, Shift, PackingLog, BreakLog, ProductPacking, ShiftTask, DefaultSettings, Master, \
+    ShiftSummary, MasterStatistics, Line
 
 
 class CustomUserAdmin(UserAdmin):
@@ -48,9 +49,10 @@ class ShiftTaskInline(admin.TabularInline):
     ordering = ('order',)
 
 class ShiftAdmin(admin.ModelAdmin):
-    list_display = ('master', 'status', 'start_time', 'end_time', 'user_starts', 'get_products', 'get_packings')
+    list_display = ('master', 'line', 'status', 'start_time', 'end_time', 'user_starts', 'get_products',
+                    'get_packings')
     search_fields = ('name', 'user_starts__username')
-    list_filter = ('status', 'start_time', 'user_starts')
+    list_filter = ('status', 'line', 'start_time', 'user_starts')
     date_hierarchy = 'start_time'
     inlines = [ShiftTaskInline]
     list_per_page = 50
@@ -144,6 +146,26 @@ class MasterAdmin(admin.ModelAdmin):
     ordering = ('name',)
     list_per_page = 50
 
+class LineAdmin(admin.ModelAdmin):
+    list_display = ('code', 'name', 'is_active')
+    list_filter = ('is_active',)
+    search_fields = ('code', 'name')
+    ordering = ('code',)
+
+class ShiftSummaryAdmin(admin.ModelAdmin):
+    list_display = ('shift', 'master', 'start_time', 'avg_completion', 'units_packed', 'tasks_count')
+    list_filter = ('master',)
+    date_hierarchy = 'start_time'
+    ordering = ('-start_time',)
+    list_per_page = 50
+
+
+class MasterStatisticsAdmin(admin.ModelAdmin):
+    list_display = ('master', 'period', 'period_start', 'shifts_count', 'avg_completion', 'units_packed')
+    list_filter = ('period', 'master')
+    ordering = ('-period_start',)
+    list_per_page = 50
+
 admin.site.register(Product, ProductAdmin)
 admin.site.register(Packing, PackingAdmin)
 admin.site.register(Shift, ShiftAdmin)
@@ -152,3 +174,6 @@ admin.site.register(BreakLog, BreakLogAdmin)
 admin.site.register(ShiftTask, ShiftTaskAdmin)
 admin.site.register(DefaultSettings, DefaultSettingsAdmin)
 admin.site.register(Master, MasterAdmin)
+admin.site.register(Line, LineAdmin)
+admin.site.register(ShiftSummary, ShiftSummaryAdmin)
+admin.site.register(MasterStatistics, MasterStatisticsAdmin)
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+# Поля, которые меняются при каждом чтении и не считаются изменением задания
+VOLATILE_FIELDS = {"server_time"}
+
+
+def version_key(shift_id):
+    return f"shift:{shift_id}:version"
+
+
+def line_group(line):
+    return f"line_{line}"
+
+
+class ShiftBroadcaster:
+    """
+    Долгоживущий асинхронный публикатор обновлений для групп shift_{id}.
+
+    Сообщения смены копятся в outbox в течение окна (BROADCAST_WINDOW),
+    подряд идущие update одного задания сливаются в одно. Для update
+    отправляются только поля, изменившиеся с прошлой отправки. Каждое
+    сообщение получает номер версии смены, по которому клиент замечает
+    пропуски и запрашивает снимок заново.
+    """
+
+    def __init__(self, redis_conn, window=None):
+        self.redis = redis_conn
+        self.window = settings.SHIFT_ENGINE["BROADCAST_WINDOW"] if window is None else window
+        self.channel_layer = get_channel_layer()
+        self._outboxes = {}
+        self._flushes = {}
+        self._last_sent = {}
+
+    async def publish(self, shift_id, message):
+        outbox = self._outboxes.setdefault(shift_id, [])
+        last = outbox[-1] if outbox else None
+        if (
+            last is not None
+            and message.get("event") == "update"
+            and last.get("event") == "update"
+            and last.get("task_id") == message.get("task_id")
+        ):
+            last["data"] = {**last["data"], **message["data"]}
+        else:
+            outbox.append(message)
+
+        if shift_id not in self._flushes:
+            self._flushes[shift_id] = asyncio.create_task(self._flush_later(shift_id))
+
+    async def _flush_later(self, shift_id):
+        await asyncio.sleep(self.window)
+        try:
+            await self.flush(shift_id)
+        except Exception:
+            logging.exception(f"[SHIFT {shift_id}] Broadcast error")
+
+    async def flush(self, shift_id):
+        self._flushes.pop(shift_id, None)
+        messages = [
+            message for message in
+            (self._to_delta(shift_id, message) for message in self._outboxes.pop(shift_id, []))
+            if message
+        ]
+        if not messages:
+            return
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.incrby(version_key(shift_id), len(messages))
+            pipe.expire(version_key(shift_id), 24 * 60 * 60)
+            version, _ = await pipe.execute()
+
+        group = f"shift_{shift_id}"
+        for number, message in enumerate(messages, start=version - len(messages) + 1):
+            message["version"] = number
+            await self.channel_layer.group_send(group, message)
+
+        if any(message.get("event") == "completed" for message in messages):
+            self.forget(shift_id)
+
+    async def announce(self, line, message):
+        """Событие линии (например, старт новой смены) для всех её клиентов, без версии и окна."""
+        await self.channel_layer.group_send(line_group(line), message)
+
+    def forget(self, shift_id):
+        for key in [key for key in self._last_sent if key[0] == shift_id]:
+            del self._last_sent[key]
+
+    def _to_delta(self, shift_id, message):
+        """Оставляет в update только изменившиеся поля задания."""
+        if message.get("type") != "task.update":
+            task = (message.get("data") or {}).get("task") if message.get("event") == "new_task" else None
+            if task:
+                self._last_sent[(shift_id, str(task.get("id")))] = dict(task)
+            return message
+
+        key = (shift_id, str(message.get("task_id")))
+        sent = self._last_sent.setdefault(key, {})
+        data = message.get("data") or {}
+        if message.get("event") != "update":
+            sent.update(data)
+            return message
+
+        changed = {
+            field: value for field, value in data.items()
+            if field in VOLATILE_FIELDS or str(sent.get(field)) != str(value)
+        }
+        if not set(changed) - VOLATILE_FIELDS:
+            return None
+        sent.update(changed)
+        return {**message, "data": changed}
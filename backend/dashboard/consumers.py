@@ -1,105 +1,218 @@
+import asyncio
 import json
-import redis
+import time
+
 from channels.generic.websocket import AsyncWebsocketConsumer
-from asgiref.sync import sync_to_async
-from django.conf import settings
 
-from dashboard.models import Shift
+from dashboard.active_shift import aget_active_shift_id
+from dashboard.broadcast import line_group
+from dashboard.models import Line
+from dashboard.repos.connection import get_async_redis
+from dashboard.repos.redis_repository import SHIFT_SNAPSHOT_SCRIPT, parse_snapshot, snapshot_keys
+from dashboard.subscriptions import Subscription
+from dashboard.timers import with_timers
 
 
 class ShiftConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         """
-        При подключении веб-сокета:
-        1. Устанавливаем соединение с Redis.
-        2. Получаем активный идентификатор смены (предполагается, что он хранится в Redis под ключом 'active_shift').
-        3. Если активная смена найдена, подписываемся на группу и отправляем клиенту данные смены,
-           извлечённые из Redis, а также список заданий, привязанных к этой смене.
-        """
-        # Инициализируем соединение с Redis с использованием настроек из settings
-        self.redis_conn = redis.Redis(
-            host=settings.REDIS_CONFIG["HOST"],
-            port=settings.REDIS_CONFIG["PORT"],
-            db=settings.REDIS_CONFIG["DB"],
-            password=settings.REDIS_CONFIG.get("PASSWORD"),
-            decode_responses=True,
-        )
-
-        active_shift = await sync_to_async(
-            lambda: Shift.objects.filter(status=Shift.Status.ACTIVE).order_by("-id").first()
-        )()
-        # Предполагаем, что идентификатор активной смены хранится под ключом "active_shift"
-        #active_shift = self.redis_conn.get("active_shift")
-        if active_shift:
-            self.shift_id = active_shift.id
-            self.group_name = f"shift_{self.shift_id}"
-            await self.channel_layer.group_add(self.group_name, self.channel_name)
-            await self.accept()
-
-            # Получаем данные смены из Redis по ключу "shift:{shift_id}"
-            shift_key = f"shift:{self.shift_id}"
-            shift_data = self.redis_conn.hgetall(shift_key)
-
-            # Получаем список идентификаторов заданий для данной смены
-            tasks_list_key = f"shift:{self.shift_id}:tasks"
-            tasks = self.redis_conn.lrange(tasks_list_key, 0, -1)
-
-            shift_tasks = []
-
-            # Перебор всех задач
-            for task in tasks:
-                task_data = self.redis_conn.hgetall(f"task:{task}")
-
-                # Для каждой задачи извлекаем нужные поля
-                task_info = {}
-                for key in task_data:
-                    # Преобразуем байтовые строки в нормальные строки (если нужно)
-                    task_info[key] = task_data[key]
+        При подключении веб-сокета (ws/shifts/<линия>/, без линии – основная):
+        1. Берём асинхронный клиент Redis из общего пула.
+        2. Получаем идентификатор активной смены линии из кэша (ключ line:{code}:active_shift в Redis).
+        3. Если активная смена найдена, подписываемся на группы линии и смены и отправляем клиенту
+           данные смены, извлечённые из Redis, а также список заданий, привязанных к этой смене.
+        """
+        # Асинхронный клиент Redis на общем пуле, чтобы не блокировать цикл событий
+        self.redis_conn = get_async_redis()
+        self.snapshot_script = self.redis_conn.register_script(SHIFT_SNAPSHOT_SCRIPT)
+        self.line = self.scope["url_route"]["kwargs"].get("line") or Line.DEFAULT_CODE
+        # Без подписки – полный поток (см. dashboard.subscriptions)
+        self.subscription = Subscription()
+        self._pending = {}
+        self._pending_flush = None
+        self._last_update = 0
 
-                shift_tasks.append(task_info)
+        # Активная смена берётся из кэша (dashboard.active_shift), БД – только при промахе
+        shift_id = await aget_active_shift_id(self.line)
+        if shift_id:
+            # Через группу линии приходит следующая смена, когда текущая завершится
+            self.line_group_name = line_group(self.line)
+            await self.channel_layer.group_add(self.line_group_name, self.channel_name)
+            await self._join_shift(shift_id)
+            await self.accept()
 
-            # Отправляем клиенту начальные данные
-            payload = {
-                "shift": shift_data,
-                "tasks": shift_tasks,
-            }
-            await self.send(text_data=json.dumps({
-                "type": "shift_init",
-                "data": payload,
-            }))
+            await self._send_snapshot()
         else:
             # Если активная смена не найдена — закрываем соединение
             await self.close()
 
     async def disconnect(self, close_code):
         """
-        При отключении убираем соединение из группы смены.
+        При отключении убираем соединение из групп линии и смены.
         """
         if hasattr(self, 'group_name'):
             await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        if hasattr(self, 'line_group_name'):
+            await self.channel_layer.group_discard(self.line_group_name, self.channel_name)
+        if getattr(self, '_pending_flush', None):
+            self._pending_flush.cancel()
 
-    async def receive(self, text_data):
+    async def _join_shift(self, shift_id):
+        if hasattr(self, 'group_name'):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        self.shift_id = shift_id
+        self.group_name = f"shift_{self.shift_id}"
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+
+    async def _send_snapshot(self):
+        """
+        Отправляет клиенту полный снимок смены из Redis вместе с номером версии.
+        Снимок читается одним Lua-скриптом, поэтому занимает один запрос
+        независимо от числа заданий. Обновления с версией не выше снимка
+        в нём уже учтены.
+        """
+        raw = await self.snapshot_script(keys=snapshot_keys(self.shift_id))
+        self.version, shift_data, tasks = parse_snapshot(raw)
+
+        # Таймеры не хранятся в Redis, а вычисляются из отметок времени
+        payload = {
+            "shift": shift_data,
+            "tasks": [self.subscription.filter_task(with_timers(task)) for task in tasks],
+        }
+        # Снимок уже содержит всё, что ждало отправки
+        self._pending.clear()
+        await self.send(text_data=json.dumps({
+            "type": "shift_init",
+            "version": self.version,
+            "data": payload,
+        }))
+
+    async def _accept_version(self, event):
         """
-        Обработка входящих сообщений от клиента (например, подтверждение или команды).
-        В данный момент сообщение просто логируется.
+        Проверяет версию обновления: устаревшие пропускаются, а при пропуске
+        версий клиенту заново отправляется снимок.
         """
-        data = json.loads(text_data)
-        print("Получено сообщение от клиента:", data)
+        version = event.get("version")
+        if version is None:
+            return True
+        if version <= self.version:
+            return False
+        if version > self.version + 1:
+            await self._send_snapshot()
+            return False
+        self.version = version
+        return True
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+        Обработка входящих сообщений от клиента.
+        {"action": "resync"} – клиент заметил пропуск версий и просит снимок.
+        {"action": "subscribe", "events": [...], "fields": [...], "rate": 1} –
+        выборочная подписка (dashboard.subscriptions); в ответ приходит
+        подтверждение и снимок смены с учётом выбранных полей.
+        Сообщение, которое не является JSON-объектом, не рвёт соединение:
+        клиенту уходит ошибка.
+        """
+        try:
+            data = json.loads(text_data)
+        except (TypeError, ValueError):
+            data = None
+        if not isinstance(data, dict):
+            await self._send_error(None, "Message must be a JSON object")
+            return
+
+        if data.get("action") == "resync" and hasattr(self, "shift_id"):
+            await self._send_snapshot()
+        elif data.get("action") == "subscribe":
+            try:
+                subscription = Subscription.parse(data)
+            except ValueError as e:
+                await self._send_error("subscribe", str(e))
+                return
+            await self._flush_pending()
+            self.subscription = subscription
+            await self.send(text_data=json.dumps({"type": "subscribed", "data": subscription.as_dict()}))
+            if hasattr(self, "shift_id"):
+                await self._send_snapshot()
+
+    async def _send_error(self, action, detail):
+        await self.send(text_data=json.dumps({"type": "error", "action": action, "detail": detail}))
+
+    async def _deliver(self, message):
+        """
+        Отправляет обновление с учётом подписки. В полном потоке сообщения
+        идут как есть, с номером версии; в выборочном версия не передаётся
+        (пропуски там ожидаемы), а обновления update копятся и уходят не
+        чаще rate раз в секунду.
+        """
+        if self.subscription.is_full:
+            await self.send(text_data=json.dumps(message))
+            return
+
+        message = self.subscription.apply(message)
+        if message is None:
+            return
+        message.pop("version", None)
+        if message["type"] == "task_update" and message["event"] == "update" and self.subscription.interval:
+            self._pending.setdefault(message["task_id"], {}).update(message["data"])
+            if self._pending_flush is None:
+                delay = self._last_update + self.subscription.interval - time.monotonic()
+                self._pending_flush = asyncio.create_task(self._flush_later(max(0, delay)))
+            return
+
+        # Остальные события не должны обогнать накопленные обновления
+        await self._flush_pending()
+        await self.send(text_data=json.dumps(message))
+
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        self._pending_flush = None
+        await self._flush_pending()
+
+    async def _flush_pending(self):
+        if self._pending_flush is not None:
+            self._pending_flush.cancel()
+        self._pending_flush = None
+        pending, self._pending = self._pending, {}
+        for task_id, data in pending.items():
+            await self.send(text_data=json.dumps({
+                "type": "task_update",
+                "event": "update",
+                "task_id": task_id,
+                "data": data,
+            }))
+        if pending:
+            self._last_update = time.monotonic()
 
     async def task_update(self, event):
         """
-        Обработчик обновлений заданий, приходящих, например, из Celery-задачи.
+        Обработчик обновлений заданий, приходящих от движка смен.
         Ожидается, что event содержит ключи:
-          - event: тип события (start, update, finish)
+          - event: тип события (update, finish, pause, resume)
           - task_id: идентификатор задания
-          - data: обновлённые данные задания
+          - data: изменившиеся поля задания (для update) или всё задание
+          - version: номер версии смены
         """
-        await self.send(text_data=json.dumps({
+        if not await self._accept_version(event):
+            return
+        await self._deliver({
             "type": "task_update",
             "event": event.get("event"),
             "task_id": event.get("task_id"),
+            "version": event.get("version"),
             "data": event.get("data"),
-        }))
+        })
+
+    async def line_update(self, event):
+        """
+        Обработчик событий линии. shift_started – на линии началась новая
+        смена: соединение переходит в её группу и получает её снимок.
+        """
+        shift_id = (event.get("data") or {}).get("shift_id")
+        if event.get("event") != "shift_started" or not shift_id or shift_id == self.shift_id:
+            return
+        await self._join_shift(shift_id)
+        await self._send_snapshot()
 
     async def shift_update(self, event):
         """
@@ -107,9 +220,13 @@ class ShiftConsumer(AsyncWebsocketConsumer):
         Ожидается, что event содержит:
           - event: тип события (например, completed)
           - data: данные, связанные со сменой
+          - version: номер версии смены
         """
-        await self.send(text_data=json.dumps({
+        if not await self._accept_version(event):
+            return
+        await self._deliver({
             "type": "shift_update",
             "event": event.get("event"),
+            "version": event.get("version"),
             "data": event.get("data"),
-        }))
+        })
@@ -0,0 +1,499 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import socket
+import time
+import traceback
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.forms.models import model_to_dict
+from django.utils import timezone
+
+from dashboard.broadcast import ShiftBroadcaster
+from dashboard.metrics import alert_data, client_metrics, task_metrics, window_minutes
+from dashboard.models import Shift
+from dashboard.repos.connection import get_async_redis
+from dashboard.repos.redis_repository import ADVANCE_TASK_SCRIPT, CHECKPOINT_DIRTY_KEY, ENGINE_CHANNEL, \
+    METRICS_SCRIPT, RELEASE_LEASE_SCRIPT, RENEW_LEASE_SCRIPT, SHIFT_SCHEDULE_KEY, TASK_SCRIPT, lease_key, \
+    metrics_args, throughput_key, to_dict
+from dashboard.services import finalize_shifts, restore_shift_state, start_planned_shift
+from dashboard.timers import remaining_seconds, to_epoch, with_timers
+
+
+def shift_info(shift_id):
+    """Полная информация о смене из БД в виде, пригодном для отправки по WS."""
+    try:
+        shift = Shift.objects.get(id=shift_id)
+        return json.loads(json.dumps(model_to_dict(shift), cls=DjangoJSONEncoder))
+    except Exception as e:
+        logging.error(f"[SHIFT {shift_id}] Ошибка получения смены из БД: {str(e)}", exc_info=True)
+        return {"id": shift_id}
+
+
+class ShiftState:
+    """Состояние одной смены, которую ведёт движок."""
+
+    def __init__(self, shift_id, task_ids):
+        self.shift_id = shift_id
+        self.task_ids = task_ids
+        self.active_index = None
+        self.task_id = None
+        self.task = None
+        # Поколение отсекает устаревшие дедлайны в куче
+        self.generation = 0
+
+    @property
+    def shift_key(self):
+        return f"shift:{self.shift_id}"
+
+    @property
+    def task_key(self):
+        return f"task:{self.task_id}"
+
+
+class ShiftEngine:
+    """
+    Ведёт все активные смены в одном asyncio-процессе.
+
+    Вместо отдельного воркера со sleep-циклом на каждую смену используется
+    куча дедлайнов: смена просыпается только тогда, когда нужно завершить
+    перерыв. Таймеры вычисляются из отметок времени (см. dashboard.timers),
+    поэтому клиентам отправляются только переходы: new_task, finish, pause,
+    resume, а время между ними клиенты считают сами. Смена активного задания,
+    паузы и изменения счётчиков приходят уведомлением через Redis pub/sub.
+    Движок – единственный отправитель в группы shift_{id}, все сообщения
+    проходят через ShiftBroadcaster. Периодическая сверка с БД и Redis
+    подхватывает потерянные уведомления. Он же запускает запланированные
+    смены по очереди shifts:schedule.
+
+    Движков может быть несколько: смену ведёт тот, кто держит её аренду
+    shift:{id}:lease. Аренда продлевается каждые LEASE_TTL / 3 секунд;
+    если движок упал, по истечении аренды смену подхватит другой при
+    ближайшей сверке. Движок, потерявший аренду, отпускает смену.
+    """
+
+    def __init__(self, resync_interval=None):
+        self.resync_interval = resync_interval or settings.SHIFT_ENGINE["RESYNC_INTERVAL"]
+        self.shifts = {}
+        self._deadlines = []
+        self._sequence = itertools.count()
+        self._events = None
+        self._schedule_changed = None
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lease_ms = int(settings.SHIFT_ENGINE["LEASE_TTL"] * 1000)
+
+    async def run(self):
+        self.redis = get_async_redis()
+        self.broadcaster = ShiftBroadcaster(self.redis)
+        self._events = asyncio.Queue()
+        self._events.put_nowait({"event": "resync"})
+        self._schedule_changed = asyncio.Event()
+        self._renew_lease = self.redis.register_script(RENEW_LEASE_SCRIPT)
+        self._release_lease = self.redis.register_script(RELEASE_LEASE_SCRIPT)
+        self._task_script = self.redis.register_script(TASK_SCRIPT)
+        self._advance_script = self.redis.register_script(ADVANCE_TASK_SCRIPT)
+        self._metrics_script = self.redis.register_script(METRICS_SCRIPT)
+        logging.warning(f"[ENGINE] Started as {self.owner}.")
+        await asyncio.gather(
+            self._listen(), self._resync_timer(), self._dispatch(), self._run_schedule(), self._heartbeat(),
+        )
+
+    async def _listen(self):
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(ENGINE_CHANNEL)
+        async for message in pubsub.listen():
+            if message["type"] != "message":
+                continue
+            try:
+                event = json.loads(message["data"])
+            except ValueError:
+                logging.warning(f"[ENGINE] Malformed notification: {message['data']}")
+                continue
+            if event.get("event") == "schedule":
+                self._schedule_changed.set()
+            else:
+                await self._events.put(event)
+
+    async def _resync_timer(self):
+        while True:
+            await asyncio.sleep(self.resync_interval)
+            await self._events.put({"event": "resync"})
+
+    async def _heartbeat(self):
+        """Продлевает аренду всех ведомых смен; смены с потерянной арендой отпускаются."""
+        while True:
+            await asyncio.sleep(self.lease_ms / 3000)
+            await self._renew_leases()
+
+    async def _renew_leases(self):
+        shift_ids = list(self.shifts)
+        if not shift_ids:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shift_id in shift_ids:
+                await self._renew_lease(keys=[lease_key(shift_id)], args=[self.owner, self.lease_ms], client=pipe)
+            renewed = await pipe.execute()
+        for shift_id, ok in zip(shift_ids, renewed):
+            if not ok and shift_id in self.shifts:
+                logging.warning(f"[SHIFT {shift_id}] Lease lost, detaching.")
+                self.shifts.pop(shift_id).generation += 1
+
+    async def _acquire_lease(self, shift_id):
+        if await self.redis.set(lease_key(shift_id), self.owner, nx=True, px=self.lease_ms):
+            return True
+        # Аренда уже наша (например, после отсоединения без освобождения)
+        return bool(await self._renew_lease(keys=[lease_key(shift_id)], args=[self.owner, self.lease_ms]))
+
+    async def _detach(self, state):
+        self.shifts.pop(state.shift_id, None)
+        state.generation += 1
+        await self._release_lease(keys=[lease_key(state.shift_id)], args=[self.owner])
+
+    async def _run_schedule(self):
+        """
+        Автозапуск смен точно в planned_start_time. Движок спит до старта
+        ближайшей смены из очереди shifts:schedule и просыпается раньше,
+        если очередь изменилась. Смену забирает тот, чей ZREM удался.
+        """
+        while True:
+            self._schedule_changed.clear()
+            head = await self.redis.zrange(SHIFT_SCHEDULE_KEY, 0, 0, withscores=True)
+            timeout = None
+            if head:
+                shift_id, start_at = head[0]
+                timeout = start_at - time.time()
+                if timeout <= 0:
+                    if await self.redis.zrem(SHIFT_SCHEDULE_KEY, shift_id):
+                        await self._guard(shift_id, self._start_planned(int(shift_id)))
+                    continue
+            try:
+                await asyncio.wait_for(self._schedule_changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _start_planned(self, shift_id):
+        logging.warning(f"[SHIFT {shift_id}] Planned start time reached.")
+        if await sync_to_async(start_planned_shift)(shift_id):
+            # Завершённые при запуске смены отсоединяются, новая подключается
+            await self._events.put({"event": "resync"})
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            timeout = None
+            if self._deadlines:
+                timeout = max(0, self._deadlines[0][0] - loop.time())
+            try:
+                event = await asyncio.wait_for(self._events.get(), timeout)
+            except asyncio.TimeoutError:
+                event = None
+
+            if event:
+                await self._guard(event.get("shift_id"), self._handle_event(event))
+
+            while self._deadlines and self._deadlines[0][0] <= loop.time():
+                _, _, shift_id, generation = heapq.heappop(self._deadlines)
+                state = self.shifts.get(shift_id)
+                if state and state.generation == generation:
+                    await self._guard(shift_id, self._on_deadline(state))
+
+    async def _guard(self, shift_id, coro):
+        try:
+            await coro
+        except Exception as e:
+            logging.error(f"[SHIFT {shift_id}] Engine error: {str(e)}")
+            logging.error(traceback.format_exc())
+
+    def _schedule(self, state, delay):
+        state.generation += 1
+        deadline = asyncio.get_running_loop().time() + delay
+        heapq.heappush(self._deadlines, (deadline, next(self._sequence), state.shift_id, state.generation))
+
+    async def _handle_event(self, event):
+        kind = event.get("event")
+        if kind == "resync":
+            await self._resync()
+            return
+
+        shift_id = int(event["shift_id"])
+        state = self.shifts.get(shift_id)
+        if kind == "start" and state is None:
+            await self._attach(shift_id)
+        elif kind == "active_task":
+            if state is None:
+                await self._attach(shift_id)
+            else:
+                index = int(await self.redis.hget(state.shift_key, "active_task") or 0)
+                await self._switch_task(state, index)
+        elif kind == "pause" and state is not None and state.task_id is not None:
+            await self._toggle_pause(state)
+        elif kind == "alert" and state is not None:
+            await self._send_alert(shift_id, event.get("task_id"), event.get("data") or {})
+        elif kind == "task_update" and state is not None:
+            await self._send_task_update(shift_id, event.get("task_id"), event.get("data") or {})
+
+    async def _resync(self):
+        active_ids = set(await sync_to_async(list)(
+            Shift.objects.filter(status=Shift.Status.ACTIVE).values_list("id", flat=True)
+        ))
+
+        # Смены, завершённые в обход движка (например, end_active_shifts)
+        for shift_id in list(self.shifts):
+            if shift_id not in active_ids:
+                logging.warning(f"[SHIFT {shift_id}] No longer active, detaching.")
+                await self._detach(self.shifts[shift_id])
+
+        for shift_id in active_ids - set(self.shifts):
+            await self._guard(shift_id, self._attach(shift_id))
+
+        states = list(self.shifts.values())
+        if not states:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for state in states:
+                pipe.hget(state.shift_key, "active_task")
+            indexes = await pipe.execute()
+        for state, index in zip(states, indexes):
+            index = int(index or 0)
+            if index != state.active_index:
+                await self._guard(state.shift_id, self._switch_task(state, index))
+        await self._refresh_metrics()
+
+    async def _refresh_metrics(self):
+        """
+        Пересчитывает показатели активных заданий по таймеру сверки: без
+        событий упаковки темп падает, и остановившаяся линия тоже должна
+        получить behind_norm.
+        """
+        states = [state for state in self.shifts.values() if state.task and state.task.get("type") == "TASK"]
+        if not states:
+            return
+        now = timezone.now()
+        window = window_minutes(now)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for state in states:
+                pipe.hgetall(state.task_key)
+                pipe.hmget(throughput_key("task", state.task_id), window)
+            results = await pipe.execute()
+
+        for index, state in enumerate(states):
+            task_data, window_counts = results[2 * index], results[2 * index + 1]
+            metrics = task_metrics(task_data, window_counts, now)
+            if not metrics or all(str(value) == task_data.get(field) for field, value in metrics.items()):
+                continue
+            written = await self._metrics_script(
+                keys=[state.task_key], args=metrics_args(task_data.get("ready_value"), metrics)
+            )
+            if not written[0]:
+                # Пришла упаковка – её вызов уже записал свежие показатели
+                continue
+            await self._send_task_update(state.shift_id, state.task_id, client_metrics(metrics))
+            if str(metrics["behind_norm"]) != written[1]:
+                await self._send_alert(state.shift_id, state.task_id, alert_data(metrics))
+
+    async def _attach(self, shift_id):
+        if not await self._acquire_lease(shift_id):
+            logging.info(f"[SHIFT {shift_id}] Led by another engine.")
+            return
+
+        task_ids = await self.redis.lrange(f"shift:{shift_id}:tasks", 0, -1)
+        if not task_ids and await sync_to_async(restore_shift_state)(shift_id):
+            # Ключи смены потеряны (вытеснение, перезапуск Redis) – восстановили из БД
+            task_ids = await self.redis.lrange(f"shift:{shift_id}:tasks", 0, -1)
+        if not task_ids:
+            logging.error(f"[SHIFT {shift_id}] No tasks found!")
+            await self._release_lease(keys=[lease_key(shift_id)], args=[self.owner])
+            return
+
+        logging.warning(f"[SHIFT {shift_id}] Attached to engine.")
+        state = ShiftState(shift_id, task_ids)
+        self.shifts[shift_id] = state
+        index, line = await self.redis.hmget(state.shift_key, ["active_task", "line"])
+        await self._switch_task(state, int(index or 0))
+        if line and state.shift_id in self.shifts:
+            # Клиенты линии, досмотревшие прошлую смену, переключаются на эту
+            await self.broadcaster.announce(line, {
+                "type": "line.update",
+                "event": "shift_started",
+                "data": {"shift_id": shift_id},
+            })
+
+    async def _switch_task(self, state, index):
+        if state.task_id is not None and index == state.active_index:
+            return
+        if state.task_id is not None and not await self._finish_task(state):
+            return
+
+        task_data = None
+        while index < len(state.task_ids):
+            task_data = await self._load_task(f"task:{state.task_ids[index]}")
+            if task_data:
+                break
+            logging.warning(f"[SHIFT {state.shift_id}] Task {state.task_ids[index]} not found in Redis. Skipping.")
+            # Если смену уже переключили, продолжаем с индекса из Redis
+            advanced, current = await self._advance(state, index)
+            if not advanced and current == index:
+                # Список заданий смены пропал из Redis – смену завершили в обход движка
+                await self._detach_finished(state)
+                return
+            index = current
+
+        state.active_index = index
+        if index >= len(state.task_ids):
+            await self._complete(state)
+            return
+
+        state.task_id = state.task_ids[index]
+        state.task = task_data
+        await self._start_task(state)
+
+    async def _start_task(self, state):
+        if not state.task.get("started_at"):
+            now = timezone.now()
+            await self._hset(state.task_key, "started_at", to_epoch(now))
+            state.task["started_at"] = str(to_epoch(now))
+            logging.info(f"[TASK {state.task_id}] Started at {now.isoformat()}")
+
+        info = await sync_to_async(shift_info)(state.shift_id)
+        await self._send(state.shift_id, {
+            "type": "shift.update",
+            "event": "new_task",
+            "data": {
+                "shift": info,
+                "task": with_timers(state.task),
+            },
+        })
+        logging.warning(
+            f"[SHIFT {state.shift_id}] Processing task index: {state.active_index} "
+            f"(Task ID: {state.task_id}, Type: {state.task.get('type')})")
+        self._schedule_break_end(state)
+
+    async def _toggle_pause(self, state):
+        state.task = await self._load_task(state.task_key)
+        event = "pause" if state.task.get("paused_at") else "resume"
+        logging.info(f"[TASK {state.task_id}] {event}")
+        await self._send(state.shift_id, {
+            "type": "task.update",
+            "event": event,
+            "task_id": state.task_id,
+            "data": with_timers(state.task),
+        })
+        self._schedule_break_end(state)
+
+    def _schedule_break_end(self, state):
+        """Ставит дедлайн окончания перерыва; на паузе дедлайн снимается."""
+        if state.task.get("type") != "BREAK" or state.task.get("paused_at"):
+            state.generation += 1
+            return
+        self._schedule(state, remaining_seconds(state.task))
+
+    async def _finish_task(self, state):
+        """
+        Отмечает задание завершённым и рассылает его. False, если хэша задания
+        уже нет: смену завершили в обход движка, и она отсоединяется – запись
+        finished_at создала бы в Redis осиротевший хэш.
+        """
+        # Счётчики в state.task остались со старта задания – перечитываем хэш перед рассылкой
+        task = await self._load_task(state.task_key)
+        if not task:
+            await self._detach_finished(state)
+            return False
+        state.task = task
+        if not state.task.get("finished_at"):
+            finish_time = to_epoch(timezone.now())
+            await self._hset(state.task_key, "finished_at", finish_time)
+            state.task["finished_at"] = str(finish_time)
+        logging.info(f"[TASK {state.task_id}] Marked as finished.")
+        await self._send(state.shift_id, {
+            "type": "task.update",
+            "event": "finish",
+            "task_id": state.task_id,
+            "data": with_timers(state.task),
+        })
+        state.task_id = None
+        state.task = None
+        return True
+
+    async def _detach_finished(self, state):
+        logging.warning(f"[SHIFT {state.shift_id}] Live state is gone, detaching.")
+        await self._detach(state)
+
+    async def _on_deadline(self, state):
+        state.task = await self._load_task(state.task_key)
+        if (remaining_seconds(state.task) or 0) > 0:
+            # Перерыв продлён паузой – ждём нового дедлайна
+            self._schedule_break_end(state)
+            return
+
+        # Время перерыва истекло – переходим к следующему заданию
+        logging.info(f"[TASK {state.task_id}] BREAK finished. Finishing task.")
+        expected = state.active_index
+        if not await self._finish_task(state):
+            return
+        # Смену могли переключить вручную, пока истекал перерыв – тогда идём за Redis
+        _, index = await self._advance(state, expected)
+        await self._switch_task(state, index)
+
+    async def _complete(self, state):
+        self.shifts.pop(state.shift_id, None)
+        state.generation += 1
+        logging.warning(f"[SHIFT {state.shift_id}] Marking shift as completed in database.")
+        await sync_to_async(finalize_shifts)([state.shift_id])
+        await self._release_lease(keys=[lease_key(state.shift_id)], args=[self.owner])
+        await self._send(state.shift_id, {
+            "type": "shift.update",
+            "event": "completed",
+            "data": {"shift_id": state.shift_id},
+        })
+        logging.warning(f"[SHIFT {state.shift_id}] Completed successfully.")
+
+    async def _advance(self, state, expected):
+        """
+        Переводит смену с задания expected на следующее через тот же CAS, что
+        и ручное переключение. Возвращает (успех, индекс); при неудаче индекс –
+        текущий active_task в Redis.
+        """
+        advanced, index = await self._advance_script(
+            keys=[state.shift_key, f"shift:{state.shift_id}:tasks", CHECKPOINT_DIRTY_KEY],
+            args=[expected, ENGINE_CHANNEL, json.dumps({"event": "active_task", "shift_id": state.shift_id})],
+        )
+        if not advanced:
+            logging.warning(f"[SHIFT {state.shift_id}] Task {expected} is no longer active, "
+                            f"following Redis to task {index}.")
+        return bool(advanced), int(index)
+
+    async def _load_task(self, key):
+        """Хэш задания с названиями продукта и упаковки из справочников."""
+        return to_dict(await self._task_script(keys=[key]))
+
+    async def _hset(self, key, field, value):
+        """Записывает поле и отмечает ключ для ближайшей контрольной точки."""
+        async with self.redis.pipeline() as pipe:
+            pipe.hset(key, field, value)
+            pipe.sadd(CHECKPOINT_DIRTY_KEY, key)
+            await pipe.execute()
+
+    async def _send_task_update(self, shift_id, task_id, data):
+        await self._send(shift_id, {
+            "type": "task.update",
+            "event": "update",
+            "task_id": task_id,
+            "data": data,
+        })
+
+    async def _send_alert(self, shift_id, task_id, data):
+        # Линия отстала от нормы или догнала её
+        await self._send(shift_id, {
+            "type": "shift.update",
+            "event": "behind_norm",
+            "data": {"task_id": task_id, **data},
+        })
+
+    async def _send(self, shift_id, message):
+        await self.broadcaster.publish(shift_id, message)
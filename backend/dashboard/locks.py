@@ -0,0 +1,74 @@
+"""
+Блокировка переходов смен (запуск, завершение).
+
+Запуск смены завершает активные, а завершение может прийти одновременно
+от движка, сверки check_and_start_shifts и другого воркера. Все переходы
+выполняются под одной блокировкой в Redis; внутри одного потока она
+повторно входима, поэтому start_planned_shift может вызвать
+finalize_shifts, не блокируя сам себя.
+
+Запись буфера packing:events в PackingLog идёт под своей блокировкой:
+отсев повторов по sid (проверка, затем вставка) верен, только пока пачки
+пишутся по одной.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from redis.exceptions import LockError
+
+from dashboard.repos.connection import get_redis
+
+LIFECYCLE_LOCK_KEY = "lock:shift_lifecycle"
+PACKING_FLUSH_LOCK_KEY = "lock:packing_flush"
+
+_local = threading.local()
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class ShiftLockTimeout(LockTimeout):
+    pass
+
+
+@contextmanager
+def shift_lifecycle_lock():
+    if getattr(_local, "depth", 0):
+        _local.depth += 1
+        try:
+            yield
+        finally:
+            _local.depth -= 1
+        return
+
+    timeout = settings.SHIFT_ENGINE["LOCK_TIMEOUT"]
+    lock = get_redis().lock(LIFECYCLE_LOCK_KEY, timeout=timeout, blocking_timeout=timeout)
+    if not lock.acquire():
+        raise ShiftLockTimeout(f"Could not acquire {LIFECYCLE_LOCK_KEY} in {timeout}s")
+    _local.depth = 1
+    try:
+        yield
+    finally:
+        _local.depth = 0
+        try:
+            lock.release()
+        except LockError:
+            logging.warning(f"{LIFECYCLE_LOCK_KEY} expired before release")
+
+
+@contextmanager
+def packing_flush_lock():
+    timeout = settings.PACKING_WRITE_BEHIND["LOCK_TIMEOUT"]
+    lock = get_redis().lock(PACKING_FLUSH_LOCK_KEY, timeout=timeout, blocking_timeout=timeout)
+    if not lock.acquire():
+        raise LockTimeout(f"Could not acquire {PACKING_FLUSH_LOCK_KEY} in {timeout}s")
+    try:
+        yield
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            logging.warning(f"{PACKING_FLUSH_LOCK_KEY} expired before release")
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from dashboard.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = "Пересобирает сводные таблицы статистики (ShiftSummary, MasterStatistics) из ShiftTask и PackingLog"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Сколько смен обрабатывать за раз")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            shifts, periods = rebuild_rollups(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {shifts} shift summaries and {periods} master periods."))
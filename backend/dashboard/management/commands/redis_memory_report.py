@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from dashboard.repos.redis_repository import PACKING_LOOKUP_KEY, PRODUCT_LOOKUP_KEY, RedisRepository
+
+
+class Command(BaseCommand):
+    help = "Показывает, сколько памяти Redis занимает живое состояние каждой смены вместе с её заданиями"
+
+    def handle(self, *args, **options):
+        redis = RedisRepository()
+        live = redis.live_keys()
+        owners = redis.task_shift_ids(live["task"])
+
+        shift_keys = {shift_id: list(keys) for shift_id, keys in live["shift"].items()}
+        task_counts = {}
+        for task_id, keys in live["task"].items():
+            # Задания без хэша или с потерянной сменой учитываются в строке "orphaned"
+            shift_keys.setdefault(owners[task_id], []).extend(keys)
+            task_counts[owners[task_id]] = task_counts.get(owners[task_id], 0) + 1
+
+        usage = redis.memory_usage(
+            [key for keys in shift_keys.values() for key in keys] + [PRODUCT_LOOKUP_KEY, PACKING_LOOKUP_KEY]
+        )
+        self.stdout.write(f"{'shift':>10} {'tasks':>6} {'keys':>6} {'bytes':>10}")
+        total = 0
+        for shift_id in sorted(shift_keys, key=lambda value: (value is None, value or 0)):
+            keys = shift_keys[shift_id]
+            size = sum(usage[key] for key in keys)
+            total += size
+            label = shift_id if shift_id is not None else "orphaned"
+            self.stdout.write(f"{label:>10} {task_counts.get(shift_id, 0):>6} {len(keys):>6} {size:>10}")
+
+        lookups = usage[PRODUCT_LOOKUP_KEY] + usage[PACKING_LOOKUP_KEY]
+        info = redis.memory_info()
+        self.stdout.write(f"Lookup hashes: {lookups} bytes")
+        self.stdout.write(self.style.SUCCESS(
+            f"Live state: {total + lookups} bytes; Redis used {info.get('used_memory_human')}"
+            f" of maxmemory {info.get('maxmemory_human') or 'unlimited'}."
+        ))
@@ -0,0 +1,16 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from dashboard.engine import ShiftEngine
+
+
+class Command(BaseCommand):
+    help = "Запускает движок, который ведёт все активные смены в одном процессе"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resync', type=float, help="Интервал сверки с БД в секундах")
+
+    def handle(self, *args, **options):
+        engine = ShiftEngine(resync_interval=options['resync'])
+        asyncio.run(engine.run())
@@ -0,0 +1,82 @@
+"""
+Живые показатели выполнения задания.
+
+Пересчитываются при каждом событии упаковки (RedisRepository.add_packed_units)
+и по таймеру движка на сверке (ShiftEngine._refresh_metrics) – иначе
+остановившаяся линия никогда не отстала бы от нормы. Хранятся в хэше задания
+рядом с ready_value и записываются скриптом METRICS_SCRIPT только для того
+ready_value, по которому посчитаны. Поэтому попадают и в снимок смены, и
+в дельты WebSocket, а клиентам не нужно считать их самим:
+- rate – штук в минуту за последние WINDOW_MINUTES минут;
+- efficiency – выработка в процентах от нормы за время выполнения;
+- norm_deficit – сколько штук не хватает до нормы (отрицательное – опережение);
+- percent_of_target – выполнение плана задания в процентах;
+- projected_finish – ожидаемое время выполнения плана при текущем темпе
+  (секунды от эпохи, клиентам – ISO 8601);
+- behind_norm – 1, если линия отстаёт от нормы больше допустимого.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from dashboard.timers import elapsed_seconds, parse_time, to_epoch
+
+METRIC_FIELDS = ["rate", "efficiency", "norm_deficit", "percent_of_target", "projected_finish", "behind_norm"]
+
+
+def window_minutes(now=None):
+    """Номера минут скользящего окна (см. minute_bucket), последняя – текущая."""
+    current = int((now or timezone.now()).timestamp() // 60)
+    size = settings.SHIFT_METRICS["WINDOW_MINUTES"]
+    return list(range(current - size + 1, current + 1))
+
+
+def task_metrics(task_data, window_counts, now=None):
+    """
+    Показатели задания по его хэшу и счётчикам упаковки за окно.
+    Для перерывов и ещё не начатых заданий возвращает пустой словарь.
+    """
+    if task_data.get("type") != "TASK" or not task_data.get("started_at"):
+        return {}
+    now = now or timezone.now()
+    ready = int(task_data.get("ready_value") or 0)
+    target = int(task_data.get("target") or 0)
+    norm = float(task_data.get("norm_in_minute") or 0)
+    elapsed_minutes = elapsed_seconds(task_data, now) / 60
+
+    window = min(settings.SHIFT_METRICS["WINDOW_MINUTES"], max(elapsed_minutes, 1))
+    rate = sum(int(count or 0) for count in window_counts) / window
+    expected = norm * elapsed_minutes
+
+    metrics = {
+        "rate": round(rate, 2),
+        "efficiency": round(ready / expected * 100, 1) if expected else 0,
+        "norm_deficit": round(expected - ready, 1),
+        "percent_of_target": round(ready / target * 100, 1) if target else 0,
+        "projected_finish": "",
+        "behind_norm": 0,
+    }
+    if target and ready < target and rate:
+        metrics["projected_finish"] = to_epoch(now + timedelta(minutes=(target - ready) / rate))
+    # Первые минуты задания не оцениваются: темп ещё не установился
+    if expected and elapsed_minutes >= settings.SHIFT_METRICS["WINDOW_MINUTES"]:
+        metrics["behind_norm"] = int(metrics["efficiency"] < settings.SHIFT_METRICS["BEHIND_NORM_PERCENT"])
+    return metrics
+
+
+def client_metrics(metrics):
+    """Показатели для клиентов: projected_finish в ISO 8601."""
+    metrics = dict(metrics)
+    if metrics.get("projected_finish"):
+        metrics["projected_finish"] = parse_time(metrics["projected_finish"]).isoformat()
+    return metrics
+
+
+def alert_data(metrics):
+    """Данные уведомления behind_norm: линия отстала от нормы или догнала её."""
+    return {
+        "behind_norm": bool(metrics["behind_norm"]),
+        "efficiency": metrics["efficiency"],
+        "norm_deficit": metrics["norm_deficit"],
+    }
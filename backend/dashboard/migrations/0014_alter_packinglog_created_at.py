@@ -0,0 +1,16 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('dashboard', '0013_add_norm_in_minute'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='packinglog',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
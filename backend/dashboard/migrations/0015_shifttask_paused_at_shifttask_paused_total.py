@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('dashboard', '0014_alter_packinglog_created_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shifttask',
+            name='paused_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='shifttask',
+            name='paused_total',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,88 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def names_to_masters(apps, schema_editor):
+    """Мастер смены раньше хранился строкой Shift.name – переносим её в справочник Master."""
+    Master = apps.get_model('dashboard', 'Master')
+    Shift = apps.get_model('dashboard', 'Shift')
+    masters = {}
+    for shift in Shift.objects.all().only('id', 'name'):
+        name = (shift.name or '').strip() or '—'
+        if name not in masters:
+            masters[name] = Master.objects.create(name=name)
+        shift.master = masters[name]
+        shift.save(update_fields=['master'])
+
+
+def masters_to_names(apps, schema_editor):
+    Shift = apps.get_model('dashboard', 'Shift')
+    for shift in Shift.objects.select_related('master'):
+        shift.name = shift.master.name if shift.master else ''
+        shift.save(update_fields=['name'])
+
+
+class Migration(migrations.Migration):
+    """Приводит схему к моделям: Master, Shift.master и Shift.planned_start_time не были описаны в миграциях."""
+
+    dependencies = [
+        ('dashboard', '0015_shifttask_paused_at_shifttask_paused_total'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Master',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=120)),
+                ('is_active', models.BooleanField(default=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Мастера',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AddField(
+            model_name='shift',
+            name='master',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT,
+                                    related_name='shifts', to='dashboard.master'),
+        ),
+        migrations.AlterField(
+            model_name='shift',
+            name='name',
+            field=models.CharField(blank=True, default='', max_length=120),
+        ),
+        migrations.RunPython(names_to_masters, masters_to_names),
+        migrations.AlterField(
+            model_name='shift',
+            name='master',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT,
+                                    related_name='shifts', to='dashboard.master'),
+        ),
+        migrations.RemoveField(
+            model_name='shift',
+            name='name',
+        ),
+        migrations.AddField(
+            model_name='shift',
+            name='planned_start_time',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='shift',
+            name='start_time',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='shift',
+            name='status',
+            field=models.CharField(choices=[('PLANNED', 'Planed'), ('ACTIVE', 'Active'), ('COMPLETED', 'Completed'),
+                                            ('CANCELLED', 'Cancelled')], default='PLANNED', max_length=120),
+        ),
+        migrations.AlterField(
+            model_name='shifttask',
+            name='percent_from_shift',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
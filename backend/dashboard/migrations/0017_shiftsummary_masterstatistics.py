@@ -0,0 +1,133 @@
+from collections import defaultdict
+from datetime import timedelta
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+from django.utils import timezone
+
+STATISTICS_FIELDS = ["shifts_count", "completion_sum", "units_packed", "tasks_count", "run_seconds", "break_seconds"]
+
+
+def build_statistics_history(apps, schema_editor, batch_size=500):
+    """
+    Заполняет сводки по уже завершённым сменам, иначе /api/statistics/ покажет
+    пустую историю. Повторяет dashboard.rollups.rebuild_rollups на исторических
+    моделях; позже то же делает команда rebuild_statistics.
+    """
+    Shift = apps.get_model('dashboard', 'Shift')
+    ShiftTask = apps.get_model('dashboard', 'ShiftTask')
+    PackingLog = apps.get_model('dashboard', 'PackingLog')
+    ShiftSummary = apps.get_model('dashboard', 'ShiftSummary')
+    MasterStatistics = apps.get_model('dashboard', 'MasterStatistics')
+
+    shift_ids = list(Shift.objects.filter(status='COMPLETED').order_by('id').values_list('id', flat=True))
+    totals = defaultdict(lambda: dict.fromkeys(STATISTICS_FIELDS, 0))
+    for offset in range(0, len(shift_ids), batch_size):
+        batch = shift_ids[offset:offset + batch_size]
+        tasks = defaultdict(list)
+        for task in ShiftTask.objects.filter(shift_id__in=batch).select_related('product').order_by('order', 'id'):
+            tasks[task.shift_id].append(task)
+        units = dict(PackingLog.objects.filter(shift_id__in=batch).values_list('shift').annotate(units=Count('id')))
+
+        summaries = []
+        for shift in Shift.objects.filter(id__in=batch):
+            work = [task for task in tasks[shift.id] if task.type == 'TASK']
+            breaks = [task for task in tasks[shift.id] if task.type == 'BREAK']
+            completions = [task.ready_value * 100.0 / task.target for task in work if task.target and task.ready_value]
+            summary = ShiftSummary(
+                shift_id=shift.id,
+                master_id=shift.master_id,
+                start_time=shift.start_time,
+                end_time=shift.end_time,
+                avg_completion=sum(completions) / len(completions) if completions else 0.0,
+                units_packed=units.get(shift.id, 0),
+                tasks_count=len(work),
+                run_seconds=sum(task.time_spent or 0 for task in work),
+                break_seconds=sum(task.time_spent or 0 for task in breaks),
+                tasks_details=[
+                    {
+                        'product_name': task.product.name if task.product else None,
+                        'target': task.target,
+                        'completed': task.ready_value,
+                        'completion_percent': round((task.ready_value / task.target * 100),
+                                                    2) if task.target and task.ready_value else 0
+                    }
+                    for task in work
+                ],
+            )
+            summaries.append(summary)
+            if not summary.start_time:
+                continue
+            day = timezone.localdate(summary.start_time)
+            for period, start in (('DAY', day), ('WEEK', day - timedelta(days=day.weekday())),
+                                  ('MONTH', day.replace(day=1))):
+                total = totals[(summary.master_id, period, start)]
+                total["shifts_count"] += 1
+                total["completion_sum"] += summary.avg_completion
+                total["units_packed"] += summary.units_packed
+                total["tasks_count"] += summary.tasks_count
+                total["run_seconds"] += summary.run_seconds
+                total["break_seconds"] += summary.break_seconds
+        ShiftSummary.objects.bulk_create(summaries)
+
+    MasterStatistics.objects.bulk_create(
+        [
+            MasterStatistics(master_id=master_id, period=period, period_start=start, **total)
+            for (master_id, period, start), total in totals.items()
+        ],
+        batch_size=batch_size,
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('dashboard', '0016_master_shift_planned_start_time'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShiftSummary',
+            fields=[
+                ('shift', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True,
+                                               related_name='summary', serialize=False, to='dashboard.shift')),
+                ('start_time', models.DateTimeField(blank=True, null=True)),
+                ('end_time', models.DateTimeField(blank=True, null=True)),
+                ('avg_completion', models.FloatField(default=0)),
+                ('units_packed', models.PositiveIntegerField(default=0)),
+                ('tasks_count', models.PositiveIntegerField(default=0)),
+                ('run_seconds', models.PositiveBigIntegerField(default=0)),
+                ('break_seconds', models.PositiveBigIntegerField(default=0)),
+                ('tasks_details', models.JSONField(default=list)),
+                ('master', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                             related_name='shift_summaries', to='dashboard.master')),
+            ],
+            options={
+                'ordering': ['-start_time'],
+                'indexes': [models.Index(fields=['master', 'start_time'], name='shiftsummary_master_start_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='MasterStatistics',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('DAY', 'Day'), ('WEEK', 'Week'), ('MONTH', 'Month')],
+                                            max_length=10)),
+                ('period_start', models.DateField()),
+                ('shifts_count', models.PositiveIntegerField(default=0)),
+                ('completion_sum', models.FloatField(default=0)),
+                ('units_packed', models.PositiveIntegerField(default=0)),
+                ('tasks_count', models.PositiveIntegerField(default=0)),
+                ('run_seconds', models.PositiveBigIntegerField(default=0)),
+                ('break_seconds', models.PositiveBigIntegerField(default=0)),
+                ('master', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                             related_name='statistics', to='dashboard.master')),
+            ],
+            options={
+                'verbose_name_plural': 'Master statistics',
+                'constraints': [models.UniqueConstraint(fields=('master', 'period', 'period_start'),
+                                                        name='unique_master_period')],
+            },
+        ),
+        migrations.RunPython(build_statistics_history, migrations.RunPython.noop),
+    ]
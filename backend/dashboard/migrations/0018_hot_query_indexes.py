@@ -0,0 +1,35 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('dashboard', '0017_shiftsummary_masterstatistics'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='shift',
+            index=models.Index(fields=['status', 'start_time'], name='shift_status_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shift',
+            index=models.Index(condition=models.Q(('status', 'PLANNED')), fields=['status', 'planned_start_time'],
+                               name='shift_planned_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shifttask',
+            index=models.Index(fields=['shift', 'type', 'order'], name='shifttask_shift_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='packinglog',
+            index=models.Index(fields=['shift', 'created_at'], name='packinglog_shift_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='packinglog',
+            index=models.Index(fields=['task', 'created_at'], name='packinglog_task_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='packinglog',
+            index=models.Index(fields=['shift', 'sid'], name='packinglog_shift_sid_idx'),
+        ),
+    ]
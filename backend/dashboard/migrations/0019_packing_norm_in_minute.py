@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+def fill_norm_in_minute(apps, schema_editor):
+    DefaultSettings = apps.get_model('dashboard', 'DefaultSettings')
+    Packing = apps.get_model('dashboard', 'Packing')
+    row = DefaultSettings.objects.order_by('id').first()
+    duration = row.shift_duration_in_minute if row else 480
+    if duration:
+        Packing.objects.update(norm_in_minute=models.F('norm') * 1.0 / duration)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('dashboard', '0018_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='packing',
+            name='norm_in_minute',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_norm_in_minute, migrations.RunPython.noop),
+    ]
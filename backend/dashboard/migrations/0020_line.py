@@ -0,0 +1,51 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+import dashboard.models
+
+
+def create_default_line(apps, schema_editor):
+    Line = apps.get_model('dashboard', 'Line')
+    Shift = apps.get_model('dashboard', 'Shift')
+    line, _ = Line.objects.get_or_create(code='main', defaults={'name': 'Основная линия'})
+    Shift.objects.filter(line__isnull=True).update(line=line)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('dashboard', '0019_packing_norm_in_minute'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Line',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.SlugField(unique=True)),
+                ('name', models.CharField(max_length=120)),
+                ('is_active', models.BooleanField(default=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Линии',
+                'ordering': ['code'],
+            },
+        ),
+        migrations.AddField(
+            model_name='shift',
+            name='line',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT,
+                                    related_name='shifts', to='dashboard.line'),
+        ),
+        migrations.RunPython(create_default_line, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='shift',
+            name='line',
+            field=models.ForeignKey(default=dashboard.models.default_line_id,
+                                    on_delete=django.db.models.deletion.PROTECT,
+                                    related_name='shifts', to='dashboard.line'),
+        ),
+        migrations.AddIndex(
+            model_name='shift',
+            index=models.Index(fields=['line', 'status', 'start_time'], name='shift_line_status_start_idx'),
+        ),
+    ]
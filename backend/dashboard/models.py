@@ -1,16 +1,15 @@
 import logging
+import time
 
-import redis
-from django.conf import settings
 from django.contrib.auth.models import User
 from django.db import models
 from django.utils import timezone
 
 
 class ShiftManager(models.Manager):
-    def get_active_shift(self):
+    def get_active_shift(self, line=None):
         return self.filter(
-            status=Shift.Status.ACTIVE
+            status=Shift.Status.ACTIVE, line__code=line or Line.DEFAULT_CODE
         ).order_by('-start_time').first()
 
 
@@ -28,9 +27,24 @@ class Master(models.Model):
 class DefaultSettings(models.Model):
     shift_duration_in_minute = models.IntegerField(default=480) # 8 часов
 
-    @staticmethod
-    def get_shift_duration_in_minute():
-        return DefaultSettings.objects.first().shift_duration_in_minute if DefaultSettings.objects.exists() else 480
+    # Настройки читаются из БД один раз на процесс; сигналы (dashboard.signals) сбрасывают
+    # кэш при сохранении, а в других процессах он обновится не позже чем через CACHE_TTL секунд
+    CACHE_TTL = 60
+    _cache = {"expires": 0, "shift_duration_in_minute": 480}
+
+    @classmethod
+    def get_shift_duration_in_minute(cls):
+        if cls._cache["expires"] <= time.monotonic():
+            row = cls.objects.order_by('id').values('shift_duration_in_minute').first()
+            cls._cache.update(
+                shift_duration_in_minute=row['shift_duration_in_minute'] if row else 480,
+                expires=time.monotonic() + cls.CACHE_TTL,
+            )
+        return cls._cache["shift_duration_in_minute"]
+
+    @classmethod
+    def invalidate_cache(cls):
+        cls._cache["expires"] = 0
 
 class Product(models.Model):
     name = models.CharField(max_length=100)
@@ -42,12 +56,30 @@ class Product(models.Model):
 class Packing(models.Model):
     value = models.FloatField()
     norm = models.PositiveIntegerField()
+    # Норма за минуту хранится, а не вычисляется при чтении; пересчитывается
+    # при сохранении упаковки и при изменении DefaultSettings
+    norm_in_minute = models.FloatField(default=0, editable=False)
 
     def __str__(self):
         return str(self.value)
 
-    def norm_in_minute(self):
-        return self.norm / DefaultSettings.get_shift_duration_in_minute()
+    @staticmethod
+    def compute_norm_in_minute(norm):
+        duration = DefaultSettings.get_shift_duration_in_minute()
+        return norm / duration if duration else 0
+
+    def save(self, *args, **kwargs):
+        self.norm_in_minute = self.compute_norm_in_minute(self.norm)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'norm' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'norm_in_minute'}
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def recompute_norms(cls):
+        """Пересчитывает нормы всех упаковок одним UPDATE (после изменения длительности смены)."""
+        duration = DefaultSettings.get_shift_duration_in_minute()
+        cls.objects.update(norm_in_minute=models.F('norm') * 1.0 / duration if duration else 0)
 
 class ProductPacking(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
@@ -58,6 +90,42 @@ class ProductPacking(models.Model):
 
 
 
+class Line(models.Model):
+    """
+    Линия фасовки. На каждой линии своя активная смена, свои веб-сокеты
+    (ws/shifts/<code>/) и свои сканеры, поэтому линии работают параллельно.
+    """
+    DEFAULT_CODE = 'main'
+    # pk основной линии: default_id вызывается при каждом создании Shift()
+    _cache = {"default_id": None}
+
+    code = models.SlugField(max_length=50, unique=True)
+    name = models.CharField(max_length=120)
+    is_active = models.BooleanField(default=True)
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        verbose_name_plural = "Линии"
+        ordering = ['code']
+
+    @classmethod
+    def default_id(cls):
+        if cls._cache["default_id"] is None:
+            line, _ = cls.objects.get_or_create(code=cls.DEFAULT_CODE, defaults={'name': 'Основная линия'})
+            cls._cache["default_id"] = line.id
+        return cls._cache["default_id"]
+
+    @classmethod
+    def invalidate_cache(cls):
+        cls._cache["default_id"] = None
+
+
+def default_line_id():
+    return Line.default_id()
+
+
 class Shift(models.Model):
     class Status(models.TextChoices):
         PLANNED = 'PLANNED', 'Planed'
@@ -69,6 +137,7 @@ class Shift(models.Model):
     user_ends = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='shift_ends')
 
     master = models.ForeignKey(Master, on_delete=models.PROTECT, related_name='shifts')
+    line = models.ForeignKey(Line, on_delete=models.PROTECT, related_name='shifts', default=default_line_id)
 
     planned_start_time = models.DateTimeField(null=True, blank=True)
     start_time = models.DateTimeField(null=True, blank=True)
@@ -78,73 +147,47 @@ class Shift(models.Model):
     active_task = models.IntegerField(default=0, null=True, blank=True)
     objects = ShiftManager()
 
+    class Meta:
+        indexes = [
+            # get_active_shift: status = ACTIVE, ORDER BY start_time DESC
+            models.Index(fields=['status', 'start_time'], name='shift_status_start_idx'),
+            # Активная смена линии
+            models.Index(fields=['line', 'status', 'start_time'], name='shift_line_status_start_idx'),
+            # check_and_start_shifts: только запланированные смены
+            models.Index(fields=['status', 'planned_start_time'], condition=models.Q(status='PLANNED'),
+                         name='shift_planned_start_idx'),
+        ]
+
     def increment_active_task(self):
         self.active_task += 1
         self.save(update_fields=['active_task'])
 
     def start_shift(self):
-        """Начинает смену, завершая все активные"""
-        from .tasks import lead_shift
+        """Начинает смену и передаёт её движку смен"""
+        from dashboard.active_shift import remember_active_shift
+        from dashboard.repos.redis_repository import RedisRepository
         self.status = self.Status.ACTIVE
         self.start_time = timezone.now()
         self.save()
         self._initialize_shift_in_redis(self)
-        lead_shift.apply_async(args=[self.id])
+        remember_active_shift(self)
+        RedisRepository().notify_engine("start", self.id)
 
     def _initialize_shift_in_redis(self, shift):
+        """Записывает смену в Redis одной транзакцией MULTI (см. RedisRepository.seed_shift)."""
         from dashboard.repos.redis_repository import RedisRepository
-        redis = RedisRepository()
-        redis.update_shift_data(self.id, {
-            "id": self.id,
-            "master": self.master.id,
-            "status": self.status,
-            "active_task": 0,
-        })
-        logging.warning(f"Shift {self.id} initialized in Redis TASKS:{self.shifttask_set.all()}")
-        for task in self.shifttask_set.all():
-            redis.save_task(task)
+        tasks = list(self.shifttask_set.select_related('product', 'packing').order_by('order', 'id'))
+        RedisRepository().seed_shift(self, tasks)
+        logging.warning(f"Shift {self.id} initialized in Redis with {len(tasks)} tasks")
 
     @classmethod
-    def end_active_shifts(cls):
-        """Завершает все активные смены"""
-        redis_conn = redis.Redis(
-            host=settings.REDIS_CONFIG["HOST"],
-            port=settings.REDIS_CONFIG["PORT"],
-            db=settings.REDIS_CONFIG["DB"],
-            password=settings.REDIS_CONFIG["PASSWORD"],
-            decode_responses=True,
-        )
-
-        active_shifts = cls.objects.filter(status=cls.Status.ACTIVE)
-        for shift in active_shifts:
-            shift.status = cls.Status.COMPLETED
-            shift.end_time = timezone.now()
-            shift.save()
-            tasks_list_key = f"shift:{shift.id}:tasks"
-            task_ids = redis_conn.lrange(tasks_list_key, 0, -1)
-            shift_key = f"shift:{shift.id}"
-            for task_id in task_ids:
-                try:
-                    task_key = f"task:{task_id}"
-                    task_data = redis_conn.hgetall(task_key)
-                    if task_data:
-                        task_defaults = {
-                            "time_spent": int(task_data.get("time_spent") or 0),
-                            "ready_value": int(task_data.get("ready_value") or 0) if task_data.get(
-                                "ready_value") else None,
-                            "remaining_time": int(task_data.get("remaining_time") or 0) if task_data.get(
-                                "remaining_time") else None,
-                            "started_at": task_data.get("started_at"),
-                            "finished_at": task_data.get("finished_at"),
-                        }
-                        ShiftTask.objects.filter(id=task_id).update(**task_defaults)
-                        logging.info(f"[TASK {task_id}] Updated in database.")
-                        redis_conn.delete(task_key)
-                except Exception as e:
-                    logging.error(f"[TASK {task_id}] Error updating database: {str(e)}")
-                    logging.error(traceback.format_exc())
-            redis_conn.delete(shift_key)
-            redis_conn.delete(tasks_list_key)
+    def end_active_shifts(cls, line_id=None):
+        """Завершает активные смены линии (без line_id – всех линий)"""
+        from dashboard.services import finalize_shifts
+        shifts = cls.objects.filter(status=cls.Status.ACTIVE)
+        if line_id is not None:
+            shifts = shifts.filter(line_id=line_id)
+        finalize_shifts(shifts.values_list('id', flat=True))
 
     def __str__(self):
         return f"{self.status}/{self.master.name}/{self.start_time}"
@@ -169,16 +212,24 @@ class ShiftTask(models.Model):
     ready_value = models.PositiveIntegerField(null=True, blank=True)
     time_needed = models.PositiveIntegerField(null=True, blank=True)
 
-    norm_in_minute = models.PositiveIntegerField(null=True, blank=True)
+    norm_in_minute = models.FloatField(null=True, blank=True)
     time_spent = models.PositiveBigIntegerField(null=True, blank=True)
     percent_from_shift = models.FloatField(null=True, blank=True)
 
     started_at = models.DateTimeField(null=True, blank=True)
     finished_at = models.DateTimeField(null=True, blank=True)
+    # Паузы сохраняются в контрольных точках, чтобы восстановить таймер из БД
+    paused_at = models.DateTimeField(null=True, blank=True)
+    paused_total = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['shift', 'type', 'order'], name='shifttask_shift_type_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         if self.packing:
-            self.norm_in_minute = self.packing.norm_in_minute()
+            self.norm_in_minute = self.packing.norm_in_minute
         super().save(*args, **kwargs)
 
 
@@ -186,12 +237,78 @@ class PackingLog(models.Model):
     shift = models.ForeignKey(Shift, on_delete=models.CASCADE, null=True, blank=True)
     task = models.ForeignKey(ShiftTask, on_delete=models.CASCADE, null=True, blank=True)
     sid = models.IntegerField(null=True, blank=True)
-    created_at = models.DateTimeField(auto_now_add=True)  # Добавьте это поле
+    # Время события берётся со сканера, если он его передал
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['shift', 'created_at'], name='packinglog_shift_created_idx'),
+            models.Index(fields=['task', 'created_at'], name='packinglog_task_created_idx'),
+            # Отсев повторов при записи буфера (flush_packing_events)
+            models.Index(fields=['shift', 'sid'], name='packinglog_shift_sid_idx'),
+        ]
 
     def __str__(self):
         return f"{self.shift.name + ' ' + str(self.shift.id)}/{self.task.id}"
 
 
+class ShiftSummary(models.Model):
+    """Итоги завершённой смены, записываются при её завершении (см. dashboard.rollups)."""
+    shift = models.OneToOneField(Shift, on_delete=models.CASCADE, primary_key=True, related_name='summary')
+    master = models.ForeignKey(Master, on_delete=models.CASCADE, related_name='shift_summaries')
+
+    start_time = models.DateTimeField(null=True, blank=True)
+    end_time = models.DateTimeField(null=True, blank=True)
+
+    avg_completion = models.FloatField(default=0)
+    units_packed = models.PositiveIntegerField(default=0)
+    tasks_count = models.PositiveIntegerField(default=0)
+    run_seconds = models.PositiveBigIntegerField(default=0)
+    break_seconds = models.PositiveBigIntegerField(default=0)
+    # [{product_name, target, completed, completion_percent}, ...] для страницы статистики
+    tasks_details = models.JSONField(default=list)
+
+    class Meta:
+        ordering = ['-start_time']
+        indexes = [models.Index(fields=['master', 'start_time'], name='shiftsummary_master_start_idx')]
+
+    def __str__(self):
+        return f"{self.shift_id}/{self.master_id}/{self.avg_completion}"
+
+
+class MasterStatistics(models.Model):
+    """Сводка мастера за день, неделю или месяц, собранная из ShiftSummary."""
+    class Period(models.TextChoices):
+        DAY = 'DAY', 'Day'
+        WEEK = 'WEEK', 'Week'
+        MONTH = 'MONTH', 'Month'
+
+    master = models.ForeignKey(Master, on_delete=models.CASCADE, related_name='statistics')
+    period = models.CharField(max_length=10, choices=Period.choices)
+    period_start = models.DateField()
+
+    shifts_count = models.PositiveIntegerField(default=0)
+    # Сумма avg_completion смен: среднее за период = completion_sum / shifts_count
+    completion_sum = models.FloatField(default=0)
+    units_packed = models.PositiveIntegerField(default=0)
+    tasks_count = models.PositiveIntegerField(default=0)
+    run_seconds = models.PositiveBigIntegerField(default=0)
+    break_seconds = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = "Master statistics"
+        constraints = [
+            models.UniqueConstraint(fields=['master', 'period', 'period_start'], name='unique_master_period'),
+        ]
+
+    @property
+    def avg_completion(self):
+        return self.completion_sum / self.shifts_count if self.shifts_count else 0
+
+    def __str__(self):
+        return f"{self.master_id}/{self.period}/{self.period_start}"
+
+
 class BreakLog(models.Model):
     shift = models.ForeignKey(Shift, on_delete=models.CASCADE)
     start_time = models.DateTimeField(auto_now_add=True)
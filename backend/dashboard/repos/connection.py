@@ -0,0 +1,50 @@
+import asyncio
+import threading
+import weakref
+
+import redis
+import redis.asyncio as aioredis
+from django.conf import settings
+
+_pool = None
+_pool_lock = threading.Lock()
+# Асинхронный пул привязан к циклу событий, поэтому он свой у каждого цикла
+_async_pools = weakref.WeakKeyDictionary()
+
+
+def _pool_options():
+    config = settings.REDIS_CONFIG
+    return {
+        "host": config["HOST"],
+        "port": config["PORT"],
+        "db": config["DB"],
+        "password": config["PASSWORD"],
+        "decode_responses": True,
+        "max_connections": config["MAX_CONNECTIONS"],
+        "timeout": config["POOL_TIMEOUT"],
+        "health_check_interval": config["HEALTH_CHECK_INTERVAL"],
+        "socket_keepalive": True,
+    }
+
+
+def get_redis():
+    """
+    Синхронный клиент Redis на общем для процесса пуле соединений.
+    Когда пул исчерпан, клиент ждёт свободное соединение до POOL_TIMEOUT
+    секунд вместо того, чтобы открывать новые.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = redis.BlockingConnectionPool(**_pool_options())
+    return redis.Redis(connection_pool=_pool)
+
+
+def get_async_redis():
+    """Асинхронный клиент Redis на общем пуле текущего цикла событий."""
+    loop = asyncio.get_running_loop()
+    pool = _async_pools.get(loop)
+    if pool is None:
+        pool = _async_pools[loop] = aioredis.BlockingConnectionPool(**_pool_options())
+    return aioredis.Redis(connection_pool=pool)
@@ -1,69 +1,674 @@
+import json
 import logging
 
 import redis
 from django.conf import settings
+from django.utils import timezone
 
-from dashboard.models import Product, ProductPacking
+from dashboard.repos.connection import get_redis
+from dashboard.metrics import alert_data, client_metrics, task_metrics, window_minutes
+from dashboard.timers import parse_time, to_epoch, with_timers
+
+# Канал, через который движок смен получает уведомления (см. dashboard.engine)
+ENGINE_CHANNEL = "shift_engine"
+
+# Буфер событий упаковки для режима отложенной записи (PACKING_WRITE_BEHIND)
+PACKING_STREAM = "packing:events"
+PACKING_GROUP = "packing_flusher"
+
+# Ключи смен и заданий, изменившиеся с последней контрольной точки в БД
+CHECKPOINT_DIRTY_KEY = "checkpoint:dirty"
+
+# Переход к следующему заданию с проверкой ожидаемого индекса (compare-and-set).
+# Движок получает уведомление из того же скрипта, без задержки.
+# KEYS: shift:{id}, shift:{id}:tasks, checkpoint:dirty
+# ARGV: ожидаемый индекс ('' – без проверки), канал движка, уведомление
+# Ответ: {1, новый индекс} или {0, текущий индекс}
+ADVANCE_TASK_SCRIPT = """
+local current = tonumber(redis.call('HGET', KEYS[1], 'active_task') or '0')
+if ARGV[1] ~= '' and tonumber(ARGV[1]) ~= current then
+    return {0, current}
+end
+if current >= redis.call('LLEN', KEYS[2]) then
+    return {0, current}
+end
+local index = redis.call('HINCRBY', KEYS[1], 'active_task', 1)
+redis.call('SADD', KEYS[3], KEYS[1])
+redis.call('PUBLISH', ARGV[2], ARGV[3])
+return {1, index}
+"""
+
+# Аренда смены движком: значение – идентификатор владельца (см. ShiftEngine)
+# KEYS: shift:{id}:lease; ARGV: владелец, срок в мс
+RENEW_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS: shift:{id}:lease; ARGV: владелец
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def lease_key(shift_id):
+    return f"shift:{shift_id}:lease"
+
+
+# Очередь автозапуска: id запланированных смен со временем старта (epoch) в качестве веса
+SHIFT_SCHEDULE_KEY = "shifts:schedule"
+
+# Сверка очереди автозапуска с БД: каждая правка применяется, только если вес
+# смены в очереди всё ещё тот, что был прочитан до запроса к БД. Смены,
+# добавленные или перенесённые во время сверки, остаются как есть.
+# KEYS: shifts:schedule; ARGV: тройки (id, прочитанный вес или '', новый вес или '')
+# Возвращает число применённых правок.
+RECONCILE_SCHEDULE_SCRIPT = """
+local changed = 0
+for i = 1, #ARGV, 3 do
+    local current = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    local expected = ARGV[i + 1]
+    if (expected == '' and not current) or (current and tonumber(current) == tonumber(expected)) then
+        if ARGV[i + 2] == '' then
+            redis.call('ZREM', KEYS[1], ARGV[i])
+        else
+            redis.call('ZADD', KEYS[1], ARGV[i + 2], ARGV[i])
+        end
+        changed = changed + 1
+    end
+end
+return changed
+"""
+
+# Активная смена линии: JSON со снимком смены или null, если активной смены нет.
+# Снимок пишут старт и завершение смены; заполнение из БД при промахе пишет
+# только в пустой ключ (SET NX) и ненадолго, чтобы не затереть более новое значение.
+ACTIVE_SHIFT_TTL = 60 * 60
+ACTIVE_SHIFT_REFILL_TTL = 60
+
+
+def active_shift_key(line):
+    return f"line:{line}:active_shift"
+
+
+# Сбрасывает активную смену линии, только если это одна из завершаемых смен.
+# Пустой ключ тоже помечается null, чтобы заполнение из БД, прочитавшее смену
+# до её завершения, не вернуло её в кэш.
+# KEYS: line:{code}:active_shift; ARGV: TTL, TTL для пустого ключа, id завершаемых смен...
+CLEAR_ACTIVE_SHIFT_SCRIPT = """
+local raw = redis.call('GET', KEYS[1])
+if not raw then
+    redis.call('SET', KEYS[1], 'null', 'EX', ARGV[2])
+    return 1
+end
+local active = cjson.decode(raw)
+if active == cjson.null then
+    return 0
+end
+for i = 3, #ARGV do
+    if tostring(active['id']) == ARGV[i] then
+        redis.call('SET', KEYS[1], 'null', 'EX', ARGV[1])
+        return 1
+    end
+end
+return 0
+"""
+
+# Записывает показатели задания (dashboard.metrics), если ready_value не изменился
+# с момента расчёта: более поздний пересчёт не затирается более ранним.
+# Возвращает {1, прежнее behind_norm} или {0}, если показатели устарели.
+# KEYS: task:{id}; ARGV: ready_value, поле, значение, ...
+METRICS_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'ready_value') ~= ARGV[1] then
+    return {0}
+end
+local previous = redis.call('HGET', KEYS[1], 'behind_norm') or '0'
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+return {1, previous}
+"""
+
+
+def metrics_args(ready_value, metrics):
+    """Аргументы METRICS_SCRIPT."""
+    return [ready_value, *[item for pair in metrics.items() for item in pair]]
+
+
+# Поминутные счётчики упаковки живой смены (поле – номер минуты от эпохи)
+THROUGHPUT_TTL = 2 * 24 * 60 * 60
+
+
+def throughput_key(kind, object_id):
+    return f"{kind}:{object_id}:throughput"
+
+
+def minute_bucket(moment):
+    return int(moment.timestamp() // 60)
+
+
+# Справочники названий: хэши заданий хранят только product_id и packing_id,
+# а названия продуктов и упаковок лежат один раз на все смены
+PRODUCT_LOOKUP_KEY = "lookup:product"
+PACKING_LOOKUP_KEY = "lookup:packing"
+
+# Хэш задания с названиями продукта и упаковки из справочников
+TASK_WITH_LABELS_LUA = """
+local function task_with_labels(key)
+    local data = redis.call('HGETALL', key)
+    if #data == 0 then
+        return data
+    end
+    local ids = redis.call('HMGET', key, 'product_id', 'packing_id')
+    if ids[1] then
+        table.insert(data, 'product')
+        table.insert(data, redis.call('HGET', '%s', ids[1]) or '')
+    end
+    if ids[2] then
+        table.insert(data, 'packing')
+        table.insert(data, redis.call('HGET', '%s', ids[2]) or '')
+    end
+    return data
+end
+""" % (PRODUCT_LOOKUP_KEY, PACKING_LOOKUP_KEY)
+
+# KEYS: task:{id}
+TASK_SCRIPT = TASK_WITH_LABELS_LUA + """
+return task_with_labels(KEYS[1])
+"""
+
+# Снимок смены за один запрос: версия, хэш смены, порядок заданий и хэши заданий.
+# KEYS: shift:{id}, shift:{id}:tasks, shift:{id}:version
+SHIFT_SNAPSHOT_SCRIPT = TASK_WITH_LABELS_LUA + """
+local tasks = {}
+local ids = redis.call('LRANGE', KEYS[2], 0, -1)
+for i, id in ipairs(ids) do
+    tasks[i] = task_with_labels('task:' .. id)
+end
+return {redis.call('GET', KEYS[3]), redis.call('HGETALL', KEYS[1]), tasks}
+"""
+
+
+def snapshot_keys(shift_id):
+    return [f"shift:{shift_id}", f"shift:{shift_id}:tasks", f"shift:{shift_id}:version"]
+
+
+def to_dict(flat):
+    """Плоский ответ HGETALL из Lua-скрипта в словарь."""
+    return dict(zip(flat[::2], flat[1::2]))
+
+
+def parse_snapshot(raw):
+    """Разбирает ответ SHIFT_SNAPSHOT_SCRIPT в (version, shift, [task, ...])."""
+    version, shift_data, tasks = raw
+    return int(version or 0), to_dict(shift_data), [to_dict(task) for task in tasks if task]
+
+
+_INT_FIELDS = {
+    "id", "master", "active_task", "order", "target", "ready_value", "shift", "duration", "behind_norm",
+    "product_id", "packing_id",
+}
+_FLOAT_FIELDS = {"norm_in_minute", "paused_total", "rate", "efficiency", "norm_deficit", "percent_of_target"}
+
+
+def typed_fields(data):
+    """Приводит строковые поля хэша Redis к числам."""
+    typed = {}
+    for field, value in data.items():
+        if value in (None, ""):
+            typed[field] = None
+        elif field in _INT_FIELDS:
+            typed[field] = int(value)
+        elif field in _FLOAT_FIELDS:
+            typed[field] = float(value)
+        else:
+            typed[field] = value
+    return typed
+
+
+def typed_snapshot(shift_id, raw, now=None):
+    """Снимок смены с типизированными полями и вычисленными таймерами."""
+    version, shift_data, tasks = parse_snapshot(raw)
+    if not shift_data and not tasks:
+        return None
+    now = now or timezone.now()
+    return {
+        "shift_id": int(shift_id),
+        "version": version,
+        "shift": typed_fields(shift_data),
+        "tasks": [with_timers(typed_fields(task), now) for task in tasks],
+    }
 
 
 class RedisRepository:
     def __init__(self):
-        self.conn = redis.Redis(
-            host=settings.REDIS_CONFIG["HOST"],
-            port=settings.REDIS_CONFIG["PORT"],
-            db=settings.REDIS_CONFIG["DB"],
-            password=settings.REDIS_CONFIG["PASSWORD"],
-            decode_responses=True,
-        )
+        self.conn = get_redis()
+        self._snapshot_script = self.conn.register_script(SHIFT_SNAPSHOT_SCRIPT)
+        self._clear_active_script = self.conn.register_script(CLEAR_ACTIVE_SHIFT_SCRIPT)
+        self._advance_script = self.conn.register_script(ADVANCE_TASK_SCRIPT)
+        self._task_script = self.conn.register_script(TASK_SCRIPT)
+        self._metrics_script = self.conn.register_script(METRICS_SCRIPT)
+        self._reconcile_schedule_script = self.conn.register_script(RECONCILE_SCHEDULE_SCRIPT)
+
+    def get_shift_snapshot(self, shift_id):
+        """
+        Полное состояние смены (смена, задания по порядку, версия) за один
+        запрос к Redis. None, если смены в Redis нет.
+        """
+        return typed_snapshot(shift_id, self._snapshot_script(keys=snapshot_keys(shift_id)))
+
+    def get_shift_snapshots(self, shift_ids):
+        """Снимки нескольких смен одним конвейером: {shift_id: snapshot}."""
+        shift_ids = list(shift_ids)
+        if not shift_ids:
+            return {}
+        with self.conn.pipeline(transaction=False) as pipe:
+            for shift_id in shift_ids:
+                self._snapshot_script(keys=snapshot_keys(shift_id), client=pipe)
+            raws = pipe.execute()
+        now = timezone.now()
+        return {
+            shift_id: typed_snapshot(shift_id, raw, now)
+            for shift_id, raw in zip(shift_ids, raws)
+        }
+
+    def delete_shift_state(self, shift_ids, task_ids):
+        """Удаляет живое состояние смен и их заданий одной командой."""
+        keys = []
+        for task_id in task_ids:
+            keys += [f"task:{task_id}", throughput_key("task", task_id)]
+        for shift_id in shift_ids:
+            keys += [f"shift:{shift_id}", f"shift:{shift_id}:tasks", throughput_key("shift", shift_id)]
+        if keys:
+            self.conn.delete(*keys)
+
+    def live_keys(self):
+        """
+        Ключи живого состояния, найденные SCAN: {"shift": {id: [ключи]}, "task": {id: [ключи]}}.
+        Аренды (у них свой срок жизни) не входят.
+        """
+        found = {"shift": {}, "task": {}}
+        for kind in found:
+            for key in self.conn.scan_iter(match=f"{kind}:*", count=1000):
+                _, _, rest = key.partition(":")
+                object_id, _, suffix = rest.partition(":")
+                if object_id.isdigit() and suffix != "lease":
+                    found[kind].setdefault(int(object_id), []).append(key)
+        return found
+
+    def task_shift_ids(self, task_ids):
+        """Смена каждого задания по его хэшу: {task_id: shift_id или None}."""
+        task_ids = list(task_ids)
+        with self.conn.pipeline(transaction=False) as pipe:
+            for task_id in task_ids:
+                pipe.hget(f"task:{task_id}", "shift")
+            owners = pipe.execute()
+        return {task_id: int(owner) if owner else None for task_id, owner in zip(task_ids, owners)}
+
+    def delete_keys(self, keys, chunk_size=500):
+        for start in range(0, len(keys), chunk_size):
+            self.conn.delete(*keys[start:start + chunk_size])
+
+    def memory_usage(self, keys):
+        """Байты, занятые каждым ключом (MEMORY USAGE): {ключ: байт}."""
+        keys = list(keys)
+        with self.conn.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.memory_usage(key)
+            return {key: usage or 0 for key, usage in zip(keys, pipe.execute())}
+
+    def memory_info(self):
+        return self.conn.info("memory")
 
     def update_shift_data(self, shift_id, data):
         try:
-            self.conn.hset(f"shift:{shift_id}", mapping=data)
-        except Exception as e:
+            with self.conn.pipeline() as pipe:
+                pipe.hset(f"shift:{shift_id}", mapping=data)
+                pipe.sadd(CHECKPOINT_DIRTY_KEY, f"shift:{shift_id}")
+                pipe.execute()
+        except Exception:
             logging.exception(f"Redis shift update error for shift {shift_id}")
             raise
 
     def increment_task_value(self, task_id, field, value=1):
         try:
-            self.conn.hincrby(f"task:{task_id}", field, value)
-        except Exception as e:
+            with self.conn.pipeline() as pipe:
+                pipe.hincrby(f"task:{task_id}", field, value)
+                pipe.sadd(CHECKPOINT_DIRTY_KEY, f"task:{task_id}")
+                return pipe.execute()[0]
+        except Exception:
             logging.exception(f"Redis error incrementing {field} for task {task_id}")
             raise
 
+    def advance_active_task(self, shift_id, expected=None):
+        """
+        Атомарно переводит смену к следующему заданию и уведомляет движок.
+        expected – индекс, который видел клиент: повторное нажатие с тем же
+        индексом не продвинет смену дважды. Возвращает (успех, индекс).
+        """
+        advanced, index = self._advance_script(
+            keys=[f"shift:{shift_id}", f"shift:{shift_id}:tasks", CHECKPOINT_DIRTY_KEY],
+            args=[
+                "" if expected is None else expected,
+                ENGINE_CHANNEL,
+                json.dumps({"event": "active_task", "shift_id": shift_id}),
+            ],
+        )
+        return bool(advanced), int(index)
+
+    def add_packed_units(self, shift_id, task_id, count, events=None, minutes=None):
+        """
+        Увеличивает счётчики смены и активного задания одним конвейером,
+        пересчитывает живые показатели задания (dashboard.metrics) и сообщает
+        движку новое значение ready_value вместе с показателями.
+        events – события для отложенной записи в PackingLog; они попадают
+        в буфер в той же транзакции, что и счётчики.
+        minutes – {номер минуты: штук} для поминутных счётчиков; по умолчанию
+        всё относится к текущей минуте.
+        """
+        now = timezone.now()
+        minutes = minutes or {minute_bucket(now): count}
+        window = window_minutes(now)
+        throughput_keys = [throughput_key("shift", shift_id)]
+        if task_id:
+            throughput_keys.append(throughput_key("task", task_id))
+        try:
+            with self.conn.pipeline() as pipe:
+                pipe.hincrby(f"shift:{shift_id}", "ready_value", count)
+                if task_id:
+                    pipe.hincrby(f"task:{task_id}", "ready_value", count)
+                    pipe.sadd(CHECKPOINT_DIRTY_KEY, f"task:{task_id}")
+                for key in throughput_keys:
+                    for minute, units in minutes.items():
+                        pipe.hincrby(key, minute, units)
+                    pipe.expire(key, THROUGHPUT_TTL)
+                for event in events or []:
+                    pipe.xadd(PACKING_STREAM, event)
+                if task_id:
+                    pipe.hgetall(f"task:{task_id}")
+                    pipe.hmget(throughput_key("task", task_id), window)
+                results = pipe.execute()
+        except Exception:
+            logging.exception(f"Redis error adding {count} packed units to shift {shift_id}")
+            raise
+
+        if task_id:
+            task_data, window_counts = results[-2], results[-1]
+            metrics = task_metrics(task_data, window_counts, now)
+            previous = None
+            if metrics:
+                written = self._metrics_script(
+                    keys=[f"task:{task_id}"], args=metrics_args(task_data.get("ready_value"), metrics)
+                )
+                if written[0]:
+                    previous = written[1]
+                else:
+                    # Показатели уже пересчитаны по более новому ready_value – их и разошлёт тот вызов
+                    metrics = {}
+            self.notify_engine("task_update", shift_id, task_id=task_id,
+                               data={"ready_value": results[1], **client_metrics(metrics)})
+            if metrics and str(metrics["behind_norm"]) != previous:
+                self.notify_engine("alert", shift_id, task_id=task_id, data=alert_data(metrics))
+
+    def get_throughput(self, kind, object_id):
+        """Поминутные счётчики живой смены или задания: {номер минуты: штук}."""
+        return {
+            int(minute): int(units)
+            for minute, units in self.conn.hgetall(throughput_key(kind, object_id)).items()
+        }
+
+    def has_packing_events(self):
+        return bool(self.conn.exists(PACKING_STREAM))
+
+    def read_packing_events(self, consumer, count, claim_idle_ms=None):
+        """
+        Забирает из буфера пачку событий [(entry_id, fields), ...].
+        Сначала подхватываются события, зависшие у упавших обработчиков
+        дольше claim_idle_ms (по умолчанию CLAIM_IDLE_MS), поэтому каждое
+        событие будет записано хотя бы один раз.
+        """
+        try:
+            self.conn.xgroup_create(PACKING_STREAM, PACKING_GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+        claimed = self.conn.xautoclaim(
+            PACKING_STREAM, PACKING_GROUP, consumer,
+            min_idle_time=settings.PACKING_WRITE_BEHIND["CLAIM_IDLE_MS"] if claim_idle_ms is None else claim_idle_ms,
+            count=count,
+        )[1]
+        if claimed:
+            return claimed
+        response = self.conn.xreadgroup(PACKING_GROUP, consumer, {PACKING_STREAM: ">"}, count=count)
+        return response[0][1] if response else []
+
+    def pop_dirty_keys(self):
+        """Забирает ключи, изменившиеся с последней контрольной точки."""
+        with self.conn.pipeline() as pipe:
+            pipe.smembers(CHECKPOINT_DIRTY_KEY)
+            pipe.delete(CHECKPOINT_DIRTY_KEY)
+            keys, _ = pipe.execute()
+        return sorted(keys)
+
+    def mark_dirty(self, *keys):
+        if keys:
+            self.conn.sadd(CHECKPOINT_DIRTY_KEY, *keys)
+
+    def read_hashes(self, keys):
+        with self.conn.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(key)
+            return pipe.execute()
+
+    def ack_packing_events(self, entry_ids):
+        with self.conn.pipeline() as pipe:
+            pipe.xack(PACKING_STREAM, PACKING_GROUP, *entry_ids)
+            pipe.xdel(PACKING_STREAM, *entry_ids)
+            pipe.execute()
+
     def save_task(self, task):
         task_data = self._prepare_task_data(task)
         try:
-            self.conn.hset(f"task:{task.id}", mapping=task_data)
-            self.conn.rpush(f"shift:{task.shift_id}:tasks", task.id)
-        except Exception as e:
+            with self.conn.pipeline() as pipe:
+                self._save_lookups(pipe, [task])
+                pipe.hset(f"task:{task.id}", mapping=task_data)
+                pipe.rpush(f"shift:{task.shift_id}:tasks", task.id)
+                pipe.execute()
+        except Exception:
             logging.exception(f"Redis error saving task {task.id}")
             raise
 
+    def seed_shift(self, shift, tasks):
+        """
+        Записывает смену целиком одной транзакцией MULTI: хэш смены, хэши
+        заданий и упорядоченный список заданий. Движок не увидит смену
+        наполовину записанной. tasks – задания с подгруженными product и packing.
+        """
+        shift_key = f"shift:{shift.id}"
+        tasks_key = f"shift:{shift.id}:tasks"
+        try:
+            with self.conn.pipeline() as pipe:
+                pipe.delete(tasks_key, *[f"task:{task.id}" for task in tasks])
+                pipe.hset(shift_key, mapping={
+                    "id": shift.id,
+                    "master": shift.master_id,
+                    "line": shift.line.code,
+                    "status": shift.status,
+                    "active_task": shift.active_task or 0,
+                })
+                self._save_lookups(pipe, tasks)
+                for task in tasks:
+                    pipe.hset(f"task:{task.id}", mapping=self._prepare_task_data(task))
+                if tasks:
+                    pipe.rpush(tasks_key, *[task.id for task in tasks])
+                pipe.sadd(CHECKPOINT_DIRTY_KEY, shift_key)
+                pipe.execute()
+        except Exception:
+            logging.exception(f"Redis error seeding shift {shift.id}")
+            raise
+
+    def _save_lookups(self, pipe, tasks):
+        """Дописывает в справочники названия продуктов и упаковок заданий."""
+        products = {task.product_id: str(task.product) for task in tasks if task.product_id}
+        packings = {task.packing_id: str(task.packing.value) for task in tasks if task.packing_id}
+        if products:
+            pipe.hset(PRODUCT_LOOKUP_KEY, mapping=products)
+        if packings:
+            pipe.hset(PACKING_LOOKUP_KEY, mapping=packings)
+
     def _prepare_task_data(self, task):
+        """Хэш задания: только числа и короткий код типа, названия – в справочниках."""
         if task.type == "TASK":
-            product = Product.objects.get(id=task.product_id)
-            packing = ProductPacking.objects.get(id=task.packing_id)
-            return {
+            data = {
                 "id": task.id,
                 "type": task.type,
                 "order": task.order,
                 "target": task.target,
-                "ready_value": 0,
-                "product": str(product),
-                "packing": str(packing.packing.value),
+                "ready_value": task.ready_value or 0,
+                "product_id": task.product_id or "",
+                "packing_id": task.packing_id or "",
                 "shift": task.shift_id,
-                "norm_in_minute": task.packing.norm_in_minute() if task.packing else 0
+                "norm_in_minute": task.norm_in_minute or 0
             }
-        return {
-            "id": task.id,
-            "type": task.type,
-            "order": task.order,
-            "remaining_time": task.remaining_time * 60,
-            "shift": task.shift_id,
+        else:
+            data = {
+                "id": task.id,
+                "type": task.type,
+                "order": task.order,
+                "duration": task.remaining_time * 60,
+                "shift": task.shift_id,
+            }
+        return {**data, **self._checkpointed_state(task)}
+
+    def _checkpointed_state(self, task):
+        """Живое состояние задания из последней контрольной точки в БД."""
+        state = {
+            "started_at": to_epoch(task.started_at),
+            "finished_at": to_epoch(task.finished_at),
+            "paused_at": to_epoch(task.paused_at),
+            "paused_total": task.paused_total,
         }
+        return {field: value for field, value in state.items() if value not in (None, "")}
+
+    def get_task(self, task_id):
+        """Данные задания с названиями продукта и упаковки и вычисленными таймерами."""
+        return with_timers(to_dict(self._task_script(keys=[f"task:{task_id}"])))
+
+    def get_active_task_id(self, shift_id):
+        return self.conn.lindex(f"shift:{shift_id}:tasks", self.get_active_task_index(shift_id))
+
+    def toggle_task_pause(self, task_id):
+        """
+        Ставит задание на паузу или снимает с неё.
+        Возвращает True, если задание теперь на паузе.
+        """
+        task_key = f"task:{task_id}"
+        task_data = self.conn.hgetall(task_key)
+        if not task_data.get("started_at") or task_data.get("finished_at"):
+            raise ValueError(f"Task {task_id} is not running")
+
+        now = timezone.now()
+        paused_at = parse_time(task_data.get("paused_at"))
+        try:
+            if paused_at:
+                paused_total = float(task_data.get("paused_total") or 0) + (now - paused_at).total_seconds()
+                with self.conn.pipeline() as pipe:
+                    pipe.hset(task_key, "paused_total", paused_total)
+                    pipe.hdel(task_key, "paused_at")
+                    pipe.sadd(CHECKPOINT_DIRTY_KEY, task_key)
+                    pipe.execute()
+                return False
+            with self.conn.pipeline() as pipe:
+                pipe.hset(task_key, "paused_at", to_epoch(now))
+                pipe.sadd(CHECKPOINT_DIRTY_KEY, task_key)
+                pipe.execute()
+            return True
+        except Exception:
+            logging.exception(f"Redis error toggling pause for task {task_id}")
+            raise
 
     def get_active_task_index(self, shift_id):
         try:
             return int(self.conn.hget(f"shift:{shift_id}", "active_task") or 0)
         except ValueError:
-            return 0
\ No newline at end of file
+            return 0
+
+    def get_active_shift(self, line):
+        """
+        (True, снимок) или (True, None), если на линии нет активной смены;
+        (False, None), если в Redis ничего не записано.
+        """
+        raw = self.conn.get(active_shift_key(line))
+        if raw is None:
+            return False, None
+        return True, json.loads(raw)
+
+    def set_active_shift(self, line, snapshot):
+        """Записывает снимок при старте смены."""
+        self.conn.set(active_shift_key(line), json.dumps(snapshot), ex=ACTIVE_SHIFT_TTL)
+
+    def refill_active_shift(self, line, snapshot):
+        """
+        Заполняет промах снимком из БД, только если ключ всё ещё пуст.
+        False – значение уже записал старт или завершение смены.
+        """
+        return bool(self.conn.set(active_shift_key(line), json.dumps(snapshot), ex=ACTIVE_SHIFT_REFILL_TTL, nx=True))
+
+    def clear_active_shift(self, line, shift_ids):
+        """Сбрасывает активную смену линии, если она среди shift_ids."""
+        self._clear_active_script(
+            keys=[active_shift_key(line)], args=[ACTIVE_SHIFT_TTL, ACTIVE_SHIFT_REFILL_TTL, *shift_ids]
+        )
+
+    def schedule_shifts(self, shifts):
+        """
+        Ставит запланированные смены в очередь автозапуска движка, остальные
+        (начатые, отменённые, без времени старта) из неё убирает.
+        """
+        with self.conn.pipeline() as pipe:
+            for shift in shifts:
+                if shift.status == "PLANNED" and shift.planned_start_time:
+                    pipe.zadd(SHIFT_SCHEDULE_KEY, {shift.id: shift.planned_start_time.timestamp()})
+                else:
+                    pipe.zrem(SHIFT_SCHEDULE_KEY, shift.id)
+            pipe.execute()
+        self.notify_engine("schedule", None)
+
+    def unschedule_shifts(self, shift_ids):
+        if shift_ids:
+            self.conn.zrem(SHIFT_SCHEDULE_KEY, *shift_ids)
+            self.notify_engine("schedule", None)
+
+    def get_schedule(self):
+        """Очередь автозапуска: {shift_id: время старта (epoch)}."""
+        return {
+            int(shift_id): start_at
+            for shift_id, start_at in self.conn.zrange(SHIFT_SCHEDULE_KEY, 0, -1, withscores=True)
+        }
+
+    def reconcile_schedule(self, scheduled, planned):
+        """
+        Сверка: приводит очередь автозапуска к списку {shift_id: planned_start_time}
+        из БД. scheduled – очередь (get_schedule), прочитанная до запроса к БД:
+        правка применяется, только если смена в очереди с тех пор не менялась,
+        поэтому смену, добавленную во время сверки, она не сотрёт.
+        """
+        args = []
+        for shift_id in scheduled.keys() | planned.keys():
+            start_at = planned[shift_id].timestamp() if shift_id in planned else None
+            if scheduled.get(shift_id) != start_at:
+                args.extend([shift_id, scheduled.get(shift_id, ""), "" if start_at is None else start_at])
+        if args and self._reconcile_schedule_script(keys=[SHIFT_SCHEDULE_KEY], args=args):
+            self.notify_engine("schedule", None)
+
+    def notify_engine(self, event, shift_id, **payload):
+        """Сообщает движку смен о событии (start, active_task, pause, task_update, alert, schedule)."""
+        try:
+            self.conn.publish(ENGINE_CHANNEL, json.dumps({"event": event, "shift_id": shift_id, **payload}))
+        except Exception:
+            logging.exception(f"Redis error notifying engine about {event} for shift {shift_id}")
+            raise
@@ -0,0 +1,186 @@
+"""
+Сводные таблицы статистики.
+
+ShiftSummary – одна строка на завершённую смену, MasterStatistics – сумма
+по мастеру за день, неделю и месяц. Строки пишутся при завершении смены
+(finalize_shifts), поэтому страница статистики читает только сводки и не
+пересчитывает историю. Команда rebuild_statistics собирает их заново из
+ShiftTask и PackingLog; историю до появления сводок заполняет миграция
+0017.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db.models import Avg, Count, ExpressionWrapper, F, FloatField, OuterRef, Prefetch, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from dashboard.models import MasterStatistics, PackingLog, Shift, ShiftSummary, ShiftTask
+
+SUMMARY_FIELDS = [
+    "master", "start_time", "end_time", "avg_completion", "units_packed", "tasks_count",
+    "run_seconds", "break_seconds", "tasks_details",
+]
+STATISTICS_FIELDS = [
+    "shifts_count", "completion_sum", "units_packed", "tasks_count", "run_seconds", "break_seconds",
+]
+
+
+def completed_shifts_with_completion(date_from=None, date_to=None, master_id=None):
+    """
+    Завершённые смены с посчитанным в БД средним процентом выполнения
+    (avg_completion) по заданиям типа TASK, у которых есть target и ready_value.
+    """
+    completion = ExpressionWrapper(F('ready_value') * 100.0 / F('target'), output_field=FloatField())
+    shift_completion = ShiftTask.objects.filter(
+        shift=OuterRef('pk'),
+        type=ShiftTask.TaskType.TASK,
+        target__gt=0,
+        ready_value__gt=0,
+    ).values('shift').annotate(avg=Avg(completion)).values('avg')
+
+    shifts = Shift.objects.filter(status=Shift.Status.COMPLETED)
+    if date_from:
+        shifts = shifts.filter(start_time__date__gte=date_from)
+    if date_to:
+        shifts = shifts.filter(start_time__date__lte=date_to)
+    if master_id:
+        shifts = shifts.filter(master_id=master_id)
+    return shifts.annotate(
+        avg_completion=Coalesce(Subquery(shift_completion, output_field=FloatField()), Value(0.0))
+    )
+
+
+def period_starts(day):
+    """Начала дня, недели (понедельник) и месяца, в которые попадает дата."""
+    return {
+        MasterStatistics.Period.DAY: day,
+        MasterStatistics.Period.WEEK: day - timedelta(days=day.weekday()),
+        MasterStatistics.Period.MONTH: day.replace(day=1),
+    }
+
+
+def _build_summaries(shifts):
+    shifts = list(shifts.prefetch_related(
+        Prefetch('shifttask_set', queryset=ShiftTask.objects.select_related('product'), to_attr='task_rows')
+    ))
+    units = dict(
+        PackingLog.objects.filter(shift__in=[shift.id for shift in shifts])
+        .values_list('shift').annotate(units=Count('id'))
+    )
+
+    summaries = []
+    for shift in shifts:
+        tasks = [task for task in shift.task_rows if task.type == ShiftTask.TaskType.TASK]
+        breaks = [task for task in shift.task_rows if task.type == ShiftTask.TaskType.BREAK]
+        summaries.append(ShiftSummary(
+            shift_id=shift.id,
+            master_id=shift.master_id,
+            start_time=shift.start_time,
+            end_time=shift.end_time,
+            avg_completion=shift.avg_completion,
+            units_packed=units.get(shift.id, 0),
+            tasks_count=len(tasks),
+            run_seconds=sum(task.time_spent or 0 for task in tasks),
+            break_seconds=sum(task.time_spent or 0 for task in breaks),
+            tasks_details=[
+                {
+                    'product_name': task.product.name if task.product else None,
+                    'target': task.target,
+                    'completed': task.ready_value,
+                    'completion_percent': round((task.ready_value / task.target * 100),
+                                                2) if task.target and task.ready_value else 0
+                }
+                for task in sorted(tasks, key=lambda task: task.order)
+            ],
+        ))
+    return summaries
+
+
+def _accumulate(summaries, keys=None):
+    """Суммирует сводки смен по (мастер, период, начало периода)."""
+    totals = defaultdict(lambda: dict.fromkeys(STATISTICS_FIELDS, 0))
+    for summary in summaries:
+        if not summary.start_time:
+            # Смену без даты не отнести к периоду; get_shifts_statistics добавляет её из ShiftSummary
+            continue
+        for period, start in period_starts(timezone.localdate(summary.start_time)).items():
+            key = (summary.master_id, period, start)
+            if keys is not None and key not in keys:
+                continue
+            total = totals[key]
+            total["shifts_count"] += 1
+            total["completion_sum"] += summary.avg_completion
+            total["units_packed"] += summary.units_packed
+            total["tasks_count"] += summary.tasks_count
+            total["run_seconds"] += summary.run_seconds
+            total["break_seconds"] += summary.break_seconds
+    return [
+        MasterStatistics(master_id=master_id, period=period, period_start=start, **total)
+        for (master_id, period, start), total in totals.items()
+    ]
+
+
+def _save_statistics(statistics):
+    MasterStatistics.objects.bulk_create(
+        statistics,
+        update_conflicts=True,
+        unique_fields=["master", "period", "period_start"],
+        update_fields=STATISTICS_FIELDS,
+    )
+
+
+def summarize_shifts(shift_ids):
+    """
+    Записывает сводки завершённых смен и пересчитывает затронутые периоды
+    их мастеров. Работа ограничена месяцем (или неделей на стыке месяцев)
+    каждого мастера и не зависит от объёма истории. Повторный вызов
+    безопасен: строки перезаписываются.
+    """
+    summaries = _build_summaries(completed_shifts_with_completion().filter(id__in=list(shift_ids)))
+    if not summaries:
+        return []
+    ShiftSummary.objects.bulk_create(
+        summaries, update_conflicts=True, unique_fields=["shift"], update_fields=SUMMARY_FIELDS,
+    )
+
+    keys = {
+        (summary.master_id, period, start)
+        for summary in summaries if summary.start_time
+        for period, start in period_starts(timezone.localdate(summary.start_time)).items()
+    }
+    ranges = defaultdict(list)
+    for master_id, _, start in keys:
+        ranges[master_id].append(start)
+
+    statistics = []
+    for master_id, starts in ranges.items():
+        # Понедельник недели может выпасть на предыдущий месяц, поэтому окно – от самого раннего начала
+        date_from = min(starts)
+        date_to = max(starts) + timedelta(days=31)
+        master_summaries = ShiftSummary.objects.filter(
+            master_id=master_id, start_time__date__gte=date_from, start_time__date__lt=date_to,
+        )
+        statistics.extend(_accumulate(master_summaries, keys))
+    _save_statistics(statistics)
+    return summaries
+
+
+def rebuild_rollups(batch_size=500):
+    """Пересобирает все сводки из ShiftTask и PackingLog."""
+    shift_ids = list(
+        Shift.objects.filter(status=Shift.Status.COMPLETED).order_by('id').values_list('id', flat=True)
+    )
+    ShiftSummary.objects.exclude(shift_id__in=shift_ids).delete()
+    for offset in range(0, len(shift_ids), batch_size):
+        summaries = _build_summaries(
+            completed_shifts_with_completion().filter(id__in=shift_ids[offset:offset + batch_size])
+        )
+        ShiftSummary.objects.bulk_create(
+            summaries, update_conflicts=True, unique_fields=["shift"], update_fields=SUMMARY_FIELDS,
+        )
+
+    MasterStatistics.objects.all().delete()
+    statistics = _accumulate(ShiftSummary.objects.all().iterator())
+    MasterStatistics.objects.bulk_create(statistics, batch_size=batch_size)
+    return len(shift_ids), len(statistics)
@@ -14,4 +14,5 @@ router.register(r'packing_log', PackingLogViewSet, basename='packing_log')
 
 websocket_urlpatterns = [
     re_path(r'ws/shifts/$', ShiftConsumer.as_asgi()),
+    re_path(r'ws/shifts/(?P<line>[-\w]+)/$', ShiftConsumer.as_asgi()),
 ]
\ No newline at end of file
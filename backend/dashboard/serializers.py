@@ -1,11 +1,11 @@
-import redis
 from django.db import transaction
-from django.db.models import Q
 from django.utils import timezone
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
+from .active_shift import get_active_shift_id, request_line
 from .models import Shift, Product, Packing, PackingLog, BreakLog, ShiftTask, Master
+from .signals import schedule_after_commit
 
 
 class ProductSerializer(serializers.ModelSerializer):
@@ -47,6 +47,56 @@ class _ShiftTaskSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'shift']
 
 
+def _authenticated_user(context):
+    request = context.get('request')
+    if not request or not request.user.is_authenticated:
+        raise ValidationError("Користувач має бути автентифікованим.")
+    return request.user
+
+
+def _build_shift(validated_data, user, now):
+    """Несохранённая смена и её задания из проверенных данных сериализатора."""
+    tasks_data = validated_data.pop('tasks', [])
+    if validated_data.pop('start_now', False):
+        validated_data['planned_start_time'] = now
+    return Shift(user_starts=user, **validated_data), tasks_data
+
+
+def _build_task(shift, task_data):
+    # bulk_create не вызывает ShiftTask.save, поэтому норма берётся из упаковки здесь, как в save
+    task = ShiftTask(shift=shift, **task_data)
+    if task.packing:
+        task.norm_in_minute = task.packing.norm_in_minute
+    return task
+
+
+def _build_tasks(shift, tasks_data):
+    return [_build_task(shift, task_data) for task_data in tasks_data]
+
+
+class BulkShiftSerializer(serializers.ListSerializer):
+    """
+    Создание списка смен (планирование на неделю): смены и все их задания
+    вставляются двумя bulk_create в одной транзакции.
+    """
+
+    def create(self, validated_data):
+        user = _authenticated_user(self.context)
+        now = timezone.now()
+        built = [_build_shift(item, user, now) for item in validated_data]
+
+        with transaction.atomic():
+            shifts = Shift.objects.bulk_create([shift for shift, _ in built])
+            ShiftTask.objects.bulk_create([
+                task
+                for shift, (_, tasks_data) in zip(shifts, built)
+                for task in _build_tasks(shift, tasks_data)
+            ])
+            # bulk_create не отправляет post_save, поэтому в очередь автозапуска ставим сами
+            schedule_after_commit(shifts)
+        return shifts
+
+
 class ShiftSerializer(serializers.ModelSerializer):
     tasks = ShiftTaskSerializer(many=True, write_only=True, required=False)
     shifttask_set = ShiftTaskSerializer(many=True, read_only=True)
@@ -56,22 +106,15 @@ class ShiftSerializer(serializers.ModelSerializer):
         model = Shift
         fields = '__all__'
         read_only_fields = ['id', 'user_starts']
+        list_serializer_class = BulkShiftSerializer
 
     def create(self, validated_data):
-        request = self.context.get('request')
-        if not request or not request.user.is_authenticated:
-            raise ValidationError("Користувач має бути автентифікованим.")
-
-        tasks_data = validated_data.pop('tasks', [])
-        start_now = validated_data.pop('start_now', False)
+        user = _authenticated_user(self.context)
+        shift, tasks_data = _build_shift(validated_data, user, timezone.now())
 
         with transaction.atomic():
-            if start_now:
-                validated_data['planned_start_time'] = timezone.now()
-
-            shift = Shift.objects.create(user_starts=request.user, **validated_data)
-            for task_data in tasks_data:
-                ShiftTask.objects.create(shift=shift, **task_data)
+            shift.save()
+            ShiftTask.objects.bulk_create(_build_tasks(shift, tasks_data))
 
         return shift
 
@@ -82,20 +125,23 @@ class PackingLogSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
     def create(self, validated_data):
-        shift = Shift.objects.filter(
-            Q(status=Shift.Status.ACTIVE)
-        ).order_by('-id').first()
-        redis_conn = redis.Redis(host="redis", port=6379, decode_responses=True)
-
-        if shift:
-            redis_conn.hincrby(f"shift:{shift.id}", "ready_value", 1)
-            validated_data['shift'] = shift
+        shift_id = get_active_shift_id(request_line(self.context['request']))
+        # Счётчики в Redis увеличивает PackingLogViewSet.create (RedisRepository.add_packed_units)
+        if shift_id:
+            validated_data.pop('shift', None)
+            validated_data['shift_id'] = shift_id
         else:
             raise serializers.ValidationError("No active or paused shift found.")
 
         return super().create(validated_data)
 
 
+class PackingEventSerializer(serializers.Serializer):
+    """Одно событие сканера в пакетной загрузке."""
+    sid = serializers.IntegerField()
+    timestamp = serializers.DateTimeField(required=False)
+
+
 class BreakLogSerializer(serializers.ModelSerializer):
     shift = ShiftSerializer()
 
@@ -177,4 +223,4 @@ class ShiftListSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Shift
-        fields = ['id', 'status', 'planned_start_time', 'start_time', 'end_time', 'master_name']
+        fields = ['id', 'line', 'status', 'planned_start_time', 'start_time', 'end_time', 'master_name']
@@ -1,70 +1,443 @@
-from dashboard.models import ShiftTask, Shift
+import logging
+import os
+import socket
+from collections import Counter, defaultdict
+from datetime import datetime, timezone as dt_timezone
 
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Sum, Window
+from django.db.models.functions import RowNumber, TruncMinute
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
-def get_shifts_statistics():
-    completed_shifts = Shift.objects.filter(
-        status=Shift.Status.COMPLETED
-    ).select_related('master')
+from dashboard.active_shift import forget_active_shifts, get_active_shift_id
+from dashboard.locks import packing_flush_lock, shift_lifecycle_lock
+from dashboard.models import ShiftTask, Shift, PackingLog, MasterStatistics, ShiftSummary
+from dashboard.repos.redis_repository import RedisRepository, minute_bucket, typed_fields
+from dashboard.rollups import summarize_shifts
+from dashboard.serializers import PackingEventSerializer
+from dashboard.timers import parse_time, with_timers
 
-    masters_stats = {}
+# Поля ShiftTask, которые переносятся из Redis при завершении смены
+TASK_STATE_FIELDS = [
+    "time_spent", "ready_value", "remaining_time", "started_at", "finished_at", "paused_at", "paused_total",
+]
+# В контрольных точках remaining_time не пишется: пока смена идёт, в нём лежит
+# плановая длительность перерыва в минутах, из которой restore_shift_state
+# восстанавливает duration, а остаток вычисляется по started_at и паузам
+TASK_CHECKPOINT_FIELDS = [field for field in TASK_STATE_FIELDS if field != "remaining_time"]
 
-    for shift in completed_shifts:
-        master_id = shift.master.id
-        master_name = shift.master.name
 
-        if master_id not in masters_stats:
-            masters_stats[master_id] = {
-                'master_id': master_id,
-                'master_name': master_name,
-                'total_shifts': 0,
-                'total_completion': 0,
-                'shifts_details': []
-            }
+def get_shifts_statistics(date_from=None, date_to=None, master_id=None, page=1, page_size=20):
+    """
+    Статистика выполнения по мастерам. Читаются только сводные таблицы
+    (dashboard.rollups): итоги мастеров – из MasterStatistics (по месяцам,
+    а при фильтре по датам – по дням), shifts_details – страница ShiftSummary
+    каждого мастера (последние смены первыми). Время ответа не зависит
+    от объёма истории.
+    """
+    periods = MasterStatistics.objects.filter(
+        period=MasterStatistics.Period.DAY if date_from or date_to else MasterStatistics.Period.MONTH
+    )
+    summaries = ShiftSummary.objects.all()
+    if date_from:
+        periods = periods.filter(period_start__gte=date_from)
+        summaries = summaries.filter(start_time__date__gte=date_from)
+    if date_to:
+        periods = periods.filter(period_start__lte=date_to)
+        summaries = summaries.filter(start_time__date__lte=date_to)
+    if master_id:
+        periods = periods.filter(master_id=master_id)
+        summaries = summaries.filter(master_id=master_id)
 
-        tasks = ShiftTask.objects.filter(
-            shift=shift,
-            type=ShiftTask.TaskType.TASK
+    masters = {
+        master['master_id']: master
+        for master in periods.values('master_id', 'master__name').annotate(
+            total_shifts=Sum('shifts_count'),
+            completion_sum=Sum('completion_sum'),
+        )
+    }
+    if not (date_from or date_to):
+        # Смена без start_time не попадает ни в один период MasterStatistics,
+        # но без фильтра по датам входит в итоги мастера, как и раньше
+        undated = summaries.filter(start_time__isnull=True).values('master_id', 'master__name').annotate(
+            total_shifts=Count('shift'),
+            completion_sum=Sum('avg_completion'),
         )
+        for row in undated:
+            master = masters.setdefault(row['master_id'], {**row, 'total_shifts': 0, 'completion_sum': 0})
+            master['total_shifts'] += row['total_shifts']
+            master['completion_sum'] += row['completion_sum']
+
+    offset = (page - 1) * page_size
+    details = summaries.annotate(
+        row=Window(RowNumber(), partition_by=F('master_id'), order_by=F('start_time').desc(nulls_last=True)),
+    ).filter(row__gt=offset, row__lte=offset + page_size).order_by('master_id', 'row')
 
-        shift_completion = 0
-        valid_tasks = 0
-
-        for task in tasks:
-            if task.target and task.ready_value:
-                completion_percent = (task.ready_value / task.target) * 100
-                shift_completion += completion_percent
-                valid_tasks += 1
-
-        avg_shift_completion = round(shift_completion / valid_tasks, 2) if valid_tasks > 0 else 0
-
-        masters_stats[master_id]['total_shifts'] += 1
-        masters_stats[master_id]['total_completion'] += avg_shift_completion
-
-        masters_stats[master_id]['shifts_details'].append({
-            'shift_id': shift.id,
-            'start_time': shift.start_time,
-            'end_time': shift.end_time,
-            'avg_completion': avg_shift_completion,
-            'tasks_count': len(tasks),
-            'tasks_details': [
-                {
-                    'product_name': task.product.name if task.product else None,
-                    'target': task.target,
-                    'completed': task.ready_value,
-                    'completion_percent': round((task.ready_value / task.target * 100),
-                                                2) if task.target and task.ready_value else 0
-                }
-                for task in tasks
-            ]
+    shifts_by_master = defaultdict(list)
+    for summary in details:
+        shifts_by_master[summary.master_id].append({
+            'shift_id': summary.shift_id,
+            'start_time': summary.start_time,
+            'end_time': summary.end_time,
+            'avg_completion': round(summary.avg_completion, 2),
+            'tasks_count': summary.tasks_count,
+            'units_packed': summary.units_packed,
+            'run_seconds': summary.run_seconds,
+            'break_seconds': summary.break_seconds,
+            'tasks_details': summary.tasks_details,
         })
 
-    result = []
-    for master_stats in masters_stats.values():
-        master_stats['avg_completion'] = round(
-            master_stats['total_completion'] / master_stats['total_shifts']
-            if master_stats['total_shifts'] > 0 else 0,
-            2
+    return [
+        {
+            'master_id': master['master_id'],
+            'master_name': master['master__name'],
+            'total_shifts': master['total_shifts'],
+            'total_completion': round(master['completion_sum'], 2),
+            'avg_completion': round(master['completion_sum'] / master['total_shifts'], 2)
+            if master['total_shifts'] else 0,
+            'shifts_details': shifts_by_master.get(master['master_id'], []),
+        }
+        for master in sorted(masters.values(), key=lambda master: master['master__name'])
+    ]
+
+
+def get_throughput(shift_id=None, task_id=None, bucket=1):
+    """
+    Ряд выработки смены или задания: штук за интервал в bucket минут.
+    Для активной смены счётчики читаются из Redis (их увеличивает путь
+    упаковки), для завершённой – группировкой PackingLog по минутам в БД.
+    К ряду прилагается норма (norm_in_minute) для сравнения: для задания –
+    одно значение, для смены – нормы заданий с их интервалами.
+    """
+    if task_id is not None:
+        task = ShiftTask.objects.select_related('shift').get(id=task_id)
+        shift, tasks = task.shift, [task]
+        kind, object_id, logs = "task", task.id, PackingLog.objects.filter(task_id=task.id)
+        started_at, finished_at = task.started_at, task.finished_at
+    else:
+        shift = Shift.objects.get(id=shift_id)
+        tasks = list(shift.shifttask_set.filter(type=ShiftTask.TaskType.TASK).order_by('order'))
+        kind, object_id, logs = "shift", shift.id, PackingLog.objects.filter(shift_id=shift.id)
+        started_at, finished_at = shift.start_time, shift.end_time
+
+    if shift.status == Shift.Status.ACTIVE:
+        counts = RedisRepository().get_throughput(kind, object_id)
+    else:
+        counts = {
+            minute_bucket(row['minute']): row['units']
+            for row in logs.annotate(minute=TruncMinute('created_at')).values('minute')
+            .annotate(units=Count('id')).order_by()
+        }
+
+    first = minute_bucket(started_at) if started_at else min(counts, default=None)
+    last = minute_bucket(finished_at or timezone.now())
+    points = []
+    if first is not None:
+        last = max(last, max(counts, default=first))
+        # Не больше суток точек, остальное – укрупнением интервала
+        bucket = max(bucket, -(-(last - first + 1) // 1440))
+        for start in range(first, last + 1, bucket):
+            units = sum(counts.get(minute, 0) for minute in range(start, start + bucket))
+            points.append({
+                "time": datetime.fromtimestamp(start * 60, tz=dt_timezone.utc),
+                "units": units,
+                "rate": round(units / bucket, 2),
+            })
+
+    return {
+        "shift_id": shift.id,
+        "task_id": task_id,
+        "bucket": bucket,
+        "live": shift.status == Shift.Status.ACTIVE,
+        "norm_in_minute": tasks[0].norm_in_minute if task_id is not None else None,
+        "norms": [
+            {
+                "task_id": task.id,
+                "norm_in_minute": task.norm_in_minute,
+                "started_at": task.started_at,
+                "finished_at": task.finished_at,
+            }
+            for task in tasks
+        ],
+        "points": points,
+    }
+
+
+def ingest_packing_events(events, line=None):
+    """
+    Принимает пачку событий сканеров линии line [{sid, timestamp}, ...].
+    Активная смена линии и задание определяются один раз на пачку, строки
+    PackingLog пишутся одним bulk_create, счётчики в Redis увеличиваются
+    одним конвейером. Возвращает результат по каждому событию.
+    """
+    results = []
+    accepted = []
+    for index, event in enumerate(events):
+        serializer = PackingEventSerializer(data=event)
+        if serializer.is_valid():
+            accepted.append((index, serializer.validated_data))
+            results.append({"index": index, "accepted": True})
+        else:
+            results.append({"index": index, "accepted": False, "errors": serializer.errors})
+
+    if not accepted:
+        return results
+
+    shift_id = get_active_shift_id(line)
+    if not shift_id:
+        for index, _ in accepted:
+            results[index] = {"index": index, "accepted": False, "errors": ["No active shift found."]}
+        return results
+
+    redis = RedisRepository()
+    task_id = redis.get_active_task_id(shift_id)
+    now = timezone.now()
+    minutes = Counter(minute_bucket(data.get("timestamp") or now) for _, data in accepted)
+
+    if settings.PACKING_WRITE_BEHIND["ENABLED"]:
+        # Событие подтверждается сразу, в PackingLog его запишет flush_packing_events
+        events = [
+            {
+                "shift": shift_id,
+                "task": task_id or "",
+                "sid": data["sid"],
+                "created_at": (data.get("timestamp") or now).isoformat(),
+            }
+            for _, data in accepted
+        ]
+        redis.add_packed_units(shift_id, task_id, len(events), events=events, minutes=minutes)
+        for index, data in accepted:
+            results[index].update({"sid": data["sid"], "shift": shift_id, "task": task_id})
+        return results
+
+    logs = [
+        PackingLog(shift_id=shift_id, task_id=task_id, sid=data["sid"], created_at=data.get("timestamp") or now)
+        for _, data in accepted
+    ]
+    with transaction.atomic():
+        PackingLog.objects.bulk_create(logs)
+
+    redis.add_packed_units(shift_id, task_id, len(logs), minutes=minutes)
+
+    for (index, data), log in zip(accepted, logs):
+        results[index].update({"id": log.id, "sid": data["sid"], "shift": shift_id, "task": task_id})
+    return results
+
+
+def flush_packing_events(consumer=None, batch_size=None, claim_idle_ms=None):
+    """
+    Переносит пачку событий из буфера Redis в PackingLog.
+    Повторная доставка безопасна: события, чей sid уже записан для смены,
+    пропускаются. Пачки пишутся под packing_flush_lock, поэтому два
+    обработчика не вставят одни и те же события одновременно.
+    Возвращает число обработанных событий.
+    """
+    with packing_flush_lock():
+        return _flush_packing_batch(consumer, batch_size, claim_idle_ms)
+
+
+def _flush_packing_batch(consumer, batch_size, claim_idle_ms):
+    redis = RedisRepository()
+    consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+    entries = redis.read_packing_events(
+        consumer, batch_size or settings.PACKING_WRITE_BEHIND["BATCH_SIZE"], claim_idle_ms
+    )
+    if not entries:
+        return 0
+
+    events_by_shift = defaultdict(dict)
+    for _, fields in entries:
+        events_by_shift[int(fields["shift"])][int(fields["sid"])] = fields
+
+    logs = []
+    with transaction.atomic():
+        for shift_id, events in events_by_shift.items():
+            existing = set(
+                PackingLog.objects.filter(shift_id=shift_id, sid__in=events.keys()).values_list("sid", flat=True)
+            )
+            logs.extend(
+                PackingLog(
+                    shift_id=shift_id,
+                    task_id=fields.get("task") or None,
+                    sid=sid,
+                    created_at=parse_datetime(fields["created_at"]),
+                )
+                for sid, fields in events.items() if sid not in existing
+            )
+        PackingLog.objects.bulk_create(logs)
+
+    redis.ack_packing_events([entry_id for entry_id, _ in entries])
+    logging.info(f"Flushed {len(logs)} packing events ({len(entries) - len(logs)} duplicates skipped).")
+    return len(entries)
+
+
+def drain_packing_events():
+    """
+    Записывает в БД всё, что накопилось в буфере (при завершении смены).
+    Забираются и события, ещё не подтверждённые другими обработчиками, без
+    ожидания CLAIM_IDLE_MS: иначе они попали бы в PackingLog уже после
+    итогов смены. Пачку, которую обработчик уже пишет, packing_flush_lock
+    дождётся, поэтому забраны будут только действительно зависшие события.
+    """
+    redis = RedisRepository()
+    if not redis.has_packing_events():
+        return
+    while flush_packing_events(claim_idle_ms=0):
+        pass
+
+
+def task_from_state(task_data):
+    """ShiftTask с полями живого состояния из типизированного хэша Redis."""
+    return ShiftTask(
+        id=task_data["id"],
+        time_spent=task_data["time_spent"],
+        ready_value=task_data.get("ready_value") or None,
+        remaining_time=task_data.get("remaining_time"),
+        started_at=parse_time(task_data.get("started_at")),
+        finished_at=parse_time(task_data.get("finished_at")),
+        paused_at=parse_time(task_data.get("paused_at")),
+        paused_total=task_data.get("paused_total"),
+    )
+
+
+def checkpoint_shifts():
+    """
+    Контрольная точка: переносит в БД только те задания и смены, чьи хэши
+    в Redis изменились с прошлого раза (множество checkpoint:dirty).
+    Выполняется под блокировкой переходов смен и пишет только смены, которые
+    всё ещё ACTIVE: иначе прочитанное до finalize_shifts состояние затёрло бы
+    итоговое. Если разбор или запись не удались, ключи возвращаются в множество.
+    """
+    redis = RedisRepository()
+    with shift_lifecycle_lock():
+        keys = redis.pop_dirty_keys()
+        if not keys:
+            return 0
+        try:
+            tasks, shifts = _checkpoint_objects(keys, redis.read_hashes(keys))
+            with transaction.atomic():
+                active = set(Shift.objects.filter(
+                    id__in={task.shift_id for task in tasks} | {shift.id for shift in shifts},
+                    status=Shift.Status.ACTIVE,
+                ).values_list("id", flat=True))
+                tasks = [task for task in tasks if task.shift_id in active]
+                shifts = [shift for shift in shifts if shift.id in active]
+                ShiftTask.objects.bulk_update(tasks, TASK_CHECKPOINT_FIELDS)
+                Shift.objects.bulk_update(shifts, ["active_task"])
+        except Exception:
+            redis.mark_dirty(*keys)
+            raise
+    logging.info(f"Checkpoint: {len(tasks)} tasks, {len(shifts)} shifts.")
+    return len(tasks) + len(shifts)
+
+
+def _checkpoint_objects(keys, hashes):
+    """Задания и смены для контрольной точки; неполные хэши (без id и смены) пропускаются."""
+    now = timezone.now()
+    tasks, shifts = [], []
+    for key, data in zip(keys, hashes):
+        kind, _, object_id = key.partition(":")
+        if kind == "task" and data.get("id") and data.get("shift"):
+            task = task_from_state(with_timers(typed_fields(data), now))
+            task.shift_id = int(data["shift"])
+            tasks.append(task)
+        elif kind == "shift" and data.get("id"):
+            shifts.append(Shift(id=int(object_id), active_task=int(data.get("active_task") or 0)))
+        elif data:
+            logging.warning(f"Checkpoint: skipping partial hash {key}: {sorted(data)}")
+    return tasks, shifts
+
+
+def start_planned_shift(shift_id):
+    """
+    Запускает запланированную смену, завершив активные смены её линии.
+    Возвращает False, если смена уже не запланирована (начата, отменена, удалена).
+    """
+    with shift_lifecycle_lock():
+        # Проверка под блокировкой: смену, запущенную движком и сверкой одновременно, запустит один
+        shift = Shift.objects.filter(id=shift_id, status=Shift.Status.PLANNED).select_related(
+            'master', 'line').first()
+        if not shift:
+            return False
+        Shift.end_active_shifts(line_id=shift.line_id)
+        shift.start_shift()
+    return True
+
+
+def restore_shift_state(shift_id):
+    """
+    Восстанавливает живое состояние активной смены в Redis из последней
+    контрольной точки в БД (после вытеснения ключей или перезапуска Redis).
+    """
+    shift = Shift.objects.filter(id=shift_id, status=Shift.Status.ACTIVE).select_related('line').first()
+    if not shift:
+        return False
+    tasks = list(shift.shifttask_set.select_related('product', 'packing').order_by('order', 'id'))
+    RedisRepository().seed_shift(shift, tasks)
+    logging.warning(f"[SHIFT {shift_id}] Restored {len(tasks)} tasks in Redis from the last checkpoint.")
+    return bool(tasks)
+
+
+def finalize_shifts(shift_ids):
+    """
+    Завершает смены и переносит живое состояние заданий из Redis в ShiftTask.
+    Состояние всех смен читается одним конвейером, задания пишутся одним
+    bulk_update в транзакции вместе со статусом смен и сводками статистики
+    (dashboard.rollups), и только после фиксации ключи Redis удаляются
+    одной командой. Выполняется под блокировкой переходов смен, поэтому
+    одновременные завершения (движок, сверка, другой воркер) не пересекаются:
+    второй вызов увидит смены уже завершёнными и ничего не сделает.
+    """
+    with shift_lifecycle_lock():
+        shift_ids = list(
+            Shift.objects.filter(id__in=list(shift_ids), status=Shift.Status.ACTIVE).values_list('id', flat=True)
         )
-        result.append(master_stats)
+        if not shift_ids:
+            return
+        drain_packing_events()
+        redis = RedisRepository()
+        snapshots = redis.get_shift_snapshots(shift_ids)
+
+        tasks = [
+            task_from_state(task_data)
+            for snapshot in snapshots.values() if snapshot
+            for task_data in snapshot["tasks"]
+        ]
+
+        with transaction.atomic():
+            Shift.objects.filter(id__in=shift_ids, status=Shift.Status.ACTIVE).update(
+                status=Shift.Status.COMPLETED, end_time=timezone.now()
+            )
+            ShiftTask.objects.bulk_update(tasks, TASK_STATE_FIELDS)
+            summarize_shifts(shift_ids)
+
+        forget_active_shifts(shift_ids)
+        redis.delete_shift_state(shift_ids, [task.id for task in tasks])
+    logging.info(f"[SHIFT {', '.join(map(str, shift_ids))}] Finalized, {len(tasks)} tasks flushed.")
+
+
+def sweep_live_state():
+    """
+    Удаляет из Redis забытое живое состояние: ключи смен, которые уже не
+    активны, и задания, чья смена не активна или чей хэш потерян. Такие
+    ключи остаются после сбоя между фиксацией в БД и удалением в
+    finalize_shifts или после ручной правки смен. Выполняется под
+    блокировкой переходов смен, чтобы не задеть смену, которая как раз
+    запускается. Возвращает число удалённых ключей.
+    """
+    with shift_lifecycle_lock():
+        redis = RedisRepository()
+        live = redis.live_keys()
+        active_ids = set(Shift.objects.filter(status=Shift.Status.ACTIVE).values_list('id', flat=True))
 
-    return result
+        keys = [key for shift_id, shift_keys in live["shift"].items() if shift_id not in active_ids
+                for key in shift_keys]
+        owners = redis.task_shift_ids(live["task"])
+        keys += [key for task_id, task_keys in live["task"].items() if owners[task_id] not in active_ids
+                 for key in task_keys]
+        redis.delete_keys(keys)
+    if keys:
+        logging.warning(f"Swept {len(keys)} orphaned live state keys from Redis.")
+    return len(keys)
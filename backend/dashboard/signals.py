@@ -0,0 +1,45 @@
+import logging
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from dashboard.models import DefaultSettings, Line, Packing, Shift
+from dashboard.repos.redis_repository import RedisRepository
+
+
+@receiver(post_save, sender=DefaultSettings)
+@receiver(post_delete, sender=DefaultSettings)
+def default_settings_changed(sender, **kwargs):
+    """Сбрасывает кэш настроек и пересчитывает сохранённые нормы упаковок."""
+    DefaultSettings.invalidate_cache()
+    Packing.recompute_norms()
+
+
+@receiver(post_delete, sender=Line)
+def line_deleted(sender, **kwargs):
+    Line.invalidate_cache()
+
+
+def _update_schedule(callback):
+    # Ошибку Redis не пробрасываем: сверка check_and_start_shifts восстановит очередь
+    try:
+        callback()
+    except Exception:
+        logging.exception("Shift schedule update error")
+
+
+def schedule_after_commit(shifts):
+    """Ставит смены в очередь автозапуска или убирает из неё после фиксации транзакции."""
+    transaction.on_commit(lambda: _update_schedule(lambda: RedisRepository().schedule_shifts(shifts)))
+
+
+@receiver(post_save, sender=Shift)
+def shift_saved(sender, instance, **kwargs):
+    schedule_after_commit([instance])
+
+
+@receiver(post_delete, sender=Shift)
+def shift_deleted(sender, instance, **kwargs):
+    transaction.on_commit(lambda: _update_schedule(lambda: RedisRepository().unschedule_shifts([instance.id])))
+
@@ -0,0 +1,82 @@
+"""
+Выборочные подписки веб-сокетов.
+
+Без подписки соединение получает все обновления смены с полными данными
+и номерами версий (пульт мастера). Клиент может сузить поток сообщением
+{"action": "subscribe", "events": [...], "fields": [...], "rate": 0.5}:
+- events – какие события присылать (update, finish, pause, resume,
+  new_task, completed, behind_norm, ...), по умолчанию все;
+- fields – какие поля задания оставлять в данных (id остаётся всегда),
+  по умолчанию все;
+- rate – не больше стольких обновлений update в секунду; промежуточные
+  обновления одного задания сливаются в одно.
+Так настенные табло получают только счётчики текущего задания и не чаще,
+чем успевают показать. {"action": "subscribe"} без параметров возвращает
+полный поток.
+"""
+
+# Поля, которые остаются в данных задания при любом наборе fields
+ALWAYS_FIELDS = {"id"}
+
+MAX_RATE = 100
+
+
+class Subscription:
+    def __init__(self, events=None, fields=None, rate=None):
+        self.events = set(events) if events is not None else None
+        self.fields = set(fields) | ALWAYS_FIELDS if fields is not None else None
+        self.rate = rate
+
+    @classmethod
+    def parse(cls, data):
+        """Подписка из сообщения клиента; ValueError при неверных параметрах."""
+        events, fields, rate = data.get("events"), data.get("fields"), data.get("rate")
+        for name, value in (("events", events), ("fields", fields)):
+            if value is not None and (
+                    not isinstance(value, list) or not all(isinstance(item, str) for item in value)):
+                raise ValueError(f"'{name}' must be a list of strings")
+        if rate is not None:
+            if isinstance(rate, bool) or not isinstance(rate, (int, float)) or not 0 < rate <= MAX_RATE:
+                raise ValueError(f"'rate' must be a number of updates per second from 0 to {MAX_RATE}")
+        return cls(events, fields, rate)
+
+    @property
+    def is_full(self):
+        """Полный поток: всё без фильтров, с номерами версий."""
+        return self.events is None and self.fields is None and self.rate is None
+
+    @property
+    def interval(self):
+        """Минимальный промежуток между обновлениями update в секундах."""
+        return 1 / self.rate if self.rate else 0
+
+    def as_dict(self):
+        return {
+            "events": sorted(self.events) if self.events is not None else None,
+            "fields": sorted(self.fields) if self.fields is not None else None,
+            "rate": self.rate,
+        }
+
+    def wants(self, event):
+        return self.events is None or event in self.events
+
+    def filter_task(self, data):
+        if self.fields is None or not data:
+            return data
+        return {field: value for field, value in data.items() if field in self.fields}
+
+    def apply(self, message):
+        """
+        Сообщение для клиента с оставленными полями задания или None, если
+        событие не нужно или в обновлении не осталось полей.
+        """
+        if not self.wants(message.get("event")):
+            return None
+        data = message.get("data")
+        if message.get("type") == "task_update":
+            data = self.filter_task(data)
+            if message.get("event") == "update" and not set(data or {}) - ALWAYS_FIELDS:
+                return None
+        elif message.get("event") == "new_task" and data:
+            data = {**data, "task": self.filter_task(data.get("task"))}
+        return {**message, "data": data}
@@ -0,0 +1,1121 @@
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+
+import redis
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management import call_command
+from django.contrib.auth.models import User
+from django.db import DatabaseError, connection
+from django.db.models import Count
+from django.db.models.functions import TruncMinute
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from dashboard import active_shift
+from dashboard.broadcast import ShiftBroadcaster, version_key
+from dashboard.consumers import ShiftConsumer
+from dashboard.engine import ShiftEngine, ShiftState
+from dashboard.locks import LIFECYCLE_LOCK_KEY, PACKING_FLUSH_LOCK_KEY, LockTimeout, ShiftLockTimeout
+from dashboard.models import DefaultSettings, Line, Master, MasterStatistics, Packing, PackingLog, Product, Shift, \
+    ShiftSummary, ShiftTask
+from dashboard.repos import connection as redis_connection
+from dashboard.repos.redis_repository import ACTIVE_SHIFT_REFILL_TTL, ADVANCE_TASK_SCRIPT, CHECKPOINT_DIRTY_KEY, \
+    METRICS_SCRIPT, PACKING_GROUP, PACKING_LOOKUP_KEY, PACKING_STREAM, PRODUCT_LOOKUP_KEY, RELEASE_LEASE_SCRIPT, \
+    RENEW_LEASE_SCRIPT, SHIFT_SCHEDULE_KEY, SHIFT_SNAPSHOT_SCRIPT, TASK_SCRIPT, RedisRepository, active_shift_key, \
+    lease_key, metrics_args, minute_bucket, throughput_key
+from dashboard.rollups import rebuild_rollups, summarize_shifts
+from dashboard.serializers import ShiftSerializer
+from dashboard.services import checkpoint_shifts, drain_packing_events, finalize_shifts, flush_packing_events, \
+    get_shifts_statistics, get_throughput, restore_shift_state, start_planned_shift, sweep_live_state
+from dashboard.subscriptions import Subscription
+from dashboard.timers import to_epoch
+from dashboard.views import PackingLogViewSet, ShiftLiveView
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+def make_shift(status=Shift.Status.COMPLETED, **fields):
+    user, _ = User.objects.get_or_create(username='operator')
+    master, _ = Master.objects.get_or_create(name='Мастер')
+    return Shift.objects.create(user_starts=user, master=master, status=status, **fields)
+
+
+@skipUnless(fakeredis, "Redis tests need fakeredis[lua] from req-test.txt")
+class RedisTestCase(TestCase):
+    """Тесты с живым состоянием: общий пул соединений подменяется пулом на fakeredis."""
+
+    def setUp(self):
+        super().setUp()
+        self.server = fakeredis.FakeServer()
+        pool = redis.ConnectionPool(
+            connection_class=fakeredis.FakeConnection, server=self.server, decode_responses=True
+        )
+        previous = redis_connection._pool
+        redis_connection._pool = pool
+        self.addCleanup(setattr, redis_connection, "_pool", previous)
+        self.redis = redis_connection.get_redis()
+
+    def seed(self, shift):
+        shift = Shift.objects.select_related('line').get(id=shift.id)
+        tasks = list(shift.shifttask_set.select_related('product', 'packing').order_by('order', 'id'))
+        RedisRepository().seed_shift(shift, tasks)
+        return tasks
+
+
+class HotQueryIndexTests(TestCase):
+    """Горячие запросы должны идти по индексам из миграции 0018, а не полным просмотром таблиц."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        if connection.vendor == 'postgresql':
+            # На пустых таблицах PostgreSQL предпочитает Seq Scan
+            with connection.cursor() as cursor:
+                cursor.execute("SET enable_seqscan = off")
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan, f"Index {index_name} is not used:\n{plan}")
+
+    def test_active_shift_lookup(self):
+        queryset = Shift.objects.filter(status=Shift.Status.ACTIVE).order_by('-start_time')[:1]
+        self.assertUsesIndex(queryset, 'shift_status_start_idx')
+
+    def test_line_active_shift_lookup(self):
+        queryset = Shift.objects.filter(line_id=1, status=Shift.Status.ACTIVE).order_by('-start_time')[:1]
+        self.assertUsesIndex(queryset, 'shift_line_status_start_idx')
+
+    def test_planned_shifts_due(self):
+        queryset = Shift.objects.filter(
+            status='PLANNED',
+            planned_start_time__lte=timezone.now()
+        ).order_by('planned_start_time')
+        self.assertUsesIndex(queryset, 'shift_planned_start_idx')
+
+    def test_shift_tasks_by_type(self):
+        queryset = ShiftTask.objects.filter(shift_id=1, type=ShiftTask.TaskType.TASK).order_by('order')
+        self.assertUsesIndex(queryset, 'shifttask_shift_type_idx')
+
+    def test_shift_packing_log_by_time(self):
+        queryset = PackingLog.objects.filter(shift_id=1).order_by('-created_at')
+        self.assertUsesIndex(queryset, 'packinglog_shift_created_idx')
+
+    def test_task_throughput(self):
+        queryset = PackingLog.objects.filter(task_id=1).annotate(
+            minute=TruncMinute('created_at')
+        ).values('minute').annotate(units=Count('id')).order_by()
+        self.assertUsesIndex(queryset, 'packinglog_task_created_idx')
+
+    def test_packing_flush_dedupe(self):
+        queryset = PackingLog.objects.filter(shift_id=1, sid__in=[1, 2, 3]).values_list('sid', flat=True)
+        self.assertUsesIndex(queryset, 'packinglog_shift_sid_idx')
+
+
+
+class DefaultLineTests(TestCase):
+    """Основная линия подставляется в Shift без запроса к БД на каждый экземпляр."""
+
+    def test_default_line_id_is_cached(self):
+        Line.invalidate_cache()
+        self.addCleanup(Line.invalidate_cache)
+        line_id = Shift().line_id
+        with self.assertNumQueries(0):
+            self.assertEqual(Shift(id=1).line_id, line_id)
+        self.assertEqual(Line.objects.get(code=Line.DEFAULT_CODE).id, line_id)
+
+    def test_deleting_default_line_resets_cache(self):
+        Line.default_id()
+        self.addCleanup(Line.invalidate_cache)
+        Line.objects.filter(code=Line.DEFAULT_CODE).delete()
+        line_id = Line.default_id()
+        self.assertTrue(Line.objects.filter(id=line_id, code=Line.DEFAULT_CODE).exists())
+
+
+class DefaultSettingsCacheTests(TestCase):
+    """Длительность смены читается из БД один раз; сохранение настроек сбрасывает кэш и пересчитывает нормы."""
+
+    def setUp(self):
+        DefaultSettings.invalidate_cache()
+        self.addCleanup(DefaultSettings.invalidate_cache)
+
+    def test_duration_is_cached(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(DefaultSettings.get_shift_duration_in_minute(), 480)
+            self.assertEqual(DefaultSettings.get_shift_duration_in_minute(), 480)
+            Packing.compute_norm_in_minute(960)
+
+    def test_saving_settings_resets_cache_and_recomputes_norms(self):
+        packing = Packing.objects.create(value=1, norm=960)
+        self.assertEqual(packing.norm_in_minute, 2)
+
+        DefaultSettings.objects.create(shift_duration_in_minute=240)
+        self.assertEqual(DefaultSettings.get_shift_duration_in_minute(), 240)
+        packing.refresh_from_db()
+        self.assertEqual(packing.norm_in_minute, 4)
+
+class SubscriptionTests(SimpleTestCase):
+    """Выборочные подписки веб-сокетов (dashboard.subscriptions)."""
+
+    def test_default_is_full_stream(self):
+        subscription = Subscription.parse({"action": "subscribe"})
+        message = {"type": "task_update", "event": "update", "task_id": 1, "version": 3, "data": {"rate": 2}}
+        self.assertTrue(subscription.is_full)
+        self.assertEqual(subscription.apply(message), message)
+
+    def test_filters_events_and_fields(self):
+        subscription = Subscription.parse({"events": ["update", "new_task"], "fields": ["ready_value"]})
+        self.assertEqual(
+            subscription.apply({"type": "task_update", "event": "update", "task_id": 1,
+                                "data": {"id": 1, "ready_value": 5, "rate": 2.5}})["data"],
+            {"id": 1, "ready_value": 5},
+        )
+        self.assertIsNone(subscription.apply({"type": "task_update", "event": "update", "task_id": 1,
+                                              "data": {"rate": 2.5}}))
+        self.assertIsNone(subscription.apply({"type": "shift_update", "event": "behind_norm", "data": {}}))
+        new_task = subscription.apply({"type": "shift_update", "event": "new_task",
+                                       "data": {"shift": {"id": 1}, "task": {"id": 2, "target": 10}}})
+        self.assertEqual(new_task["data"]["task"], {"id": 2})
+
+    def test_rate_interval(self):
+        self.assertEqual(Subscription.parse({"rate": 0.5}).interval, 2)
+
+    def test_rejects_invalid_parameters(self):
+        for data in ({"rate": 0}, {"rate": "fast"}, {"events": "update"}, {"fields": [1]}):
+            with self.assertRaises(ValueError):
+                Subscription.parse(data)
+
+
+
+class ShiftConsumerReceiveTests(SimpleTestCase):
+    """Входящие сообщения веб-сокета: ошибка в ответ вместо разрыва соединения."""
+
+    def receive(self, text_data):
+        consumer = ShiftConsumer()
+        consumer.send = mock.AsyncMock()
+        async_to_sync(consumer.receive)(text_data)
+        return [json.loads(call.kwargs["text_data"]) for call in consumer.send.await_args_list]
+
+    def test_malformed_frames_get_error(self):
+        for text_data in ("not json", "[1, 2]", "null", None):
+            with self.subTest(text_data=text_data):
+                replies = self.receive(text_data)
+                self.assertEqual(len(replies), 1)
+                self.assertEqual(replies[0]["type"], "error")
+                self.assertIsNone(replies[0]["action"])
+
+    def test_bad_subscription_gets_error(self):
+        replies = self.receive(json.dumps({"action": "subscribe", "rate": -1}))
+        self.assertEqual(replies[0]["type"], "error")
+        self.assertEqual(replies[0]["action"], "subscribe")
+
+class RollupTests(TestCase):
+    """Сводки статистики пишутся при завершении смены и совпадают с полной пересборкой."""
+
+    def make_completed_shift(self, day):
+        start = datetime(2024, 3, day, 8, tzinfo=dt_timezone.utc)
+        shift = make_shift(start_time=start, end_time=start.replace(hour=16))
+        task = ShiftTask.objects.create(shift=shift, order=0, target=100, ready_value=50, time_spent=3600)
+        ShiftTask.objects.create(shift=shift, order=1, target=10, ready_value=10, time_spent=600)
+        ShiftTask.objects.create(shift=shift, order=2, type=ShiftTask.TaskType.BREAK, remaining_time=10,
+                                 time_spent=600)
+        PackingLog.objects.bulk_create([PackingLog(shift=shift, task=task, sid=sid) for sid in range(3)])
+        return shift
+
+    def test_summarize_shift(self):
+        shift = self.make_completed_shift(5)
+        summarize_shifts([shift.id])
+
+        summary = ShiftSummary.objects.get(shift=shift)
+        self.assertEqual(summary.avg_completion, 75)
+        self.assertEqual(summary.units_packed, 3)
+        self.assertEqual(summary.tasks_count, 2)
+        self.assertEqual(summary.run_seconds, 4200)
+        self.assertEqual(summary.break_seconds, 600)
+        day = MasterStatistics.objects.get(period=MasterStatistics.Period.DAY)
+        self.assertEqual((day.shifts_count, day.units_packed), (1, 3))
+
+    def test_incremental_matches_rebuild(self):
+        for day in (4, 5, 12):
+            summarize_shifts([self.make_completed_shift(day).id])
+
+        def snapshot():
+            return sorted(MasterStatistics.objects.values_list(
+                'period', 'period_start', 'shifts_count', 'completion_sum', 'units_packed', 'run_seconds'))
+
+        incremental = snapshot()
+        rebuild_rollups()
+        self.assertEqual(snapshot(), incremental)
+        month = MasterStatistics.objects.get(period=MasterStatistics.Period.MONTH)
+        self.assertEqual(month.shifts_count, 3)
+
+    def test_statistics_include_undated_shifts(self):
+        dated = self.make_completed_shift(5)
+        undated = make_shift()
+        ShiftTask.objects.create(shift=undated, order=0, target=100, ready_value=25)
+        summarize_shifts([dated.id, undated.id])
+
+        master, = get_shifts_statistics()
+        self.assertEqual((master['total_shifts'], master['total_completion'], master['avg_completion']), (2, 100, 50))
+        self.assertEqual([shift['shift_id'] for shift in master['shifts_details']], [dated.id, undated.id])
+        # Фильтр по датам отбрасывает смену без start_time
+        master, = get_shifts_statistics(date_from=datetime(2024, 3, 1).date())
+        self.assertEqual((master['total_shifts'], master['total_completion']), (1, 75))
+
+
+class CheckpointRestoreTests(RedisTestCase):
+    """Контрольная точка и восстановление живого состояния из БД."""
+
+    def test_break_survives_checkpoint_and_restore(self):
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        task = ShiftTask.objects.create(shift=shift, order=0, type=ShiftTask.TaskType.BREAK, remaining_time=10)
+        self.seed(shift)
+        started = timezone.now() - timedelta(minutes=5)
+        RedisRepository().mark_dirty(f"task:{task.id}")
+        self.redis.hset(f"task:{task.id}", "started_at", to_epoch(started))
+
+        checkpoint_shifts()
+        task.refresh_from_db()
+        # Плановая длительность перерыва (минуты) не затирается остатком в секундах
+        self.assertEqual(task.remaining_time, 10)
+        self.assertAlmostEqual(task.started_at.timestamp(), started.timestamp(), places=2)
+
+        self.redis.flushall()
+        self.assertTrue(restore_shift_state(shift.id))
+        restored = RedisRepository().get_task(task.id)
+        self.assertEqual(restored["duration"], "600")
+        self.assertAlmostEqual(restored["remaining_time"], 300, delta=2)
+
+    def test_task_counters_survive_checkpoint_and_restore(self):
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        task = ShiftTask.objects.create(shift=shift, order=0, target=100)
+        self.seed(shift)
+        self.redis.hset(f"task:{task.id}", mapping={"ready_value": 7, "started_at": to_epoch(timezone.now())})
+        self.redis.hset(f"shift:{shift.id}", "active_task", 0)
+        RedisRepository().mark_dirty(f"task:{task.id}", f"shift:{shift.id}")
+
+        checkpoint_shifts()
+        self.redis.flushall()
+        restore_shift_state(shift.id)
+
+        restored = RedisRepository().get_task(task.id)
+        self.assertEqual(restored["ready_value"], "7")
+        self.assertEqual(restored["target"], "100")
+
+
+    def test_checkpoint_does_not_overwrite_finalized_shift(self):
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        task = ShiftTask.objects.create(shift=shift, order=0, target=100)
+        self.seed(shift)
+        self.redis.hset(f"task:{task.id}", mapping={"ready_value": 3, "started_at": to_epoch(timezone.now())})
+        RedisRepository().mark_dirty(f"task:{task.id}")
+        read_hashes = RedisRepository.read_hashes
+
+        def finalized_after_read(repository, keys):
+            # Смену завершили, пока контрольная точка держала прочитанные хэши
+            hashes = read_hashes(repository, keys)
+            self.redis.hset(f"task:{task.id}", "ready_value", 7)
+            finalize_shifts([shift.id])
+            return hashes
+
+        with mock.patch.object(RedisRepository, 'read_hashes', autospec=True, side_effect=finalized_after_read):
+            checkpoint_shifts()
+
+        task.refresh_from_db()
+        self.assertEqual(task.ready_value, 7)
+
+    def test_partial_hash_does_not_lose_other_updates(self):
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        task = ShiftTask.objects.create(shift=shift, order=0, target=100)
+        self.seed(shift)
+        self.redis.hset(f"task:{task.id}", "ready_value", 5)
+        # Осиротевший хэш без id и смены
+        self.redis.hset("task:999", "ready_value", 1)
+        RedisRepository().mark_dirty(f"task:{task.id}", "task:999")
+
+        checkpoint_shifts()
+
+        task.refresh_from_db()
+        self.assertEqual(task.ready_value, 5)
+
+    def test_failed_checkpoint_keeps_dirty_keys(self):
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        task = ShiftTask.objects.create(shift=shift, order=0, target=100)
+        self.seed(shift)
+        RedisRepository().mark_dirty(f"task:{task.id}")
+
+        with mock.patch.object(ShiftTask.objects, 'bulk_update', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                checkpoint_shifts()
+
+        self.assertIn(f"task:{task.id}", self.redis.smembers(CHECKPOINT_DIRTY_KEY))
+
+    def test_finalize_flushes_live_state(self):
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        task = ShiftTask.objects.create(shift=shift, order=0, target=100)
+        pause = ShiftTask.objects.create(shift=shift, order=1, type=ShiftTask.TaskType.BREAK, remaining_time=10)
+        self.seed(shift)
+        started = timezone.now() - timedelta(minutes=4)
+        self.redis.hset(f"task:{task.id}", mapping={"ready_value": 7, "started_at": to_epoch(started)})
+        self.redis.hset(f"task:{pause.id}", "started_at", to_epoch(started))
+
+        finalize_shifts([shift.id])
+
+        shift.refresh_from_db()
+        task.refresh_from_db()
+        pause.refresh_from_db()
+        self.assertEqual(shift.status, Shift.Status.COMPLETED)
+        self.assertEqual(task.ready_value, 7)
+        self.assertAlmostEqual(task.time_spent, 240, delta=2)
+        # В завершённой смене remaining_time – остаток перерыва в секундах
+        self.assertAlmostEqual(pause.remaining_time, 360, delta=2)
+        self.assertTrue(ShiftSummary.objects.filter(shift=shift).exists())
+        self.assertFalse(self.redis.exists(f"shift:{shift.id}", f"task:{task.id}", f"shift:{shift.id}:tasks"))
+
+@skipUnless(fakeredis, "Redis tests need fakeredis[lua] from req-test.txt")
+class BulkShiftCreateTests(RedisTestCase):
+    """Планирование нескольких смен одним запросом (BulkShiftSerializer)."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='planner')
+        self.master = Master.objects.create(name='Мастер')
+        self.product = Product.objects.create(name='Олія')
+        self.packing = Packing.objects.create(value=1, norm=480)
+
+    def create(self, payload):
+        serializer = ShiftSerializer(data=payload, many=True, context={'request': SimpleNamespace(user=self.user)})
+        serializer.is_valid(raise_exception=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            return serializer.save()
+
+    def test_payload_with_norm_in_minute(self):
+        shifts = self.create([
+            {
+                "master": self.master.id,
+                "planned_start_time": "2024-03-05T08:00:00Z",
+                "tasks": [
+                    {"type": "TASK", "product": self.product.id, "packing": self.packing.id, "target": 100,
+                     "order": 0, "norm_in_minute": 99},
+                    {"type": "BREAK", "remaining_time": 10, "order": 1, "norm_in_minute": 2},
+                ],
+            },
+            {"master": self.master.id, "planned_start_time": "2024-03-06T08:00:00Z"},
+        ])
+
+        self.assertEqual(len(shifts), 2)
+        task, pause = ShiftTask.objects.filter(shift=shifts[0]).order_by('order')
+        # Норма задания с упаковкой берётся из упаковки, как в ShiftTask.save
+        self.assertEqual(task.norm_in_minute, self.packing.norm_in_minute)
+        self.assertEqual(pause.norm_in_minute, 2)
+        self.assertFalse(ShiftTask.objects.filter(shift=shifts[1]).exists())
+        self.assertEqual(self.redis.zcard(SHIFT_SCHEDULE_KEY), 2)
+
+    def test_schedule_error_is_logged(self):
+        # Очередь автозапуска пишется после фиксации; ошибка Redis не должна ломать запрос
+        with mock.patch.object(RedisRepository, 'schedule_shifts', side_effect=redis.ConnectionError), \
+                self.assertLogs(level='ERROR') as logs:
+            shifts = self.create([{"master": self.master.id, "planned_start_time": "2024-03-05T08:00:00Z"}])
+        self.assertEqual(len(shifts), 1)
+        self.assertIn("Shift schedule update error", logs.output[0])
+
+
+
+@skipUnless(fakeredis, "Redis tests need fakeredis[lua] from req-test.txt")
+class ActiveShiftCacheTests(RedisTestCase):
+    """Кэш активной смены линии: заполнение из БД не затирает записи старта и завершения."""
+
+    def setUp(self):
+        super().setUp()
+        active_shift._cache.clear()
+        self.addCleanup(active_shift._cache.clear)
+        self.key = active_shift_key(Line.DEFAULT_CODE)
+
+    def test_miss_is_refilled_from_db_briefly(self):
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+
+        self.assertEqual(active_shift.get_active_shift_id(), shift.id)
+        self.assertEqual(json.loads(self.redis.get(self.key))["id"], shift.id)
+        self.assertLessEqual(self.redis.ttl(self.key), ACTIVE_SHIFT_REFILL_TTL)
+
+    def test_refill_does_not_overwrite_newer_snapshot(self):
+        make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        newer = make_shift(status=Shift.Status.PLANNED)
+        original = RedisRepository.get_active_shift
+        misses = iter([(False, None)])
+
+        def miss_then_start(repository, line):
+            # Промах читает БД, а в это время стартует новая смена и пишет свой снимок
+            miss = next(misses, None)
+            if miss:
+                RedisRepository().set_active_shift(line, {"id": newer.id, "line": line})
+                return miss
+            return original(repository, line)
+
+        with mock.patch.object(RedisRepository, 'get_active_shift', autospec=True, side_effect=miss_then_start):
+            self.assertEqual(active_shift.get_active_shift_id(), newer.id)
+
+        self.assertEqual(json.loads(self.redis.get(self.key))["id"], newer.id)
+        self.assertGreater(self.redis.ttl(self.key), ACTIVE_SHIFT_REFILL_TTL)
+
+
+@skipUnless(fakeredis, "Redis tests need fakeredis[lua] from req-test.txt")
+class PackingWriteBehindTests(RedisTestCase):
+    """Отложенная запись PackingLog из буфера packing:events."""
+
+    def setUp(self):
+        super().setUp()
+        self.shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        self.task = ShiftTask.objects.create(shift=self.shift, order=0, target=100)
+        self.seed(self.shift)
+
+    def buffer(self, *sids):
+        events = [
+            {"shift": self.shift.id, "task": self.task.id, "sid": sid, "created_at": timezone.now().isoformat()}
+            for sid in sids
+        ]
+        RedisRepository().add_packed_units(self.shift.id, self.task.id, len(events), events=events)
+
+    def test_flush_skips_redelivered_events(self):
+        self.buffer(1, 2)
+        self.assertEqual(flush_packing_events(), 2)
+        self.buffer(2)
+        self.assertEqual(flush_packing_events(), 1)
+
+        self.assertEqual(sorted(PackingLog.objects.values_list('sid', flat=True)), [1, 2])
+        self.assertEqual(self.redis.xlen(PACKING_STREAM), 0)
+
+    def test_drain_takes_events_pending_at_other_worker(self):
+        self.buffer(1, 2, 3)
+        # Обработчик забрал события и ещё не подтвердил их
+        RedisRepository().read_packing_events("other-worker", 10)
+        self.assertEqual(flush_packing_events(), 0)
+
+        drain_packing_events()
+
+        self.assertEqual(PackingLog.objects.filter(shift=self.shift).count(), 3)
+        self.assertEqual(self.redis.xpending(PACKING_STREAM, PACKING_GROUP)["pending"], 0)
+
+    def test_flushes_do_not_overlap(self):
+        self.buffer(1, 2)
+        # Другой обработчик пишет пачку: пока он держит блокировку, вторая запись ждёт
+        other = self.redis.lock(PACKING_FLUSH_LOCK_KEY, timeout=60)
+        self.assertTrue(other.acquire())
+        with self.settings(PACKING_WRITE_BEHIND={**settings.PACKING_WRITE_BEHIND, "LOCK_TIMEOUT": 0.05}):
+            with self.assertRaises(LockTimeout):
+                drain_packing_events()
+        self.assertFalse(PackingLog.objects.exists())
+
+        other.release()
+        drain_packing_events()
+        self.assertEqual(PackingLog.objects.count(), 2)
+
+
+@skipUnless(fakeredis, "Redis tests need fakeredis[lua] from req-test.txt")
+class ScheduleReconcileTests(RedisTestCase):
+    """Сверка очереди автозапуска shifts:schedule с БД."""
+
+    def at(self, hour):
+        return datetime(2024, 3, 5, hour, tzinfo=dt_timezone.utc)
+
+    def test_queue_follows_db(self):
+        self.redis.zadd(SHIFT_SCHEDULE_KEY, {1: self.at(8).timestamp(), 2: self.at(9).timestamp()})
+        repository = RedisRepository()
+
+        repository.reconcile_schedule(repository.get_schedule(), {2: self.at(10), 3: self.at(11)})
+
+        self.assertEqual(repository.get_schedule(), {2: self.at(10).timestamp(), 3: self.at(11).timestamp()})
+
+    def test_shift_scheduled_during_reconcile_is_kept(self):
+        repository = RedisRepository()
+        scheduled = repository.get_schedule()
+        # Пока сверка читала БД, спланировали новую смену
+        self.redis.zadd(SHIFT_SCHEDULE_KEY, {5: self.at(8).timestamp()})
+
+        repository.reconcile_schedule(scheduled, {})
+
+        self.assertEqual(repository.get_schedule(), {5: self.at(8).timestamp()})
+
+
+@skipUnless(fakeredis, "Redis tests need fakeredis[lua] from req-test.txt")
+class ShiftBroadcasterTests(RedisTestCase):
+    """Окно рассылки: слияние update, дельты изменившихся полей и номера версий."""
+
+    def setUp(self):
+        super().setUp()
+        self.broadcaster = ShiftBroadcaster(fakeredis.FakeAsyncRedis(server=self.server), window=0)
+        self.broadcaster.channel_layer = mock.AsyncMock()
+
+    def send(self, shift_id, *messages):
+        async def publish_and_flush():
+            for message in messages:
+                await self.broadcaster.publish(shift_id, message)
+            await self.broadcaster.flush(shift_id)
+            # Отложенная отправка окна находит outbox пустым
+            await asyncio.sleep(0)
+
+        self.broadcaster.channel_layer.group_send.reset_mock()
+        async_to_sync(publish_and_flush)()
+        return [call.args[1] for call in self.broadcaster.channel_layer.group_send.await_args_list]
+
+    def update(self, task_id, **data):
+        return {"type": "task.update", "event": "update", "task_id": task_id, "data": data}
+
+    def test_updates_of_one_task_are_merged(self):
+        sent = self.send(1, self.update(5, ready_value=1), self.update(5, ready_value=2, rate=3),
+                         self.update(6, ready_value=1))
+
+        self.assertEqual([message["task_id"] for message in sent], [5, 6])
+        self.assertEqual(sent[0]["data"], {"ready_value": 2, "rate": 3})
+
+    def test_update_carries_only_changed_fields(self):
+        self.send(1, {"type": "task.update", "event": "resume", "task_id": 5,
+                      "data": {"id": 5, "ready_value": 2, "rate": 3}})
+
+        sent = self.send(1, self.update(5, ready_value=2, rate=4, server_time="now"))
+        self.assertEqual(sent[0]["data"], {"rate": 4, "server_time": "now"})
+        # Ничего не изменилось – нечего и отправлять
+        self.assertEqual(self.send(1, self.update(5, ready_value=2, rate=4)), [])
+
+    def test_versions_continue_across_flushes(self):
+        first = self.send(1, self.update(5, ready_value=1), self.update(6, ready_value=1))
+        second = self.send(1, self.update(5, ready_value=2))
+
+        self.assertEqual([message["version"] for message in first + second], [1, 2, 3])
+        self.assertEqual(self.redis.get(version_key(1)), "3")
+        self.assertEqual(self.send(2, self.update(7, ready_value=1))[0]["version"], 1)
+
+
+@skipUnless(fakeredis, "Redis tests need fakeredis[lua] from req-test.txt")
+class ShiftConsumerVersionTests(RedisTestCase):
+    """Соединение применяет обновления по порядку версий, а при пропуске отправляет снимок."""
+
+    def setUp(self):
+        super().setUp()
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        ShiftTask.objects.create(shift=shift, order=0, target=100)
+        self.seed(shift)
+        self.redis.set(version_key(shift.id), 7)
+
+        redis_conn = fakeredis.FakeAsyncRedis(server=self.server, decode_responses=True)
+        self.consumer = ShiftConsumer()
+        self.consumer.snapshot_script = redis_conn.register_script(SHIFT_SNAPSHOT_SCRIPT)
+        self.consumer.subscription = Subscription()
+        self.consumer._pending = {}
+        self.consumer.shift_id = shift.id
+        self.consumer.version = 5
+        self.consumer.send = mock.AsyncMock()
+
+    def deliver(self, version):
+        self.consumer.send.reset_mock()
+        async_to_sync(self.consumer.task_update)(
+            {"event": "update", "task_id": 1, "version": version, "data": {"ready_value": version}}
+        )
+        return [json.loads(call.kwargs["text_data"]) for call in self.consumer.send.await_args_list]
+
+    def test_next_version_is_delivered(self):
+        sent = self.deliver(6)
+        self.assertEqual([(message["type"], message["version"]) for message in sent], [("task_update", 6)])
+        self.assertEqual(self.deliver(6), [])
+
+    def test_gap_sends_snapshot(self):
+        sent = self.deliver(7)
+
+        self.assertEqual([message["type"] for message in sent], ["shift_init"])
+        self.assertEqual(sent[0]["version"], 7)
+        self.assertEqual(len(sent[0]["data"]["tasks"]), 1)
+        # Обновления, уже учтённые в снимке, не повторяются
+        self.assertEqual(self.deliver(7), [])
+
+
+@skipUnless(fakeredis, "Redis tests need fakeredis[lua] from req-test.txt")
+class PackingBulkTests(RedisTestCase):
+    """Пакетная загрузка событий сканеров: POST /api/packing_log/bulk/."""
+
+    url = '/api/packing_log/bulk/'
+
+    def setUp(self):
+        super().setUp()
+        active_shift._cache.clear()
+        self.addCleanup(active_shift._cache.clear)
+        self.client = APIClient()
+
+    def start_shift(self):
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        task = ShiftTask.objects.create(shift=shift, order=0, target=100)
+        self.seed(shift)
+        return shift, task
+
+    def test_results_per_event(self):
+        shift, task = self.start_shift()
+
+        response = self.client.post(self.url, [
+            {"sid": 1, "timestamp": "2024-03-05T08:00:00Z"}, {"sid": "scanner"}, {"timestamp": "2024-03-05T08:00:00Z"},
+        ], format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data["accepted"], response.data["rejected"]), (1, 2))
+        first, second, third = response.data["results"]
+        self.assertEqual((first["accepted"], first["shift"], first["task"]), (True, shift.id, str(task.id)))
+        self.assertIn("sid", second["errors"])
+        self.assertIn("sid", third["errors"])
+        self.assertEqual(list(PackingLog.objects.values_list('sid', 'task_id')), [(1, task.id)])
+        self.assertEqual(self.redis.hget(f"task:{task.id}", "ready_value"), "1")
+
+    def test_no_active_shift(self):
+        response = self.client.post(self.url, {"events": [{"sid": 1}, {"sid": 2}]}, format='json')
+
+        self.assertEqual(response.data["accepted"], 0)
+        self.assertEqual(
+            [result["errors"] for result in response.data["results"]], [["No active shift found."]] * 2
+        )
+        self.assertFalse(PackingLog.objects.exists())
+
+    @override_settings(PACKING_BULK_MAX_EVENTS=2)
+    def test_events_limit(self):
+        self.start_shift()
+        response = self.client.post(self.url, [{"sid": 1}, {"sid": 2}, {"sid": 3}], format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(PackingLog.objects.exists())
+
+    def test_one_insert_per_batch(self):
+        self.start_shift()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, [{"sid": sid} for sid in range(50)], format='json')
+
+        self.assertEqual(response.data["accepted"], 50)
+        inserts = [query for query in queries if query["sql"].startswith('INSERT INTO "dashboard_packinglog"')]
+        self.assertEqual(len(inserts), 1)
+
+
+@skipUnless(fakeredis, "Redis tests need fakeredis[lua] from req-test.txt")
+class ShiftLiveViewTests(RedisTestCase):
+    """Живое состояние смен из Redis: /api/shift/<id>/live/ и /api/shift/live/?ids=."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(ShiftLiveView, 'redis', RedisRepository())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.shifts = []
+        for _ in range(2):
+            shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+            ShiftTask.objects.create(shift=shift, order=0, target=100)
+            self.seed(shift)
+            self.shifts.append(shift)
+
+    def test_single_snapshot_without_sql(self):
+        shift = self.shifts[0]
+        with self.assertNumQueries(0):
+            response = self.client.get(f'/api/shift/{shift.id}/live/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["shift_id"], shift.id)
+        self.assertEqual(len(response.data["tasks"]), 1)
+
+    def test_several_snapshots_without_sql(self):
+        ids = ",".join(str(shift.id) for shift in self.shifts)
+        with self.assertNumQueries(0):
+            response = self.client.get(f'/api/shift/live/?ids={ids},999')
+
+        self.assertEqual(response.status_code, 200)
+        # Смен, которых нет в Redis, в ответе нет
+        self.assertEqual([snapshot["shift_id"] for snapshot in response.data], [shift.id for shift in self.shifts])
+
+    def test_shift_missing_in_redis(self):
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/shift/999/live/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_bad_ids(self):
+        self.assertEqual(self.client.get('/api/shift/live/?ids=1,x').status_code, 400)
+
+
+@skipUnless(fakeredis, "Redis tests need fakeredis[lua] from req-test.txt")
+class ThroughputTests(RedisTestCase):
+    """Ряд выработки: живой из поминутных счётчиков Redis, завершённый – из PackingLog."""
+
+    def setUp(self):
+        super().setUp()
+        active_shift._cache.clear()
+        self.addCleanup(active_shift._cache.clear)
+        self.start = timezone.now().replace(second=0, microsecond=0) - timedelta(minutes=3)
+        self.minute = minute_bucket(self.start)
+        # Ряд живой смены доходит до текущей минуты – останавливаем часы
+        patcher = mock.patch('django.utils.timezone.now', return_value=self.start + timedelta(minutes=3, seconds=30))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_live_series_from_redis(self):
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=self.start)
+        task = ShiftTask.objects.create(shift=shift, order=0, target=100, norm_in_minute=2, started_at=self.start)
+        self.seed(shift)
+        RedisRepository().add_packed_units(shift.id, task.id, 6, minutes={
+            self.minute: 3, self.minute + 1: 2, self.minute + 3: 1,
+        })
+
+        series = get_throughput(shift_id=shift.id, bucket=2)
+
+        self.assertTrue(series["live"])
+        self.assertEqual([point["units"] for point in series["points"]], [5, 1])
+        self.assertEqual(series["points"][0]["rate"], 2.5)
+        self.assertEqual(series["points"][0]["time"], self.start)
+        self.assertEqual(get_throughput(task_id=task.id)["norm_in_minute"], 2)
+        self.assertEqual([point["units"] for point in get_throughput(task_id=task.id)["points"]], [3, 2, 0, 1])
+
+    def test_completed_series_from_packing_log(self):
+        shift = make_shift(start_time=self.start, end_time=self.start + timedelta(minutes=3, seconds=30))
+        task = ShiftTask.objects.create(shift=shift, order=0, target=100, started_at=self.start)
+        for offset in (5, 40, 70, 200):
+            PackingLog.objects.create(shift=shift, task=task, sid=offset,
+                                      created_at=self.start + timedelta(seconds=offset))
+        # Счётчики Redis для завершённой смены не читаются
+        self.redis.hset(throughput_key("shift", shift.id), self.minute, 100)
+
+        series = get_throughput(shift_id=shift.id)
+
+        self.assertFalse(series["live"])
+        self.assertEqual([point["units"] for point in series["points"]], [2, 1, 0, 1])
+        self.assertEqual([point["units"] for point in get_throughput(shift_id=shift.id, bucket=3)["points"]], [3, 1])
+
+    def test_rejected_event_does_not_count(self):
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=self.start)
+        task = ShiftTask.objects.create(shift=shift, order=0, target=100, started_at=self.start)
+        self.seed(shift)
+        client = APIClient()
+        with mock.patch.object(PackingLogViewSet, 'redis', RedisRepository()):
+            self.assertEqual(client.post('/api/packing_log/', {"sid": "x"}, format='json').status_code, 400)
+            self.assertEqual(self.redis.hget(f"task:{task.id}", "ready_value"), "0")
+
+            self.assertEqual(client.post('/api/packing_log/', {"sid": 1}, format='json').status_code, 201)
+        self.assertEqual(self.redis.hget(f"task:{task.id}", "ready_value"), "1")
+
+
+@skipUnless(fakeredis, "Redis tests need fakeredis[lua] from req-test.txt")
+@override_settings(SHIFT_ENGINE={**settings.SHIFT_ENGINE, "LOCK_TIMEOUT": 0.2})
+class ShiftLifecycleLockTests(RedisTestCase):
+    """Блокировка переходов смен: повторный вход в одном потоке и ожидание для остальных."""
+
+    def setUp(self):
+        super().setUp()
+        active_shift._cache.clear()
+        self.addCleanup(active_shift._cache.clear)
+        self.active = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        ShiftTask.objects.create(shift=self.active, order=0, target=100)
+        self.seed(self.active)
+        self.planned = make_shift(status=Shift.Status.PLANNED, planned_start_time=timezone.now())
+        ShiftTask.objects.create(shift=self.planned, order=0, target=100)
+
+    def test_start_reenters_lock_to_finalize_active_shift(self):
+        # start_planned_shift держит блокировку и внутри вызывает finalize_shifts
+        self.assertTrue(start_planned_shift(self.planned.id))
+
+        self.active.refresh_from_db()
+        self.planned.refresh_from_db()
+        self.assertEqual(self.active.status, Shift.Status.COMPLETED)
+        self.assertEqual(self.planned.status, Shift.Status.ACTIVE)
+        self.assertFalse(self.redis.exists(LIFECYCLE_LOCK_KEY))
+        # Повторный запуск той же смены ничего не делает
+        self.assertFalse(start_planned_shift(self.planned.id))
+
+    def test_transition_waits_for_other_holder(self):
+        other = self.redis.lock(LIFECYCLE_LOCK_KEY, timeout=60)
+        self.assertTrue(other.acquire())
+        with self.assertRaises(ShiftLockTimeout):
+            start_planned_shift(self.planned.id)
+        other.release()
+
+        self.planned.refresh_from_db()
+        self.assertEqual(self.planned.status, Shift.Status.PLANNED)
+
+
+class SweepLiveStateTests(RedisTestCase):
+    """Очистка забытого живого состояния и отчёт о памяти Redis."""
+
+    def setUp(self):
+        super().setUp()
+        self.active = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        self.active_task = ShiftTask.objects.create(shift=self.active, order=0, target=100)
+        self.seed(self.active)
+        self.done = make_shift(start_time=timezone.now())
+        self.done_task = ShiftTask.objects.create(shift=self.done, order=0, target=100)
+        self.seed(self.done)
+        for kind, object_id in (("shift", self.active.id), ("task", self.active_task.id),
+                                ("shift", self.done.id), ("task", self.done_task.id)):
+            self.redis.hset(throughput_key(kind, object_id), "0", 1)
+        # Задание, чей хэш потерян: осталась только минутная статистика
+        self.redis.hset(throughput_key("task", 999), "0", 1)
+        self.redis.set(lease_key(self.done.id), "engine", px=60000)
+        self.redis.hset(PRODUCT_LOOKUP_KEY, "1", "{}")
+        self.redis.hset(PACKING_LOOKUP_KEY, "1", "{}")
+
+    def test_sweep_removes_inactive_and_orphaned_keys(self):
+        swept = sweep_live_state()
+
+        for key in (f"shift:{self.done.id}", f"shift:{self.done.id}:tasks", throughput_key("shift", self.done.id),
+                    f"task:{self.done_task.id}", throughput_key("task", self.done_task.id),
+                    throughput_key("task", 999)):
+            self.assertFalse(self.redis.exists(key), key)
+        self.assertEqual(swept, 6)
+        for key in (f"shift:{self.active.id}", f"shift:{self.active.id}:tasks",
+                    throughput_key("shift", self.active.id), f"task:{self.active_task.id}",
+                    throughput_key("task", self.active_task.id),
+                    lease_key(self.done.id), PRODUCT_LOOKUP_KEY, PACKING_LOOKUP_KEY):
+            self.assertTrue(self.redis.exists(key), key)
+        # Повторный проход ничего не находит
+        self.assertEqual(sweep_live_state(), 0)
+
+    def test_memory_report_groups_keys_by_shift(self):
+        out = StringIO()
+        # fakeredis не знает MEMORY USAGE: каждый ключ считается по 10 байт
+        with mock.patch.object(RedisRepository, 'memory_usage', lambda repo, keys: {key: 10 for key in keys}), \
+                mock.patch.object(RedisRepository, 'memory_info', lambda repo: {}):
+            call_command('redis_memory_report', stdout=out)
+        lines = out.getvalue().splitlines()
+        rows = {line.split()[0]: line.split()[1:] for line in lines[1:-2]}
+
+        # Задания, ключи, байты
+        self.assertEqual(rows[str(self.active.id)], ["1", "5", "50"])
+        self.assertEqual(rows[str(self.done.id)], ["1", "5", "50"])
+        self.assertEqual(rows["orphaned"], ["1", "1", "10"])
+        self.assertEqual(lines[-2], "Lookup hashes: 20 bytes")
+        self.assertIn("Live state: 130 bytes", lines[-1])
+
+class RecordingBroadcaster:
+    """Вместо рассылки в группы запоминает сообщения движка."""
+
+    def __init__(self):
+        self.messages = []
+
+    async def publish(self, shift_id, message):
+        self.messages.append(message)
+
+    async def announce(self, line, message):
+        self.messages.append(message)
+
+
+@skipUnless(fakeredis, "Redis tests need fakeredis[lua] from req-test.txt")
+class ShiftEngineTests(RedisTestCase):
+    """Переходы между заданиями в ShiftEngine на fakeredis."""
+
+    def setUp(self):
+        super().setUp()
+        self.engine = ShiftEngine(resync_interval=60)
+        self.engine.redis = fakeredis.FakeAsyncRedis(server=self.server, decode_responses=True)
+        self.engine.broadcaster = RecordingBroadcaster()
+        self.engine._task_script = self.engine.redis.register_script(TASK_SCRIPT)
+        self.engine._advance_script = self.engine.redis.register_script(ADVANCE_TASK_SCRIPT)
+        self.engine._metrics_script = self.engine.redis.register_script(METRICS_SCRIPT)
+        self.engine._release_lease = self.engine.redis.register_script(RELEASE_LEASE_SCRIPT)
+        self.engine._renew_lease = self.engine.redis.register_script(RENEW_LEASE_SCRIPT)
+
+    def attach(self, shift, index=0):
+        tasks = self.seed(shift)
+        state = ShiftState(shift.id, [str(task.id) for task in tasks])
+        state.active_index = index
+        state.task_id = state.task_ids[index]
+        state.task = async_to_sync(self.engine._load_task)(state.task_key)
+        self.engine.shifts[shift.id] = state
+        return state, tasks
+
+    def events(self):
+        return [message["event"] for message in self.engine.broadcaster.messages]
+
+    def test_finish_broadcasts_current_counters(self):
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        ShiftTask.objects.create(shift=shift, order=0, target=100)
+        state, tasks = self.attach(shift)
+        self.redis.hset(f"task:{tasks[0].id}", "ready_value", 42)
+
+        async_to_sync(self.engine._finish_task)(state)
+
+        finish = self.engine.broadcaster.messages[-1]
+        self.assertEqual(finish["event"], "finish")
+        self.assertEqual(finish["data"]["ready_value"], "42")
+        self.assertTrue(self.redis.hget(f"task:{tasks[0].id}", "finished_at"))
+
+    def drop_live_state(self, shift, tasks):
+        # Так ключи удаляет finalize_shifts, запущенный в обход движка
+        RedisRepository().delete_shift_state([shift.id], [task.id for task in tasks])
+
+    def test_finish_after_external_finalize_detaches(self):
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        ShiftTask.objects.create(shift=shift, order=0, target=100)
+        state, tasks = self.attach(shift)
+        self.drop_live_state(shift, tasks)
+
+        self.assertFalse(async_to_sync(self.engine._finish_task)(state))
+
+        self.assertNotIn(shift.id, self.engine.shifts)
+        self.assertFalse(self.redis.exists(f"task:{tasks[0].id}"))
+        self.assertNotIn(f"task:{tasks[0].id}", self.redis.smembers(CHECKPOINT_DIRTY_KEY))
+        self.assertEqual(self.events(), [])
+
+    def test_switch_with_lost_state_detaches(self):
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        ShiftTask.objects.create(shift=shift, order=0, target=100)
+        ShiftTask.objects.create(shift=shift, order=1, target=100)
+        tasks = self.seed(shift)
+        state = ShiftState(shift.id, [str(task.id) for task in tasks])
+        self.engine.shifts[shift.id] = state
+        self.drop_live_state(shift, tasks)
+
+        async_to_sync(self.engine._switch_task)(state, 0)
+
+        self.assertNotIn(shift.id, self.engine.shifts)
+        self.assertFalse(self.redis.exists(f"shift:{shift.id}"))
+
+    def test_advance_is_compare_and_set(self):
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        ShiftTask.objects.create(shift=shift, order=0, target=100)
+        ShiftTask.objects.create(shift=shift, order=1, target=100)
+        self.seed(shift)
+
+        repository = RedisRepository()
+        self.assertEqual(repository.advance_active_task(shift.id, expected=0), (True, 1))
+        # Повторное нажатие с тем же индексом не продвигает смену второй раз
+        self.assertEqual(repository.advance_active_task(shift.id, expected=0), (False, 1))
+        # За последнее задание не уходим
+        self.assertEqual(repository.advance_active_task(shift.id, expected=1), (True, 2))
+        self.assertEqual(repository.advance_active_task(shift.id), (False, 2))
+
+    def test_missing_task_is_skipped(self):
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        ShiftTask.objects.create(shift=shift, order=0, target=100)
+        ShiftTask.objects.create(shift=shift, order=1, target=100)
+        tasks = self.seed(shift)
+        self.redis.delete(f"task:{tasks[0].id}")
+        state = ShiftState(shift.id, [str(task.id) for task in tasks])
+
+        async_to_sync(self.engine._switch_task)(state, 0)
+
+        self.assertEqual(self.redis.hget(f"shift:{shift.id}", "active_task"), "1")
+        self.assertEqual(state.task_id, str(tasks[1].id))
+        self.assertEqual(self.events(), ["new_task"])
+
+    def test_break_end_follows_concurrent_advance(self):
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        ShiftTask.objects.create(shift=shift, order=0, type=ShiftTask.TaskType.BREAK, remaining_time=1)
+        ShiftTask.objects.create(shift=shift, order=1, target=100)
+        ShiftTask.objects.create(shift=shift, order=2, target=100)
+        state, tasks = self.attach(shift)
+        self.redis.hset(f"task:{tasks[0].id}", "started_at", to_epoch(timezone.now() - timedelta(minutes=5)))
+        # Пока истекал перерыв, мастер дважды переключил смену
+        self.redis.hset(f"shift:{shift.id}", "active_task", 2)
+
+        async_to_sync(self.engine._on_deadline)(state)
+
+        self.assertEqual(self.redis.hget(f"shift:{shift.id}", "active_task"), "2")
+        self.assertEqual(state.active_index, 2)
+        self.assertEqual(state.task_id, str(tasks[2].id))
+        self.assertEqual(self.events(), ["finish", "new_task"])
+
+    def test_break_end_advances_shift(self):
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        ShiftTask.objects.create(shift=shift, order=0, type=ShiftTask.TaskType.BREAK, remaining_time=1)
+        ShiftTask.objects.create(shift=shift, order=1, target=100)
+        state, tasks = self.attach(shift)
+        self.redis.hset(f"task:{tasks[0].id}", "started_at", to_epoch(timezone.now() - timedelta(minutes=5)))
+
+        async_to_sync(self.engine._on_deadline)(state)
+
+        self.assertEqual(self.redis.hget(f"shift:{shift.id}", "active_task"), "1")
+        self.assertEqual(state.task_id, str(tasks[1].id))
+        self.assertIn(f"shift:{shift.id}", self.redis.smembers(CHECKPOINT_DIRTY_KEY))
+
+    def test_stopped_line_falls_behind_norm(self):
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        ShiftTask.objects.create(shift=shift, order=0, target=100, norm_in_minute=2)
+        state, tasks = self.attach(shift)
+        # Задание идёт полчаса, а упаковки не было – событий, пересчитывающих показатели, тоже
+        self.redis.hset(f"task:{tasks[0].id}", "started_at", to_epoch(timezone.now() - timedelta(minutes=30)))
+
+        async_to_sync(self.engine._refresh_metrics)()
+
+        self.assertEqual(self.redis.hget(f"task:{tasks[0].id}", "behind_norm"), "1")
+        self.assertEqual(self.events(), ["update", "behind_norm"])
+        self.assertTrue(self.engine.broadcaster.messages[1]["data"]["behind_norm"])
+
+        async_to_sync(self.engine._refresh_metrics)()
+        # Линия всё ещё отстаёт – повторного уведомления нет
+        self.assertNotIn("behind_norm", self.events()[2:])
+
+
+    def other_engine(self):
+        engine = ShiftEngine(resync_interval=60)
+        engine.redis = self.engine.redis
+        engine._renew_lease = engine.redis.register_script(RENEW_LEASE_SCRIPT)
+        return engine
+
+    def test_lease_is_exclusive(self):
+        other = self.other_engine()
+        self.assertTrue(async_to_sync(self.engine._acquire_lease)(1))
+        # Повторный захват своей аренды только продлевает её
+        self.assertTrue(async_to_sync(self.engine._acquire_lease)(1))
+        self.assertFalse(async_to_sync(other._acquire_lease)(1))
+        self.assertEqual(self.redis.get(lease_key(1)), self.engine.owner)
+
+    def test_expired_lease_is_taken_over(self):
+        other = self.other_engine()
+        self.engine.lease_ms = 50
+        self.assertTrue(async_to_sync(self.engine._acquire_lease)(1))
+        time.sleep(0.1)
+
+        self.assertTrue(async_to_sync(other._acquire_lease)(1))
+        self.assertEqual(self.redis.get(lease_key(1)), other.owner)
+
+    def test_lost_lease_detaches_shift(self):
+        for shift_id in (1, 2):
+            async_to_sync(self.engine._acquire_lease)(shift_id)
+            self.engine.shifts[shift_id] = ShiftState(shift_id, ["1"])
+        state = self.engine.shifts[2]
+        # Аренда смены 2 истекла, и её забрал другой движок
+        self.redis.set(lease_key(2), "other-engine")
+
+        async_to_sync(self.engine._renew_leases)()
+
+        self.assertEqual(list(self.engine.shifts), [1])
+        self.assertEqual(state.generation, 1)
+        self.assertEqual(self.redis.get(lease_key(2)), "other-engine")
+
+@skipUnless(fakeredis, "Redis tests need fakeredis[lua] from req-test.txt")
+class PackedUnitsMetricsTests(RedisTestCase):
+    """Показатели задания пишутся вместе с тем ready_value, по которому посчитаны."""
+
+    def setUp(self):
+        super().setUp()
+        shift = make_shift(status=Shift.Status.ACTIVE, start_time=timezone.now())
+        self.shift_id = shift.id
+        self.task = ShiftTask.objects.create(shift=shift, order=0, target=100, norm_in_minute=2)
+        self.seed(shift)
+        self.key = f"task:{self.task.id}"
+        self.redis.hset(self.key, "started_at", to_epoch(timezone.now() - timedelta(minutes=10)))
+
+    def test_metrics_follow_packed_units(self):
+        RedisRepository().add_packed_units(self.shift_id, self.task.id, 20)
+
+        task = self.redis.hgetall(self.key)
+        self.assertEqual(task["ready_value"], "20")
+        self.assertAlmostEqual(float(task["norm_deficit"]), 0, delta=0.1)
+        self.assertEqual(task["behind_norm"], "0")
+
+    def test_stale_metrics_are_not_written(self):
+        repository = RedisRepository()
+        repository.add_packed_units(self.shift_id, self.task.id, 20)
+        current = self.redis.hget(self.key, "norm_deficit")
+        written = repository._metrics_script(keys=[self.key], args=metrics_args(19, {"norm_deficit": 1.5}))
+
+        self.assertEqual(written, [0])
+        self.assertEqual(self.redis.hget(self.key, "norm_deficit"), current)
@@ -0,0 +1,70 @@
+"""
+Таймеры заданий, вычисляемые из отметок времени.
+
+В Redis хранятся только started_at, finished_at, paused_at (начало текущей
+паузы), paused_total (сумма завершённых пауз в секундах) и для перерывов
+duration. Время выполнения и остаток перерыва вычисляются при чтении,
+поэтому их не нужно записывать каждую секунду.
+
+Отметки времени хранятся в Redis числами (секунды от эпохи), а клиентам
+with_timers отдаёт их в ISO 8601.
+"""
+from datetime import datetime, timezone as dt_timezone
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+TIMESTAMP_FIELDS = ("started_at", "finished_at", "paused_at", "projected_finish")
+
+
+def parse_time(value):
+    """Отметка времени из Redis (число секунд) или из ISO-строки."""
+    if value in (None, ""):
+        return None
+    try:
+        return datetime.fromtimestamp(float(value), tz=dt_timezone.utc)
+    except (TypeError, ValueError):
+        return parse_datetime(value)
+
+
+def to_epoch(moment):
+    return round(moment.timestamp(), 3) if moment else None
+
+
+def elapsed_seconds(task_data, now=None):
+    """Время выполнения задания без учёта пауз."""
+    started_at = parse_time(task_data.get("started_at"))
+    if not started_at:
+        return 0
+    end = (
+        parse_time(task_data.get("paused_at"))
+        or parse_time(task_data.get("finished_at"))
+        or now
+        or timezone.now()
+    )
+    paused_total = float(task_data.get("paused_total") or 0)
+    return max(0, int((end - started_at).total_seconds() - paused_total))
+
+
+def remaining_seconds(task_data, now=None):
+    """Остаток перерыва; для обычных заданий None."""
+    if task_data.get("type") != "BREAK":
+        return None
+    duration = int(task_data.get("duration") or task_data.get("remaining_time") or 0)
+    return max(0, duration - elapsed_seconds(task_data, now))
+
+
+def with_timers(task_data, now=None):
+    """Копия хэша задания с вычисленными time_spent и remaining_time."""
+    if not task_data:
+        return task_data
+    now = now or timezone.now()
+    data = dict(task_data)
+    for field in TIMESTAMP_FIELDS:
+        if data.get(field):
+            data[field] = parse_time(data[field]).isoformat()
+    data["time_spent"] = elapsed_seconds(task_data, now)
+    if task_data.get("type") == "BREAK":
+        data["remaining_time"] = remaining_seconds(task_data, now)
+    data["server_time"] = now.isoformat()
+    return data
@@ -1,6 +1,8 @@
 import logging
 
+from django.conf import settings
 from django.db.models import Prefetch
+from django.utils.dateparse import parse_date
 from rest_framework import viewsets, status, permissions, generics
 from rest_framework.decorators import action, api_view
 from rest_framework.exceptions import PermissionDenied
@@ -8,6 +10,7 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from .active_shift import get_active_shift_id, request_line
 from .models import Shift, Product, Packing, PackingLog, DefaultSettings, ShiftTask, Master
 from .repos.redis_repository import RedisRepository
 from .ser import ShiftDetailSerializer
@@ -21,7 +24,8 @@ from .serializers import (
     PackingCreateSerializer, DetailedShiftSerializer, _ShiftTaskSerializer,
     ShiftListSerializer
 )
-from .services import get_shifts_statistics
+from .services import get_shifts_statistics, get_throughput, ingest_packing_events
+from .tasks import sync_active_task
 
 
 class BaseViewSet(viewsets.ModelViewSet):
@@ -34,9 +38,31 @@ class PackageViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.AllowAny]
 
 
+def _query_date(params, name):
+    if not params.get(name):
+        return None
+    value = parse_date(params[name])
+    if value is None:
+        raise ValueError(name)
+    return value
+
+
 @api_view(['GET'])
 def shifts_statistics(request):
-    statistics = get_shifts_statistics()
+    """
+    Параметры: date_from, date_to (YYYY-MM-DD), master (id),
+    page, page_size – страница shifts_details каждого мастера.
+    """
+    params = request.query_params
+    try:
+        date_from, date_to = (_query_date(params, name) for name in ('date_from', 'date_to'))
+        master_id = int(params['master']) if params.get('master') else None
+        page = max(1, int(params.get('page', 1)))
+        page_size = min(max(1, int(params.get('page_size', 20))), 100)
+    except ValueError:
+        return Response({"detail": "Некоректні параметри фільтрації."}, status=status.HTTP_400_BAD_REQUEST)
+
+    statistics = get_shifts_statistics(date_from, date_to, master_id, page, page_size)
     return Response(statistics)
 
 class CalculatePercentageView(APIView):
@@ -60,8 +86,8 @@ class CalculatePercentageView(APIView):
             except ValueError:
                 return Response({"detail": "'target' має бути дійсним числом."}, status=status.HTTP_400_BAD_REQUEST)
 
-            # Перевірка на ділення на нуль у norm_in_minute() та get_shift_duration_in_minute()
-            norm_in_minute = packing.norm_in_minute()
+            # Норма за хвилину зберігається в Packing, тривалість зміни береться з кешу налаштувань
+            norm_in_minute = packing.norm_in_minute
             if norm_in_minute == 0:
                 return Response({"detail": "Норма пакування дорівнює нулю, неможливо розрахувати відсоток."},
                                 status=status.HTTP_400_BAD_REQUEST)
@@ -128,13 +154,11 @@ class ShiftViewSet(viewsets.ModelViewSet):
         serializer.is_valid(raise_exception=True)
 
         if is_many:
-            created_shifts = []
-            for item in serializer.validated_data:
-                shift_serializer = self.get_serializer(data=item)
-                shift_serializer.is_valid(raise_exception=True)
-                created_shift = shift_serializer.save()
-                created_shifts.append(created_shift)
-
+            # Список проверяется один раз и сохраняется пачкой (BulkShiftSerializer)
+            created_shifts = serializer.save()
+            created_shifts = Shift.objects.filter(
+                id__in=[shift.id for shift in created_shifts]
+            ).prefetch_related('shifttask_set').order_by('id')
             response_serializer = self.get_serializer(created_shifts, many=True)
             return Response(response_serializer.data, status=status.HTTP_201_CREATED)
 
@@ -181,7 +205,7 @@ class ShiftListAPI(APIView):
 
 class ActiveShiftView(APIView):
     def get(self, request):
-        active_shift = Shift.objects.get_active_shift()
+        active_shift = Shift.objects.filter(id=get_active_shift_id(request_line(request))).first()
         if not active_shift:
             return Response(
                 {"detail": "Активна зміна не знайдена"},
@@ -191,24 +215,98 @@ class ActiveShiftView(APIView):
         serializer = DetailedShiftSerializer(active_shift)
         return Response(serializer.data)
 
+class ShiftLiveView(APIView):
+    """
+    Живое состояние смены прямо из Redis, без обращения к БД:
+    - GET /api/shift/<id>/live/ – одна смена;
+    - GET /api/shift/live/?ids=1,2 – несколько смен одним запросом к Redis.
+    """
+    # Аутентификация по JWT читает пользователя из БД
+    authentication_classes = []
+    permission_classes = [permissions.AllowAny]
+    redis = RedisRepository()
+
+    def get(self, request, id=None):
+        if id is not None:
+            snapshot = self.redis.get_shift_snapshot(id)
+            if not snapshot:
+                return Response({"detail": "Смена не найдена в Redis"}, status=status.HTTP_404_NOT_FOUND)
+            return Response(snapshot)
+
+        try:
+            shift_ids = [int(value) for value in request.query_params.get('ids', '').split(',') if value]
+        except ValueError:
+            return Response({"detail": "'ids' – список идентификаторов через запятую."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        snapshots = self.redis.get_shift_snapshots(shift_ids)
+        return Response([snapshot for snapshot in snapshots.values() if snapshot])
+
+class ThroughputView(APIView):
+    """
+    Выработка по интервалам для графика против нормы:
+    - GET /api/shift/<id>/throughput/?bucket=5
+    - GET /api/task/<id>/throughput/?bucket=1
+    bucket – длина интервала в минутах (1–60).
+    """
+
+    def get(self, request, id, kind):
+        try:
+            bucket = int(request.query_params.get('bucket', 1))
+        except ValueError:
+            bucket = 0
+        if not 1 <= bucket <= 60:
+            return Response({"detail": "'bucket' – число минут от 1 до 60."}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            if kind == "task":
+                series = get_throughput(task_id=id, bucket=bucket)
+            else:
+                series = get_throughput(shift_id=id, bucket=bucket)
+        except (Shift.DoesNotExist, ShiftTask.DoesNotExist):
+            return Response({"detail": "Не найдено."}, status=status.HTTP_404_NOT_FOUND)
+        return Response(series)
+
 class PackingLogViewSet(BaseViewSet):
     queryset = PackingLog.objects.all()
     serializer_class = PackingLogSerializer
     permission_classes = [permissions.AllowAny]
 
     def create(self, request, *args, **kwargs):
-        shift = Shift.objects.get_active_shift()
-        if shift:
-            self._update_shift_progress(shift)
-        return super().create(request, *args, **kwargs)
-
-    def _update_shift_progress(self, shift):
-        task_id = self.redis.conn.lindex(
-            f"shift:{shift.id}:tasks", 
-            self.redis.get_active_task_index(shift.id)
-        )
-        if task_id:
-            self.redis.increment_task_value(task_id, "ready_value")
+        if settings.PACKING_WRITE_BEHIND["ENABLED"]:
+            # Событие подтверждается сразу, в БД оно попадёт пачкой
+            result = ingest_packing_events([request.data], line=request_line(request))[0]
+            return Response(result, status=status.HTTP_202_ACCEPTED if result["accepted"] else status.HTTP_400_BAD_REQUEST)
+
+        response = super().create(request, *args, **kwargs)
+        # Счётчики растут только после записи события: запрос с ошибкой (400) их не трогает
+        shift_id = response.data.get("shift")
+        if shift_id:
+            self.redis.add_packed_units(shift_id, self.redis.get_active_task_id(shift_id), 1)
+        return response
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        Пакетная загрузка событий сканеров: список [{sid, timestamp}, ...]
+        или {"events": [...], "line": "<код линии>"}; линию можно передать
+        и параметром ?line=. Отвечает результатом по каждому событию.
+        """
+        events = request.data.get('events') if isinstance(request.data, dict) else request.data
+        if not isinstance(events, list):
+            return Response({"detail": "Ожидается список событий."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(events) > settings.PACKING_BULK_MAX_EVENTS:
+            return Response(
+                {"detail": f"Не более {settings.PACKING_BULK_MAX_EVENTS} событий за запрос."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        results = ingest_packing_events(events, line=request_line(request))
+        accepted = sum(1 for result in results if result["accepted"])
+        return Response({
+            "accepted": accepted,
+            "rejected": len(results) - accepted,
+            "results": results,
+        })
 
 class ShiftTaskViewSet(BaseViewSet):
     queryset = ShiftTask.objects.all()
@@ -219,21 +317,63 @@ class IncrementActiveTaskView(APIView):
     redis = RedisRepository()
 
     def patch(self, request):
-        shift = Shift.objects.get_active_shift()
-        if not shift:
+        shift_id = get_active_shift_id(request_line(request))
+        if not shift_id:
             return self._error_response("Активная смена не найдена", status.HTTP_404_NOT_FOUND)
 
+        expected = request.data.get('expected_active_task')
         try:
-            shift.increment_active_task()
-            self.redis.update_shift_data(shift.id, {"active_task": shift.active_task})
-            return Response({
-                "message": "Активное задание успешно обновлено",
-                "new_active_task": shift.active_task
-            })
-        except Exception as e:
+            expected = int(expected) if expected is not None else None
+        except (TypeError, ValueError):
+            return self._error_response("'expected_active_task' должен быть числом", status.HTTP_400_BAD_REQUEST)
+
+        try:
+            advanced, active_task = self.redis.advance_active_task(shift_id, expected)
+        except Exception:
             logging.exception("Active task update error")
             return self._error_response("Ошибка обновления задания", status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+        if not advanced:
+            # Задание уже переключено (повторное нажатие) или смена на последнем задании
+            return Response({
+                "error": "Активное задание уже изменилось",
+                "active_task": active_task
+            }, status=status.HTTP_409_CONFLICT)
+
+        sync_active_task.delay(shift_id, active_task)
+        return Response({
+            "message": "Активное задание успешно обновлено",
+            "new_active_task": active_task
+        })
+
+    def _error_response(self, message, status_code):
+        return Response({"error": message}, status=status_code)
+
+
+class ToggleTaskPauseView(APIView):
+    permission_classes = [permissions.AllowAny]
+    redis = RedisRepository()
+
+    def patch(self, request):
+        shift_id = get_active_shift_id(request_line(request))
+        if not shift_id:
+            return self._error_response("Активная смена не найдена", status.HTTP_404_NOT_FOUND)
+
+        task_id = self.redis.get_active_task_id(shift_id)
+        if not task_id:
+            return self._error_response("Активное задание не найдено", status.HTTP_404_NOT_FOUND)
+
+        try:
+            paused = self.redis.toggle_task_pause(task_id)
+        except ValueError:
+            return self._error_response("Задание не выполняется", status.HTTP_409_CONFLICT)
+        except Exception:
+            logging.exception("Task pause toggle error")
+            return self._error_response("Ошибка обновления задания", status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        self.redis.notify_engine("pause", shift_id)
+        return Response({"task_id": task_id, "paused": paused})
+
     def _error_response(self, message, status_code):
         return Response({"error": message}, status=status_code)
 
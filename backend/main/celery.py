@@ -11,8 +11,21 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 
 app.autodiscover_tasks()
 app.conf.beat_schedule = {
-    'check-shifts-every-minute': {
+    # Смены запускает движок в назначенную секунду, здесь – только сверка
+    'check-shifts-reconcile': {
         'task': 'dashboard.tasks.check_and_start_shifts',
-        'schedule': crontab(minute='*'),  # Выполняется каждую минуту
+        'schedule': crontab(minute='*/5'),
+    },
+    'checkpoint-shifts': {
+        'task': 'dashboard.tasks.checkpoint_shifts',
+        'schedule': float(os.environ.get('SHIFT_CHECKPOINT_INTERVAL', 30)),
+    },
+    'flush-packing-events': {
+        'task': 'dashboard.tasks.flush_packing_events',
+        'schedule': float(os.environ.get('PACKING_FLUSH_INTERVAL', 5)),
+    },
+    'sweep-redis-state': {
+        'task': 'dashboard.tasks.sweep_redis_state',
+        'schedule': crontab(minute='*/10'),
     },
 }
@@ -105,6 +105,40 @@ REDIS_CONFIG = {
     "PORT": int(os.environ.get('REDIS_PORT')),
     "DB": int(os.environ.get('REDIS_DB')),
     "PASSWORD": os.environ.get('REDIS_PASSWORD'),
+    # Общий пул соединений процесса (dashboard.repos.connection)
+    "MAX_CONNECTIONS": int(os.environ.get('REDIS_MAX_CONNECTIONS', 50)),
+    "POOL_TIMEOUT": float(os.environ.get('REDIS_POOL_TIMEOUT', 5)),
+    "HEALTH_CHECK_INTERVAL": int(os.environ.get('REDIS_HEALTH_CHECK_INTERVAL', 30)),
+}
+
+SHIFT_ENGINE = {
+    "RESYNC_INTERVAL": float(os.environ.get('SHIFT_ENGINE_RESYNC_INTERVAL', 5)),
+    # Окно, в течение которого обновления смены сливаются в одно сообщение
+    "BROADCAST_WINDOW": float(os.environ.get('SHIFT_BROADCAST_WINDOW', 0.25)),
+    # Сколько секунд процесс помнит активную смену, не спрашивая Redis
+    "ACTIVE_SHIFT_CACHE_TTL": float(os.environ.get('ACTIVE_SHIFT_CACHE_TTL', 2)),
+    # Аренда смены движком: продлевается каждые LEASE_TTL / 3 секунд, по истечении смену забирает другой движок
+    "LEASE_TTL": float(os.environ.get('SHIFT_LEASE_TTL', 15)),
+    # Блокировка запуска/завершения смен
+    "LOCK_TIMEOUT": float(os.environ.get('SHIFT_LOCK_TIMEOUT', 60)),
+}
+
+# Живые показатели заданий (dashboard.metrics)
+SHIFT_METRICS = {
+    "WINDOW_MINUTES": int(os.environ.get('SHIFT_METRICS_WINDOW_MINUTES', 5)),
+    # Ниже этого процента нормы линия считается отстающей
+    "BEHIND_NORM_PERCENT": float(os.environ.get('SHIFT_BEHIND_NORM_PERCENT', 90)),
+}
+
+PACKING_BULK_MAX_EVENTS = int(os.environ.get('PACKING_BULK_MAX_EVENTS', 1000))
+
+# Отложенная запись PackingLog: события копятся в Redis и пишутся в БД пачками
+PACKING_WRITE_BEHIND = {
+    "ENABLED": bool(os.environ.get('PACKING_WRITE_BEHIND')),
+    "BATCH_SIZE": int(os.environ.get('PACKING_FLUSH_BATCH_SIZE', 500)),
+    "CLAIM_IDLE_MS": int(os.environ.get('PACKING_FLUSH_CLAIM_IDLE_MS', 60000)),
+    # Блокировка записи буфера: пачки пишутся в PackingLog по одной
+    "LOCK_TIMEOUT": float(os.environ.get('PACKING_FLUSH_LOCK_TIMEOUT', 60)),
 }
 
 CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL")
@@ -5,12 +5,16 @@ from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
 from dashboard.router import router
 from dashboard.views import CalculatePercentageView, IncrementActiveTaskView, ActiveShiftView, ShiftListAPI, \
-    ShiftDetailAPIView, shifts_statistics
+    ShiftDetailAPIView, shifts_statistics, ToggleTaskPauseView, ShiftLiveView, ThroughputView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include(router.urls)),
     path('api/shift/active/', ActiveShiftView.as_view(), name='active-shift'),
+    path('api/shift/live/', ShiftLiveView.as_view(), name='shift-live-list'),
+    path('api/shift/<int:id>/live/', ShiftLiveView.as_view(), name='shift-live'),
+    path('api/shift/<int:id>/throughput/', ThroughputView.as_view(), {'kind': 'shift'}, name='shift-throughput'),
+    path('api/task/<int:id>/throughput/', ThroughputView.as_view(), {'kind': 'task'}, name='task-throughput'),
     path('api/table/', ShiftListAPI.as_view(), name='shift-table'),
     path('api/shifts_detail/<int:id>/', ShiftDetailAPIView.as_view(), name='shift-detail'),
     path('api/statistics/', shifts_statistics, name='shifts-statistics'),
@@ -19,4 +23,5 @@ urlpatterns = [
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('api/calculate-percentage/', CalculatePercentageView.as_view(), name='calculate_percentage'),
     path('api/shift/increment-active-task/', IncrementActiveTaskView.as_view(), name='increment-active-task'),
+    path('api/shift/toggle_pause/', ToggleTaskPauseView.as_view(), name='toggle-pause'),
 ]
@@ -26,7 +26,8 @@ const useShiftData = () => {
       const response = await apiClient.get('shift/active/');
       const shiftData = response.data;
       const sortedTasks = (shiftData.shifttask_set || []).sort((a, b) => a.order - b.order);
-      const currentTask = sortedTasks.find(t => t.id === shiftData.active_task);
+      // active_task – індекс завдання за порядком, а не його id
+      const currentTask = sortedTasks[parseInt(shiftData.active_task) || 0];
 
       setShift({...shiftData, tasks: sortedTasks});
       setActiveTask(currentTask || null);
@@ -149,8 +150,9 @@ const ShiftManagement = () => {
   }, []);
 
   const tasks = useMemo(() => shift?.tasks || [], [shift]);
+  // Id з REST – числа, зі знімка та кадрів веб-сокета – рядки
   const currentIndex = useMemo(() =>
-      tasks.findIndex(task => task.id === activeTask?.id), [tasks, activeTask]);
+      tasks.findIndex(task => String(task.id) === String(activeTask?.id)), [tasks, activeTask]);
 
   const shiftDuration = useMemo(() => {
     if (!shift?.start_time) return '00:00';
@@ -163,8 +165,15 @@ const ShiftManagement = () => {
 
   const handleAction = async () => {
     try {
-      await apiClient.patch('shift/increment-active-task/');
+      // Індекс, який бачив оператор: повторне натискання не перемкне зміну двічі
+      await apiClient.patch('shift/increment-active-task/', {expected_active_task: currentIndex});
     } catch (error) {
+      if (error.response?.status === 409) {
+        // Зміну вже перемкнули (інший пульт або рушій) – показуємо поточне завдання
+        Modal.info({title: 'Активне завдання вже змінилося', content: 'Дані зміни оновлено.'});
+        fetchActiveShift();
+        return;
+      }
       Modal.error({
         title: 'Помилка',
         content: error.response?.data?.detail || 'Невідома помилка',
@@ -1,19 +1,32 @@
-import React, {useCallback, useEffect, useState} from 'react';
+import React, {useCallback, useEffect, useMemo, useRef, useState} from 'react';
 import ShiftContext from '../services/ShiftContext';
+import {clockOffset, withTimers} from '../services/timers';
+import {LINE} from '../services/api';
 
-const WEBSOCKET_URL = import.meta.env.VITE_WS_URL;
+// Без VITE_LINE клиент подключается к основной линии (ws/shifts/)
+const WEBSOCKET_URL = LINE ? `${import.meta.env.VITE_WS_URL.replace(/\/?$/, '/')}${LINE}/` : import.meta.env.VITE_WS_URL;
+// Выборочная подписка табло, например {"events": ["update", "new_task", "completed"],
+// "fields": ["ready_value", "target", "percent_of_target"], "rate": 0.5}; без неё – полный поток
+const WEBSOCKET_SUBSCRIPTION = import.meta.env.VITE_WS_SUBSCRIPTION;
 const RELOAD_DELAY = 1000;
+const TIMER_INTERVAL = 1000;
 
 const MESSAGE_TYPES = {
   SHIFT_INIT: 'shift_init',
   TASK_UPDATE: 'task_update',
-  SHIFT_UPDATE: 'shift_update'
+  SHIFT_UPDATE: 'shift_update',
+  SUBSCRIBED: 'subscribed',
+  ERROR: 'error'
 };
 
 const ShiftProvider = ({ children }) => {
   const [shiftData, setShiftData] = useState(null);
   const [currentTask, setCurrentTask] = useState(null);
   const [shouldReload, setShouldReload] = useState(false);
+  const [now, setNow] = useState(Date.now());
+  const [offset, setOffset] = useState(0);
+  const socketRef = useRef(null);
+  const versionRef = useRef(0);
 
   const handleShiftInit = useCallback((data) => {
     const {shift, tasks} = data;
@@ -21,21 +34,37 @@ const ShiftProvider = ({ children }) => {
     // Находим активную задачу из списка задач
     const activeTaskIndex = parseInt(shift.active_task) || 0;
     if (tasks && tasks.length > 0) {
-      setCurrentTask(tasks[activeTaskIndex]);
+      const task = tasks[activeTaskIndex];
+      setCurrentTask(task);
+      if (task) setOffset(clockOffset(task.server_time));
     }
   }, []);
 
 
-  const handleTaskUpdate = useCallback((data) => {
-    setCurrentTask(prevTask => ({
-      ...prevTask,
-      ready_value: data.ready_value,
-      time_spent: data.time_spent,
-      remaining_time: data.remaining_time,
-      started_at: data.started_at,
-      finished_at: data.finished_at,
-      norm_in_minute: parseFloat(data.norm_in_minute) || 0
-    }));
+  const handleTaskUpdate = useCallback((data, taskId, event) => {
+    if (!data) return;
+    if (data.server_time) setOffset(clockOffset(data.server_time));
+    setCurrentTask(prevTask => {
+      if (prevTask && String(prevTask.id) !== String(taskId)) return prevTask;
+      // update несёт только изменившиеся поля, pause/resume/finish – задание целиком:
+      // его нужно заменить, иначе удалённые поля (paused_at после resume) останутся
+      return event === 'update' ? {...prevTask, ...data} : data;
+    });
+  }, []);
+
+  // Обновления применяются строго по порядку версий, при пропуске запрашиваем снимок
+  const acceptVersion = useCallback((message) => {
+    if (message.version == null) return true;
+    if (message.version <= versionRef.current) return false;
+    if (message.version > versionRef.current + 1) {
+      const socket = socketRef.current;
+      if (socket && socket.readyState === WebSocket.OPEN) {
+        socket.send(JSON.stringify({action: 'resync'}));
+      }
+      return false;
+    }
+    versionRef.current = message.version;
+    return true;
   }, []);
 
 
@@ -44,6 +73,13 @@ const ShiftProvider = ({ children }) => {
       setShiftData(null);
       setCurrentTask(null);
       setShouldReload(true);
+    } else if (event === 'new_task') {
+      setShiftData(data.shift);
+      setCurrentTask(data.task);
+      if (data.task) setOffset(clockOffset(data.task.server_time));
+    } else if (event === 'behind_norm') {
+      // Сигнал об отставании от нормы: {task_id, behind_norm, efficiency, norm_deficit}
+      setShiftData((prevShift) => ({...prevShift, norm_alert: data}));
     } else {
       setShiftData((prevShift) => ({
         ...prevShift,
@@ -58,28 +94,46 @@ const ShiftProvider = ({ children }) => {
 
     switch (message.type) {
       case MESSAGE_TYPES.SHIFT_INIT:
+        versionRef.current = message.version || 0;
         handleShiftInit(message.data);
         break;
       case MESSAGE_TYPES.TASK_UPDATE:
-        handleTaskUpdate(message.data);
+        if (acceptVersion(message)) handleTaskUpdate(message.data, message.task_id, message.event);
         break;
       case MESSAGE_TYPES.SHIFT_UPDATE:
-        handleShiftUpdate(message.data, message.event);
+        if (acceptVersion(message)) handleShiftUpdate(message.data, message.event);
+        break;
+      case MESSAGE_TYPES.SUBSCRIBED:
+        break;
+      case MESSAGE_TYPES.ERROR:
+        console.error('Ошибка веб-сокета:', message.detail);
         break;
       default:
         console.warn('Неизвестный тип сообщения:', message.type);
     }
-  }, [handleShiftInit, handleTaskUpdate, handleShiftUpdate]);
+  }, [handleShiftInit, handleTaskUpdate, handleShiftUpdate, acceptVersion]);
 
   useEffect(() => {
     const socket = new WebSocket(WEBSOCKET_URL);
     socket.onmessage = handleWebSocketMessage;
+    if (WEBSOCKET_SUBSCRIPTION) {
+      socket.onopen = () => socket.send(JSON.stringify({action: 'subscribe', ...JSON.parse(WEBSOCKET_SUBSCRIPTION)}));
+    }
+    socketRef.current = socket;
 
     return () => {
+      socketRef.current = null;
       socket.close();
     };
   }, [handleWebSocketMessage]);
 
+  useEffect(() => {
+    const timer = setInterval(() => setNow(Date.now()), TIMER_INTERVAL);
+    return () => clearInterval(timer);
+  }, []);
+
+  const activeTask = useMemo(() => withTimers(currentTask, now + offset), [currentTask, now, offset]);
+
   useEffect(() => {
     if (shouldReload) {
       const timer = setTimeout(() => {
@@ -93,7 +147,7 @@ const ShiftProvider = ({ children }) => {
       <ShiftContext.Provider
           value={{
             shift: shiftData,
-            activeTask: currentTask,
+            activeTask: activeTask,
             setShift: setShiftData,
             setActiveTask: setCurrentTask,
             reload: shouldReload
@@ -3,11 +3,15 @@ import axios from 'axios';
 const AUTH_HEADER = 'Bearer';
 const HTTP_UNAUTHORIZED = 401;
 
+// Линия фасовки этого рабочего места (активная смена, переключение заданий, сканеры)
+export const LINE = import.meta.env.VITE_LINE;
+
 const apiClient = axios.create({
     baseURL: import.meta.env.VITE_API_BASE_URL,
     headers: {
         'Content-Type': 'application/json',
     },
+    params: LINE ? {line: LINE} : undefined,
 });
 
 const formatAuthHeader = (token) => `${AUTH_HEADER} ${token}`;
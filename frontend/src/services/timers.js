@@ -0,0 +1,25 @@
+// Таймеры задания считаются на клиенте из отметок времени,
+// сервер присылает только переходы (new_task, finish, pause, resume).
+
+const toMs = (value) => (value ? Date.parse(value) : null);
+
+export const elapsedSeconds = (task, now) => {
+  if (!task || !task.started_at) return 0;
+  const started = toMs(task.started_at);
+  const end = toMs(task.paused_at) || toMs(task.finished_at) || now;
+  const pausedTotal = parseFloat(task.paused_total) || 0;
+  return Math.max(0, Math.floor((end - started) / 1000 - pausedTotal));
+};
+
+export const withTimers = (task, now) => {
+  if (!task) return task;
+  const timeSpent = elapsedSeconds(task, now);
+  if (task.type !== 'BREAK') {
+    return {...task, time_spent: timeSpent};
+  }
+  const duration = parseInt(task.duration) || 0;
+  return {...task, time_spent: timeSpent, remaining_time: Math.max(0, duration - timeSpent)};
+};
+
+// Смещение часов клиента относительно сервера
+export const clockOffset = (serverTime) => (serverTime ? Date.parse(serverTime) - Date.now() : 0);